@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: benchmark.py
+
+# GOAL: Time the tiling, stitching and viewer data paths, and measure their peak memory, on synthetic slides and cell
+#tables, so performance can be compared between versions on any machine without patient data
+
+# INPUT: Nothing. Synthetic slides (synthetic_slide.py) of every --slide-sizes and cell tables of every --cell-counts
+#are generated in --work-dir. The synthetic slides stand in for czi files (see SyntheticCzi)
+
+# OUTPUT: A json file (--output) with the machine, the options and, for every case and size, the seconds of every
+#repeat and the peak memory of the process that ran it. With --compare the results are also compared to an older json
+
+#Cases:
+#   tile        tile_czi_file on a synthetic slide (channel tiffs, deepcell inputs, tile_metadata.txt)
+#   format      create_deepcell_dir_format_from_single_channel_fovs.py on a tiling in the old layout
+#   boundaries  finding the cell borders of every tile of the label store, like the viewer's get_boundaries
+#   quantify    quantify_cells.py on the segmented synthetic slide (the cell tables of every fov)
+#   overlay     generate_stitched_overlay.py on the segmented synthetic slide
+#   stitch      stitch_cell_data.py on a synthetic cell table
+#   thresholds  moving the threshold slider of a marker, like the viewer's threshold_slider_change
+#   cell_types  the categorical cell types the viewer's update_cell_types pushes to the layers
+#   viewport    building the spatial index of the stitched centroids and panning the viewer over the slide
+
+# usage: benchmark.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--cases CASES] [--slide-sizes SLIDE_SIZES] [--cell-counts CELL_COUNTS]
+#                     [--repeats REPEATS] [--workers WORKERS] [--stream] [--tile-size TILE_SIZE] [--work-dir WORK_DIR]
+#                     [--output OUTPUT] [--compare COMPARE] [--keep]
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information while benchmarking. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --cases CASES  Comma separated cases to run. (Default is every case)
+#   --slide-sizes SLIDE_SIZES
+#                  Comma separated sizes in pixels of the square synthetic slides. (Default is 4096,8192)
+#   --cell-counts CELL_COUNTS
+#                  Comma separated number of cells of the synthetic cell tables. (Default is 100000,1000000)
+#   --repeats REPEATS
+#                  Number of times every case is timed. (Default is 3)
+#   --workers WORKERS, -w WORKERS
+#                  Number of processes used by tiling, quantification and the overlay. (Default is 1)
+#   --stream, -s   Tile with --stream. (Default is False)
+#   --tile-size TILE_SIZE
+#                  Tile size of the synthetic slides, or auto (see tile_czi.py). (Default is 2048)
+#   --work-dir WORK_DIR
+#                  Where the synthetic data is written. (Default is a temporary directory)
+#   --output OUTPUT, -o OUTPUT
+#                  Json file the results are written to. (Default is benchmark_results/benchmark-{date}.json)
+#   --compare COMPARE
+#                  Json file of an earlier run to compare the results to
+#   --keep         Keep the synthetic data in --work-dir after the run
+
+#################################################################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from pathlib import Path
+
+from cell_store import CellStore
+from cell_table_io import get_cell_table_path, read_cell_table, write_cell_table
+from cell_type_rules import load_cell_type_rules
+from create_deepcell_dir_format_from_single_channel_fovs import format_directory
+from generate_stitched_overlay import generate_slide_overlay
+from intensity_stats import get_intensity_histograms_path, get_intensity_stats_path
+from label_store import get_label_store_path, lazy_border_pyramid
+from multiscale_utils import ChunkCache
+from quantify_cells import generate_cell_table
+from run_pipeline import get_slide, get_segmented_fovs, run_segment
+from segmentation_utils import print_colored, benchmark_parser, get_peak_rss_mb, get_slide_metadata_path, load_slide_metadata, \
+    get_tile_geometry, load_tile_metadata, profile_span, profiler, enable_profiling
+from stitch_cell_data import stich_cell_data
+from spatial_index import CellGridIndex
+from synthetic_slide import CELL_SPACING, SyntheticCzi, write_synthetic_slide, make_synthetic_cell_table
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import tile_czi
+
+DEBUG = False
+
+DEFAULT_SLIDE_SIZES = [4096, 8192]
+DEFAULT_CELL_COUNTS = [100000, 1000000]
+DEFAULT_REPEATS = 3
+THRESHOLD_STEPS = 20 #Slider positions of a threshold drag
+VIEWPORT_QUERIES = 100 #Views of a pan over the slide
+VIEWPORT_SIZE = 2048 #Pixels of the slide in view
+REGRESSION_RATIO = 1.1 #Cases this much slower than in --compare are printed in red
+
+CHANNELS = tile_czi.channels_to_use
+
+#Runs setup (not timed) and then run, repeats times. Returns the seconds of every run
+def time_repeats(run, repeats, setup=None):
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+# Cases. Each takes the synthetic data, the options and the number of repeats and returns the seconds of every repeat
+#and the number of items (tiles, cells, ...) each repeat went through, for the throughput
+
+def bench_tile(data, options, repeats):
+    tile_dir = Path(data['work_dir'], 'tile_output')
+
+    def setup():
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        tile_dir.mkdir()
+
+    def run():
+        tile_czi.tile_czi_file([data['slide_path']], CHANNELS, stream=options['stream'], workers=options['workers'],
+                               output_dir=tile_dir, tile_size=data['tile_size'])
+
+    seconds = time_repeats(run, repeats, setup)
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    return seconds, {'tiles': len(data['tiles']) * len(CHANNELS)}
+
+#The fov directories of the tiling at the top of the slide directory, like tile_czi.py wrote them before it wrote the
+#deepcell layout itself. Hard links, so setting it up copies no pixels
+def write_old_layout(slide, old_layout_dir):
+    shutil.rmtree(old_layout_dir, ignore_errors=True)
+    old_layout_dir.mkdir()
+    shutil.copy(slide['tile_metadata'], old_layout_dir)
+    for fov in get_segmented_fovs(slide):
+        shutil.copytree(Path(slide['tiff_dir'], fov, "TIFs"), Path(old_layout_dir, fov), copy_function=os.link)
+
+def bench_format(data, options, repeats):
+    old_layout_dir = Path(data['work_dir'], 'old_layout_dir')
+    seconds = time_repeats(lambda: format_directory([old_layout_dir]), repeats,
+                           lambda: write_old_layout(data['slide'], old_layout_dir))
+    shutil.rmtree(old_layout_dir, ignore_errors=True)
+    return seconds, {'fovs': len(get_segmented_fovs(data['slide']))}
+
+#The borders of every tile at full size, with an empty cache every repeat so every tile's borders are found again
+def bench_boundaries(data, options, repeats):
+    return time_repeats(lambda: lazy_border_pyramid(data['label_store_path'], ChunkCache())[0].compute(), repeats), \
+        {'megapixels': data['size'] ** 2 / 1e6}
+
+def bench_quantify(data, options, repeats):
+    slide = data['slide']
+    fovs = get_segmented_fovs(slide)
+
+    def run():
+        generate_cell_table(slide['deepcell_output_dir'], slide['tiff_dir'], fovs, CHANNELS,
+                            label_store_path=data['label_store_path'], workers=options['workers'])
+
+    return time_repeats(run, repeats), {'fovs': len(fovs), 'megapixels': data['size'] ** 2 / 1e6}
+
+def bench_overlay(data, options, repeats):
+    seconds = time_repeats(lambda: generate_slide_overlay(data['slide']['dir'], options['workers']), repeats)
+    return seconds, {'megapixels': data['size'] ** 2 / 1e6}
+
+def bench_stitch(data, options, repeats):
+    return time_repeats(lambda: stich_cell_data(data['cell_dir']), repeats), {'cells': data['cells']}
+
+def get_cell_store(data):
+    return CellStore(read_cell_table(data['cell_table_path']), CHANNELS, cell_type_rules=load_cell_type_rules())
+
+#Drags the slider of every marker a cell type rule uses from 0 to the largest value of the marker
+def bench_thresholds(data, options, repeats):
+    cell_store = get_cell_store(data)
+    markers = [marker for marker in cell_store.markers
+               if any(cell_store.cell_type_rules['used'] & cell_store.marker_bits[marker])]
+
+    def run():
+        for marker in markers:
+            for value in np.linspace(0, float(cell_store.intensities[marker].max()), THRESHOLD_STEPS):
+                cell_store.set_threshold(marker, value)
+
+    return time_repeats(run, repeats), {'threshold_updates': len(markers) * THRESHOLD_STEPS}
+
+def bench_cell_types(data, options, repeats):
+    cell_store = get_cell_store(data)
+    return time_repeats(cell_store.get_cell_types, repeats), {'cells': data['cells']}
+
+#Cells of the table spread over a slide as densely as the synthetic slides, then the index is built and the cells of
+#VIEWPORT_QUERIES views panning over the slide are looked up, like the viewer does as the camera moves
+def bench_viewport(data, options, repeats):
+    rng = np.random.default_rng(0)
+    slide_size = int(np.sqrt(data['cells'])) * CELL_SPACING
+    centroids = rng.uniform(0, slide_size, size=(data['cells'], 2))
+    view_corners = rng.uniform(0, max(slide_size - VIEWPORT_SIZE, 0), size=(VIEWPORT_QUERIES, 2))
+
+    def run():
+        index = CellGridIndex(centroids)
+        for row, col in view_corners:
+            index.query_rect(row, row + VIEWPORT_SIZE, col, col + VIEWPORT_SIZE)
+
+    return time_repeats(run, repeats), {'cells': data['cells'], 'queries': VIEWPORT_QUERIES}
+
+#Which synthetic data every case runs on: 'slide' cases run for every slide size, 'cells' cases for every cell count
+BENCHMARK_CASES = {
+    'tile': {'data': 'slide', 'run': bench_tile},
+    'format': {'data': 'slide', 'run': bench_format},
+    'boundaries': {'data': 'slide', 'run': bench_boundaries},
+    'quantify': {'data': 'slide', 'run': bench_quantify},
+    'overlay': {'data': 'slide', 'run': bench_overlay},
+    'stitch': {'data': 'cells', 'run': bench_stitch},
+    'thresholds': {'data': 'cells', 'run': bench_thresholds},
+    'cell_types': {'data': 'cells', 'run': bench_cell_types},
+    'viewport': {'data': 'cells', 'run': bench_viewport},
+}
+
+# Synthetic data
+
+#Writes a synthetic slide, tiles it and segments it with the threshold backend, so every slide case has its inputs.
+#The tile size the slide was tiled with is read back from its metadata, so the tile case retiles it the same way
+def prepare_slide_data(work_dir, size, tile_size=tile_czi.DEFAULT_TILE_SIZE, workers=1):
+    name = f"synthetic_{size}"
+    slide_path = write_synthetic_slide(Path(work_dir, name + '.npy'), size, size, len(CHANNELS))
+    tile_czi.tile_czi_file([slide_path], CHANNELS, stream=True, output_dir=work_dir, tile_size=tile_size, workers=workers)
+
+    slide = get_slide(slide_path, work_dir)
+    run_segment(slide, {'segmentation': 'threshold', 'model_path': None, 'image_mpp': None, 'scale': None, 'workers': 1})
+    return {
+        'work_dir': work_dir,
+        'size': size,
+        'slide_path': slide_path,
+        'slide': slide,
+        'tiles': load_tile_metadata(slide['tile_metadata']),
+        'tile_size': get_tile_geometry(load_slide_metadata(name))['tile_size'],
+        'label_store_path': get_label_store_path(slide['single_cell_dir'], name),
+    }
+
+#Writes a cell table of ncells cells over the fovs of a segmented slide, in a slide directory of its own
+def prepare_cell_data(work_dir, ncells, slide_data):
+    name = f"cells_{ncells}"
+    cell_dir = Path(work_dir, name + '_dir')
+    Path(cell_dir, "single_cell_output").mkdir(parents=True, exist_ok=True)
+    shutil.copy(slide_data['slide']['tile_metadata'], cell_dir)
+
+    cell_table_path = get_cell_table_path(Path(cell_dir, "single_cell_output"), f"cell_table_arcsinh_transformed-{name}")
+    write_cell_table(make_synthetic_cell_table(ncells, CHANNELS, get_segmented_fovs(slide_data['slide']), slide_data['tile_size']),
+                     cell_table_path)
+    return {'work_dir': work_dir, 'cells': ncells, 'cell_dir': cell_dir, 'cell_table_path': cell_table_path}
+
+# Running
+
+#Runs in a fresh process, so the peak memory is the case's own. Forked processes start with the peak memory of what
+#they were forked with, so that is recorded as the baseline
+def run_case(case, data, options):
+    tile_czi.CziFile = SyntheticCzi
+    baseline_rss_mb = get_peak_rss_mb()
+    with profile_span(case, category='benchmark'):
+        seconds, counts = BENCHMARK_CASES[case]['run'](data, options, options['repeats'])
+    return {
+        'seconds': seconds,
+        'best_seconds': min(seconds),
+        'median_seconds': float(np.median(seconds)),
+        'baseline_rss_mb': baseline_rss_mb,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'workers_peak_rss_mb': get_peak_rss_mb(children=True),
+        'counts': counts,
+        'per_second': {name: count / max(min(seconds), 1e-9) for name, count in counts.items()},
+    }, profiler.take_events()
+
+def run_case_in_process(case, data, options):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        result, trace_events = executor.submit(run_case, case, data, options).result()
+    profiler.add_events(trace_events)
+    return result
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#Results are matched by case and size
+def get_result_key(result):
+    return (result['case'], result.get('slide_size'), result.get('cells'))
+
+def compare_results(results, previous_results_path):
+    with open(previous_results_path) as previous_results_file:
+        previous = json.load(previous_results_file)
+    previous_results = {get_result_key(result): result for result in previous['results']}
+
+    print_colored("cyan", f"Compared to {previous_results_path} ({previous.get('version')})")
+    for result in results:
+        previous_result = previous_results.get(get_result_key(result))
+        if previous_result is None:
+            continue
+        ratio = result['best_seconds'] / max(previous_result['best_seconds'], 1e-9)
+        print_colored("red" if ratio > REGRESSION_RATIO else "green",
+                      f"{result['name']}: {ratio:.2f}x the time ({previous_result['best_seconds']:.3f}s -> "
+                      f"{result['best_seconds']:.3f}s), peak memory {previous_result['peak_rss_mb']:.0f} MB -> "
+                      f"{result['peak_rss_mb']:.0f} MB")
+
+def run_benchmarks(cases, slide_sizes, cell_counts, options, work_dir):
+    tile_czi.CziFile = SyntheticCzi
+    results = []
+    slide_data = {}
+    for size in slide_sizes:
+        print_colored("cyan", f"Preparing a {size}x{size} synthetic slide")
+        slide_data[size] = prepare_slide_data(work_dir, size, options['tile_size'], options['workers'])
+
+    for case in cases:
+        if BENCHMARK_CASES[case]['data'] == 'slide':
+            runs = [({'slide_size': size}, slide_data[size]) for size in slide_sizes]
+        else:
+            runs = [({'cells': ncells}, prepare_cell_data(work_dir, ncells, slide_data[slide_sizes[0]])) for ncells in cell_counts]
+
+        for sizes, data in runs:
+            name = f"{case} " + ", ".join(f"{key} {value}" for key, value in sizes.items())
+            if DEBUG: print(f"DEBUG: Running {name}")
+            result = {'case': case, 'name': name, **sizes, **run_case_in_process(case, data, options)}
+            print_colored("green", f"{name}: best {result['best_seconds']:.3f}s of {options['repeats']}, "
+                                   f"peak memory {result['peak_rss_mb']:.0f} MB (started at {result['baseline_rss_mb']:.0f} MB)")
+            results.append(result)
+
+    #The slide metadata and intensity stats of the synthetic slides are in final_data/, not in the work dir
+    for size in slide_sizes:
+        slide_name = slide_data[size]['slide']['name']
+        for path in [get_slide_metadata_path(slide_name), get_intensity_stats_path(slide_name), get_intensity_histograms_path(slide_name)]:
+            path.unlink(missing_ok=True)
+    return results
+
+def split_list(values, convert=str):
+    return [convert(value) for value in values.replace(" ", "").split(',') if value]
+
+if __name__ == "__main__":
+    benchmark_parser.add_argument("--cases", dest='cases', action="store", type=split_list, default=list(BENCHMARK_CASES),
+                        help=f"Comma separated cases to run (Default is {','.join(BENCHMARK_CASES)})")
+    benchmark_parser.add_argument("--slide-sizes", dest='slide_sizes', action="store", type=lambda sizes: split_list(sizes, int),
+                        default=DEFAULT_SLIDE_SIZES, help=f"Comma separated sizes of the synthetic slides (Default is {DEFAULT_SLIDE_SIZES})")
+    benchmark_parser.add_argument("--cell-counts", dest='cell_counts', action="store", type=lambda counts: split_list(counts, int),
+                        default=DEFAULT_CELL_COUNTS, help=f"Comma separated cells of the synthetic cell tables (Default is {DEFAULT_CELL_COUNTS})")
+    benchmark_parser.add_argument("--repeats", dest='repeats', action="store", type=int, default=DEFAULT_REPEATS,
+                        help=f"Number of times every case is timed (Default is {DEFAULT_REPEATS})")
+    benchmark_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=1,
+                        help="Number of processes used by tiling, quantification and the overlay (Default is 1)")
+    benchmark_parser.add_argument("--stream", "-s", dest='stream', action="store_true",
+                        help="Tile with --stream")
+    benchmark_parser.add_argument("--tile-size", dest='tile_size', action="store",
+                        type=lambda tile_size: tile_size if tile_size == tile_czi.AUTO_TILE_SIZE else int(tile_size),
+                        default=tile_czi.DEFAULT_TILE_SIZE, help=f"Tile size of the synthetic slides (Default is {tile_czi.DEFAULT_TILE_SIZE})")
+    benchmark_parser.add_argument("--work-dir", dest='work_dir', action="store", type=Path, default=None,
+                        help="Where the synthetic data is written (Default is a temporary directory)")
+    benchmark_parser.add_argument("--output", "-o", dest='output', action="store", type=Path, default=None,
+                        help="Json file the results are written to (Default is benchmark_results/benchmark-{date}.json)")
+    benchmark_parser.add_argument("--compare", dest='compare', action="store", type=Path, default=None,
+                        help="Json file of an earlier run to compare the results to")
+    benchmark_parser.add_argument("--keep", dest='keep', action="store_true",
+                        help="Keep the synthetic data in --work-dir after the run")
+
+    benchmark_parser_args = benchmark_parser.parse_args()
+
+    if benchmark_parser_args.debug:
+        DEBUG = True
+    enable_profiling(benchmark_parser_args)
+
+    unknown_cases = set(benchmark_parser_args.cases) - set(BENCHMARK_CASES)
+    if unknown_cases:
+        benchmark_parser.error(f"Unknown cases {sorted(unknown_cases)}. Choose from {list(BENCHMARK_CASES)}")
+
+    options = {
+        'repeats': benchmark_parser_args.repeats,
+        'workers': benchmark_parser_args.workers,
+        'stream': benchmark_parser_args.stream,
+        'tile_size': benchmark_parser_args.tile_size,
+    }
+    work_dir = benchmark_parser_args.work_dir or Path(tempfile.mkdtemp(prefix='segmentation_benchmark_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    output_path = benchmark_parser_args.output or Path("benchmark_results", f"benchmark-{dt.now().strftime('%Y%m%d-%H%M%S')}.json")
+
+    try:
+        results = run_benchmarks(benchmark_parser_args.cases, benchmark_parser_args.slide_sizes,
+                                 benchmark_parser_args.cell_counts, options, work_dir)
+    finally:
+        if not benchmark_parser_args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'version': get_version(),
+            'created': dt.now().isoformat(timespec='seconds'),
+            'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+            'options': {**options, 'slide_sizes': benchmark_parser_args.slide_sizes,
+                        'cell_counts': benchmark_parser_args.cell_counts},
+            'results': results,
+        }, output_file, indent=2, default=str)
+    print_colored("green", f"Wrote {output_path}")
+
+    if benchmark_parser_args.compare is not None:
+        compare_results(results, benchmark_parser_args.compare)
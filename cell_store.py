@@ -0,0 +1,102 @@
+import numpy as np
+
+from cell_type_rules import compile_cell_type_rules, get_cell_type_bits, get_cell_type_categorical, load_cell_type_rules
+
+#Columnar store of the cells of a slide, used for gating and cell typing with or without the viewer
+# Includes
+#   1. A CellStore class that owns the cell table as one contiguous array per marker, and keeps which markers every
+#      cell expresses as bits of a single uint64 per cell. Changing a threshold only recomputes that marker's bit and
+#      the cell types whose rule (see cell_type_rules.py) uses the marker
+
+MAX_MARKERS = 64 #One bit per marker in a uint64
+
+class CellStore:
+    def __init__(self, table, markers, thresholds=None, cell_type_rules=None):
+        markers = [marker for marker in markers if marker in table.columns]
+        assert len(markers) <= MAX_MARKERS, f"At most {MAX_MARKERS} markers can be gated at once"
+
+        self.table = table.reset_index(drop=True)
+        self.markers = markers
+        self.marker_bits = {marker: np.uint64(1) << np.uint64(index) for index, marker in enumerate(markers)}
+        self.intensities = {marker: np.ascontiguousarray(self.table[marker].to_numpy(dtype=np.float64)) for marker in markers}
+        self.thresholds = {marker: 0.0 for marker in markers}
+        if thresholds:
+            self.thresholds.update({marker: value for marker, value in thresholds.items() if marker in self.thresholds})
+
+        self.expressed_bits = np.zeros(len(self.table), dtype=np.uint64)
+        for marker in markers:
+            self._update_expressed(marker)
+
+        #Positive and negative marker masks of every cell type, and one bit per cell type for every cell
+        self.cell_type_rules = compile_cell_type_rules(cell_type_rules if cell_type_rules is not None else load_cell_type_rules(),
+                                                       self.marker_bits)
+        self.cell_types = self.cell_type_rules['names']
+        self.cell_type_bits = get_cell_type_bits(self.expressed_bits, self.cell_type_rules)
+
+    def __len__(self):
+        return len(self.table)
+
+    def _update_expressed(self, marker):
+        bit = self.marker_bits[marker]
+        self.expressed_bits &= ~bit
+        self.expressed_bits |= (self.intensities[marker] > self.thresholds[marker]).astype(np.uint64) * bit
+
+    def centroids(self):
+        return np.stack((self.table['centroid-0'].to_numpy(), self.table['centroid-1'].to_numpy()), axis=1)
+
+    #Which cells express the marker, or only which of the cells at rows do
+    def expressed(self, marker, rows=None):
+        expressed_bits = self.expressed_bits if rows is None else self.expressed_bits[rows]
+        return (expressed_bits & self.marker_bits[marker]) != 0
+
+    #Sets the threshold of one marker and returns which cells express it. Only the cell types that use the marker
+    #are recomputed
+    def set_threshold(self, marker, value):
+        self.thresholds[marker] = value
+        self._update_expressed(marker)
+        self.classify(changed_marker=marker)
+        return self.expressed(marker)
+
+    #Recomputes the cell type bits. With changed_marker only the cell types whose rule uses it are recomputed
+    def classify(self, changed_marker=None):
+        changed_mask = self.marker_bits[changed_marker] if changed_marker is not None else None
+        get_cell_type_bits(self.expressed_bits, self.cell_type_rules, self.cell_type_bits, changed_mask)
+
+    #Which cells (or which of the cells at rows) are only of the given cell type
+    def is_cell_type(self, name, rows=None):
+        cell_type_bits = self.cell_type_bits if rows is None else self.cell_type_bits[rows]
+        return cell_type_bits == np.uint64(1) << np.uint64(self.cell_types.index(name))
+
+    #Categorical cell type of every cell, or only of the cells at rows: 'other' if it matches no cell type and
+    #'assigned_twice' if it matches more than one
+    def get_cell_types(self, rows=None):
+        cell_type_bits = self.cell_type_bits if rows is None else self.cell_type_bits[rows]
+        return get_cell_type_categorical(cell_type_bits, self.cell_type_rules)
+
+    #Properties handed to a napari layer: the cell table with the expressed columns and cell types added. With rows
+    #only the properties of those cells, for a layer that only has the cells in view
+    def layer_properties(self, rows=None):
+        selected = slice(None) if rows is None else rows
+        properties = {column: self.table[column].to_numpy()[selected] for column in self.table.columns}
+        for marker in self.markers:
+            properties[marker + "_expressed"] = self.expressed(marker, rows).astype(np.uint8)
+        properties['cell_type'] = self.get_cell_types(rows)
+        return properties
+
+    #Properties of a single cell, like layer_properties of one row, without touching the other cells
+    def cell_properties(self, row):
+        properties = self.table.iloc[row].to_dict()
+        for marker in self.markers:
+            properties[marker + "_expressed"] = int(self.expressed_bits[row] & self.marker_bits[marker] != 0)
+        properties['cell_type'] = self.get_cell_types(np.array([row]))[0]
+        return properties
+
+    #The gated cell table as a DataFrame, for saving. table can be the full cell table, with the same rows as the
+    #table the store was made from but more columns
+    def to_frame(self, table=None):
+        data = self.table.copy() if table is None else table.reset_index(drop=True)
+        assert len(data) == len(self), "The table does not have the cells of the store"
+        for marker in self.markers:
+            data[marker + "_expressed"] = self.expressed(marker).astype(np.int8)
+        data['cell_type'] = self.get_cell_types()
+        return data
@@ -0,0 +1,163 @@
+from pathlib import Path
+
+import pandas as pd
+
+from segmentation_utils import profile_span, add_profiled_bytes
+
+#Reading and writing cell tables in a columnar binary format (parquet or feather) or as csv
+# Includes
+#   1. read_cell_table to read a cell table, optionally only some of its columns
+#   2. iter_cell_table to read a cell table a number of rows at a time
+#   3. A CellTableWriter class to write a cell table a number of rows at a time
+#   4. write_cell_table and get_cell_table_path to write a whole table and find the table of a given name in any format
+#
+# Parquet and feather keep the column types, are compressed and only decode the columns that are asked for, which is
+# much faster than parsing a csv. The format is picked from the file suffix. csv is kept as an export format
+
+CELL_TABLE_FORMATS = {'parquet': '.parquet', 'feather': '.feather', 'csv': '.csv'}
+DEFAULT_CELL_TABLE_FORMAT = 'parquet'
+DEFAULT_CELL_TABLE_COMPRESSION = 'zstd'
+
+def get_cell_table_format(cell_table_path):
+    suffix = Path(cell_table_path).suffix.lower()
+    for cell_table_format, format_suffix in CELL_TABLE_FORMATS.items():
+        if suffix == format_suffix:
+            return cell_table_format
+    raise ValueError(f"{cell_table_path} is not a cell table. Expected one of {list(CELL_TABLE_FORMATS.values())}")
+
+#Path of the cell table named name in directory, in the given format. Without a format, the first existing file of
+#any format is returned (parquet, then feather, then csv), or the parquet path if there is none
+def get_cell_table_path(directory, name, cell_table_format=None):
+    if cell_table_format is not None:
+        return Path(directory, name + CELL_TABLE_FORMATS[cell_table_format])
+    for format_suffix in CELL_TABLE_FORMATS.values():
+        if Path(directory, name + format_suffix).exists():
+            return Path(directory, name + format_suffix)
+    return Path(directory, name + CELL_TABLE_FORMATS[DEFAULT_CELL_TABLE_FORMAT])
+
+#Columns of a cell table, read from its schema (or csv header) without reading any rows
+def get_cell_table_columns(cell_table_path):
+    cell_table_format = get_cell_table_format(cell_table_path)
+    if cell_table_format == 'csv':
+        return list(pd.read_csv(cell_table_path, nrows=0).columns)
+
+    #pyarrow is only needed for the binary formats
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if cell_table_format == 'parquet':
+        return list(pq.read_schema(cell_table_path).names)
+    with pa.memory_map(str(cell_table_path)) as source:
+        return list(pa.ipc.open_file(source).schema.names)
+
+#Reads a cell table. With columns only those of them that are in the table are read (and decoded, for the binary
+#formats), in the order they are given
+def read_cell_table(cell_table_path, columns=None):
+    with profile_span("read cell table", path=Path(cell_table_path).name):
+        add_profiled_bytes(read=Path(cell_table_path).stat().st_size)
+        cell_table_format = get_cell_table_format(cell_table_path)
+        if columns is not None:
+            available_columns = set(get_cell_table_columns(cell_table_path))
+            columns = [column for column in columns if column in available_columns]
+
+        if cell_table_format == 'parquet':
+            return pd.read_parquet(cell_table_path, columns=columns)
+        if cell_table_format == 'feather':
+            return pd.read_feather(cell_table_path, columns=columns)
+        table = pd.read_csv(cell_table_path, usecols=columns)
+        return table[columns] if columns is not None else table
+
+#Reads a cell table chunksize rows at a time. The index of the chunks continues from one chunk to the next, like the
+#index of the whole table would
+def iter_cell_table(cell_table_path, chunksize, columns=None):
+    cell_table_format = get_cell_table_format(cell_table_path)
+    if cell_table_format == 'csv':
+        yield from pd.read_csv(cell_table_path, chunksize=chunksize, usecols=columns)
+        return
+
+    for start, batch in enumerate_batches(cell_table_path, cell_table_format, chunksize, columns):
+        chunk = batch.to_pandas()
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        yield chunk
+
+#Arrow record batches of at most chunksize rows of a parquet or feather cell table, with the row they start at
+def enumerate_batches(cell_table_path, cell_table_format, chunksize, columns=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    start = 0
+    if cell_table_format == 'parquet':
+        for batch in pq.ParquetFile(cell_table_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield start, batch
+            start += batch.num_rows
+        return
+
+    with pa.memory_map(str(cell_table_path)) as source:
+        reader = pa.ipc.open_file(source)
+        for batch_index in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_index)
+            if columns is not None:
+                batch = batch.select(columns)
+            for offset in range(0, batch.num_rows, chunksize):
+                yield start, batch.slice(offset, chunksize)
+                start += min(chunksize, batch.num_rows - offset)
+
+class CellTableWriter:
+    #Writes a cell table one chunk at a time. Every chunk must have the columns of the first one, they are cast to
+    #its types. csv chunks are appended with the index (like the stitched tables always were), the binary formats
+    #store no index
+    def __init__(self, cell_table_path, compression=DEFAULT_CELL_TABLE_COMPRESSION, index=True):
+        self.path = Path(cell_table_path)
+        self.format = get_cell_table_format(cell_table_path)
+        self.compression = compression
+        self.index = index
+        self.rows_written = 0
+        self._schema = None
+        self._writer = None
+        self._sink = None
+
+    def write(self, chunk):
+        if self.format == 'csv':
+            chunk.to_csv(self.path, mode='w' if self.rows_written == 0 else 'a', header=(self.rows_written == 0),
+                         index=self.index)
+            self.rows_written += len(chunk)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self._writer is None:
+            self._schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+            if self.format == 'parquet':
+                self._writer = pq.ParquetWriter(str(self.path), self._schema, compression=self.compression)
+            else:
+                self._sink = pa.OSFile(str(self.path), 'wb')
+                self._writer = pa.ipc.new_file(self._sink, self._schema,
+                                               options=pa.ipc.IpcWriteOptions(compression=self.compression))
+        self._writer.write_table(pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False))
+        self.rows_written += len(chunk)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+        if self.path.exists():
+            add_profiled_bytes(written=self.path.stat().st_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+#Writes a whole cell table. index is only used for csv
+def write_cell_table(table, cell_table_path, compression=DEFAULT_CELL_TABLE_COMPRESSION, index=True):
+    with profile_span("write cell table", path=Path(cell_table_path).name, cells=len(table)):
+        cell_table_format = get_cell_table_format(cell_table_path)
+        if cell_table_format == 'csv':
+            table.to_csv(cell_table_path, index=index)
+        elif cell_table_format == 'parquet':
+            table.to_parquet(cell_table_path, compression=compression, index=False)
+        else:
+            table.reset_index(drop=True).to_feather(cell_table_path, compression=compression)
+        add_profiled_bytes(written=Path(cell_table_path).stat().st_size)
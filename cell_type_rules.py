@@ -0,0 +1,111 @@
+from pathlib import Path
+
+import json
+import re
+import numpy as np
+import os
+import pandas as pd
+
+#Cell type rule engine, used by the viewer and headless gating alike through cell_store.CellStore
+# Includes
+#   1. A load_cell_type_rules function to read the cell type rules from a json config (Default is cell_type_rules.json).
+#      Each cell type lists the markers it must express (positive) and must not express (negative):
+#           {"cd4_t_cell": {"positive": ["DAPI", "CD4", "CD3"], "negative": ["CD8", "XCR1"]}, ...}
+#   2. A compile_cell_type_rules function that turns the rules into a positive and a negative bitmask per cell type,
+#      over the bits of the markers each cell expresses
+#   3. Functions to classify cells with those bitmasks into categorical codes:
+#      0 is 'other' (no cell type), 1 + i is cell type i and the last code is 'assigned_twice' (more than one)
+#   4. A load_thresholds function to read the marker thresholds saved by the viewer ({slide}_thresholds.txt) or a
+#      json of {marker: threshold}
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_CELL_TYPE_RULES_PATH = Path(CURRENT_DIR, 'cell_type_rules.json')
+
+#Line the viewer appends to {slide}_thresholds.txt for every marker on save. Ex: 2022-05-04 13:12: CD4 gate set to 1.5
+THRESHOLD_LINE = re.compile(r'^.*: (?P<marker>\S+) gate set to (?P<threshold>\S+)$')
+
+OTHER_CELL_TYPE = 'other'
+ASSIGNED_TWICE_CELL_TYPE = 'assigned_twice'
+
+def load_cell_type_rules(rules_path=None):
+    #Cell type rules in the order of the config file
+    with open(rules_path or DEFAULT_CELL_TYPE_RULES_PATH) as rules_file:
+        rules = json.load(rules_file)
+
+    for name, rule in rules.items():
+        unknown_keys = set(rule) - {'positive', 'negative'}
+        if unknown_keys:
+            raise ValueError(f"Cell type {name} has unknown keys {sorted(unknown_keys)}. Only positive and negative are allowed")
+        both = set(rule.get('positive', [])) & set(rule.get('negative', []))
+        if both:
+            raise ValueError(f"Cell type {name} needs {sorted(both)} to be both positive and negative")
+        if name in (OTHER_CELL_TYPE, ASSIGNED_TWICE_CELL_TYPE):
+            raise ValueError(f"{name} is reserved and cannot be used as a cell type")
+    return rules
+
+#Bitmask of the given markers, where marker_bits maps each marker to its bit
+def get_marker_mask(markers, marker_bits):
+    mask = np.uint64(0)
+    for marker in markers:
+        if marker not in marker_bits:
+            raise KeyError(f"Cell type rule uses marker {marker} which is not in the cell table")
+        mask |= marker_bits[marker]
+    return mask
+
+#Positive and negative bitmasks of every cell type, plus the markers each rule depends on
+def compile_cell_type_rules(rules, marker_bits):
+    names = list(rules)
+    positive = np.array([get_marker_mask(rules[name].get('positive', []), marker_bits) for name in names], dtype=np.uint64)
+    negative = np.array([get_marker_mask(rules[name].get('negative', []), marker_bits) for name in names], dtype=np.uint64)
+    return {'names': names, 'positive': positive, 'negative': negative, 'used': positive | negative}
+
+#Which cells are of cell type index, from the packed expressed bits of every cell
+def match_cell_type(expressed_bits, compiled_rules, index):
+    positive = compiled_rules['positive'][index]
+    negative = compiled_rules['negative'][index]
+    return ((expressed_bits & positive) == positive) & ((expressed_bits & negative) == 0)
+
+#One bit per cell type for every cell. With cell_type_bits and changed_mask given, only the cell types whose rule uses
+#one of the changed markers are recomputed in place
+def get_cell_type_bits(expressed_bits, compiled_rules, cell_type_bits=None, changed_mask=None):
+    if cell_type_bits is None:
+        cell_type_bits = np.zeros(len(expressed_bits), dtype=np.uint64)
+    for index in range(len(compiled_rules['names'])):
+        if changed_mask is not None and not compiled_rules['used'][index] & changed_mask:
+            continue
+        bit = np.uint64(1) << np.uint64(index)
+        cell_type_bits &= ~bit
+        cell_type_bits |= match_cell_type(expressed_bits, compiled_rules, index).astype(np.uint64) * bit
+    return cell_type_bits
+
+def get_cell_type_categories(compiled_rules):
+    return [OTHER_CELL_TYPE] + compiled_rules['names'] + [ASSIGNED_TWICE_CELL_TYPE]
+
+#Categorical code of every cell from its cell type bits
+def get_cell_type_codes(cell_type_bits, compiled_rules):
+    codes = np.zeros(len(cell_type_bits), dtype=np.int16)
+    for index in range(len(compiled_rules['names'])):
+        codes[cell_type_bits == np.uint64(1) << np.uint64(index)] = index + 1
+    codes[(cell_type_bits & (cell_type_bits - np.uint64(1))) != 0] = len(compiled_rules['names']) + 1 #More than one bit set
+    return codes
+
+def get_cell_type_categorical(cell_type_bits, compiled_rules):
+    return pd.Categorical.from_codes(get_cell_type_codes(cell_type_bits, compiled_rules),
+                                     categories=get_cell_type_categories(compiled_rules))
+
+#Thresholds of every marker. The viewer appends the thresholds on every save, so the last one of each marker is used
+def load_thresholds(thresholds_path):
+    if Path(thresholds_path).suffix.lower() == '.json':
+        with open(thresholds_path) as thresholds_file:
+            return {marker: float(threshold) for marker, threshold in json.load(thresholds_file).items()}
+
+    thresholds = {}
+    with open(thresholds_path) as thresholds_file:
+        for line_number, line in enumerate(thresholds_file, 1):
+            if not line.strip():
+                continue
+            match = THRESHOLD_LINE.match(line.strip())
+            if match is None:
+                raise ValueError(f"Line {line_number} of {thresholds_path} is not a saved threshold: {line.strip()}")
+            thresholds[match['marker']] = float(match['threshold'])
+    return thresholds
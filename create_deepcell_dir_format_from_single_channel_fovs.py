@@ -5,7 +5,8 @@
 #Filename: create_deepcell_dir_format_from_single_channel_fovs.py
 
 # GOAL: Take input fom tile_czi.py to format tiffs for deepcell segmentation. It is done in place, so the same
-#directory is used for deepcell
+#directory is used for deepcell. tile_czi.py now writes this layout directly, so this is only needed for directories
+#tiled by older versions (and for -t, to move the directory to ark-analysis)
 
 # INPUT: Path to directory containing single channel images. This is the output from tile_czi (output of tile_czi.py above)
 
@@ -26,8 +27,10 @@
 #               TIFs/
 #                   channel0.tiff
 #                   channel1.tiff
+#   empty_fovs/
+#       fov2/          (tiles marked empty in tile_metadata.txt are moved here so later steps skip them)
 
-# usage: tile_czi.py [-h] [--debug] [--channel] files [files ...]
+# usage: tile_czi.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--channel] files [files ...]
 #
 # positional arguments:
 #   files          Input 1 or more CZI File Paths to Tile
@@ -36,6 +39,9 @@
 # optional arguments:
 #   -h, --help     show this help message and exit
 #   --debug, -d    Prints out information when tiling the czi. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
 
 #################################################################################################################
 from pathlib import Path
@@ -45,23 +51,10 @@ import pathlib
 import re
 import shutil
 
-from segmentation_utils import print_colored, cell_segment_parser
+from segmentation_utils import print_colored, cell_segment_parser, load_tile_metadata, profile_span, enable_profiling
 
 DEBUG = False
 
-cell_segment_parser.add_argument("--ark_target", "-t",
-                    dest='ark_target',
-                    action="store",
-                    nargs='?', #Show it is optional
-                    type=pathlib.Path,
-                    help="Specify where the output of script should go to. Should be ark_analysis/data");
-
-cell_segment_parser_args = cell_segment_parser.parse_args()
-
-if cell_segment_parser_args.debug:
-    DEBUG = True
-
-
 def isempty(dir_path):
     # Checks a directory to see if it contains any files
 
@@ -77,35 +70,47 @@ def create_dir(dir_path):
         if not isempty(dir_path):
             print_colored("red", f'Directory {dir_path.name} exists and is not empty. Not creating')
 
-def format_directory(directory_of_formatted_fovs):
-    for formatted_dir in directory_of_formatted_fovs:
-        fov_dirs = []
-        for fov in Path(formatted_dir).iterdir(): #Loop thru each fov dir
-            if fov.is_dir() and re.match("fov\d+", fov.name): #if it is a dir and it is the fov# format, then add it to
-                fov_dirs.append(fov)
-
-        # Create required directory structure for DeepCell
-        deepcell_output_dir = Path(formatted_dir, "deepcell_output")
-        create_dir(deepcell_output_dir)
-        if DEBUG: print(f"DEBUG: Created {deepcell_output_dir}")
-
-        input_dir = Path(formatted_dir, "input_data")
-        create_dir(input_dir)
-        if DEBUG: print(f"DEBUG: Created {input_dir}")
-
-        single_tiff_dir = Path(input_dir, "single_channel_inputs")
-        create_dir(single_tiff_dir)
-        if DEBUG: print(f"DEBUG: Created {single_tiff_dir}")
-
-        mibitiff_dir = Path(input_dir, "mibitiff_inputs")
-        create_dir(mibitiff_dir)
-        if DEBUG: print(f"DEBUG: Created {mibitiff_dir}")
+#Moves the fov directories written by older versions of tile_czi.py into single_channel_inputs/fovN/TIFs
+def rearrange_directory(formatted_dir, fov_dirs):
+    #Tiles tile_czi.py found to be background or padding. They never go into single_channel_inputs
+    empty_fovs = set()
+    tile_metadata_path = Path(formatted_dir, "tile_metadata.txt")
+    if tile_metadata_path.exists():
+        empty_fovs = {tile['fov'] for tile in load_tile_metadata(tile_metadata_path) if tile['empty']}
+
+    # Create required directory structure for DeepCell
+    deepcell_output_dir = Path(formatted_dir, "deepcell_output")
+    create_dir(deepcell_output_dir)
+    if DEBUG: print(f"DEBUG: Created {deepcell_output_dir}")
+
+    input_dir = Path(formatted_dir, "input_data")
+    create_dir(input_dir)
+    if DEBUG: print(f"DEBUG: Created {input_dir}")
+
+    single_tiff_dir = Path(input_dir, "single_channel_inputs")
+    create_dir(single_tiff_dir)
+    if DEBUG: print(f"DEBUG: Created {single_tiff_dir}")
+
+    mibitiff_dir = Path(input_dir, "mibitiff_inputs")
+    create_dir(mibitiff_dir)
+    if DEBUG: print(f"DEBUG: Created {mibitiff_dir}")
+
+    deepcell_input_dir = Path(input_dir, "deepcell_input")
+    create_dir(deepcell_input_dir)
+    if DEBUG: print(f"DEBUG: Created {deepcell_input_dir}")
+
+    if empty_fovs:
+        empty_fovs_dir = Path(formatted_dir, "empty_fovs")
+        create_dir(empty_fovs_dir)
+        if DEBUG: print(f"DEBUG: Created {empty_fovs_dir}")
+
+    for fov_dir in fov_dirs:
+        with profile_span("move fov", fov=fov_dir.name):
+            if fov_dir.name in empty_fovs:
+                print_colored("yellow", f"Skipping empty tile {fov_dir}")
+                shutil.move(str(fov_dir), str(Path(empty_fovs_dir, fov_dir.name)))
+                continue
 
-        deepcell_input_dir = Path(input_dir, "deepcell_input")
-        create_dir(deepcell_input_dir)
-        if DEBUG: print(f"DEBUG: Created {deepcell_input_dir}")
-
-        for fov_dir in fov_dirs:
             print_colored("cyan", f"Rearranging directory {fov_dir}")
             fov_tiff_dir = Path(single_tiff_dir, fov_dir.name)
             create_dir(fov_tiff_dir)
@@ -127,23 +132,47 @@ def format_directory(directory_of_formatted_fovs):
             if DEBUG: print(f"DEBUG: Removing directory {fov_dir}")
             os.rmdir(fov_dir)
 
+def format_directory(directory_of_formatted_fovs, ark_target=None):
+    for formatted_dir in directory_of_formatted_fovs:
+        fov_dirs = []
+        for fov in Path(formatted_dir).iterdir(): #Loop thru each fov dir
+            if fov.is_dir() and re.match("fov\d+", fov.name): #if it is a dir and it is the fov# format, then add it to
+                fov_dirs.append(fov)
+
+        #tile_czi.py writes the deepcell layout itself now. Only directories tiled before that need rearranging
+        if not fov_dirs and Path(formatted_dir, "input_data", "single_channel_inputs").is_dir():
+            print_colored("cyan", f"{formatted_dir} is already in the deepcell layout")
+        else:
+            with profile_span("rearrange directory", directory=str(formatted_dir), fovs=len(fov_dirs)):
+                rearrange_directory(formatted_dir, fov_dirs)
+
         #Handling the -t target file path if specified with argparse
-        if(cell_segment_parser_args.ark_target != None):
-            if(os.path.exists(cell_segment_parser_args.ark_target)):
-                shutil.move(str(formatted_dir), str(cell_segment_parser_args.ark_target))
-                print_colored("green", f"Moved {formatted_dir} to {str(cell_segment_parser_args.ark_target)}")
+        if(ark_target != None):
+            if(os.path.exists(ark_target)):
+                shutil.move(str(formatted_dir), str(ark_target))
+                print_colored("green", f"Moved {formatted_dir} to {str(ark_target)}")
             else:
-                print_colored("red", f"{cell_segment_parser_args.ark_target} is not a valid path! Output will go to current directory")
+                print_colored("red", f"{ark_target} is not a valid path! Output will go to current directory")
                 print_colored("green", f"Run:\n mv -v {formatted_dir}\n to wherever ark-analysis/data file location is")
         else:
             print_colored("green", f"Run:\n mv -v {formatted_dir}\n to wherever ark-analysis/data file location is")
 
-input_files = cell_segment_parser_args.files
+if __name__ == "__main__":
+    cell_segment_parser.add_argument("--ark_target", "-t",
+                        dest='ark_target',
+                        action="store",
+                        nargs='?', #Show it is optional
+                        type=pathlib.Path,
+                        help="Specify where the output of script should go to. Should be ark_analysis/data");
 
-directory_of_formatted_fovs_to_rearrange = [Path(input_path) for input_path in input_files]
+    cell_segment_parser_args = cell_segment_parser.parse_args()
 
-if __name__ == "__main__":
-    format_directory(directory_of_formatted_fovs_to_rearrange)
+    if cell_segment_parser_args.debug:
+        DEBUG = True
+    enable_profiling(cell_segment_parser_args)
+
+    directory_of_formatted_fovs_to_rearrange = [Path(input_path) for input_path in cell_segment_parser_args.files]
+    format_directory(directory_of_formatted_fovs_to_rearrange, cell_segment_parser_args.ark_target)
 
 #Can run: mv  -v cell_to_segment_dir LOCATION_OF_ARK_ANALYSIS/DATA
 # to move folder and all contents to deepcell location
\ No newline at end of file
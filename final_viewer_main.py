@@ -14,34 +14,58 @@
 # optional arguments:
 #   -h, --help            show this help message and exit
 #   --debug, -d           Print additional information to the terminal when running script
+#   --profile             Print how long loading layers and threshold updates took, the bytes read and the peak memory
+#   --trace-out TRACE_OUT
+#                         Also write the timeline as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
 #   --points POINTS, -p POINTS
 #                         Specify a single file with points label to preload in
 #   --image IMAGE, -i IMAGE
 #                         Specify a single czi image file to preload in
 #   --bounds BOUNDS, -b BOUNDS
-#                         Specify a single file with segementation boundaries to load in
+#                         Specify a single segmentation label store (segmentation_labels-*.zarr) to load the cell
+#                         borders of. Older segmentation_borders_current-*.npy files load too
+#   --channel, -c         View, Select, and Add Channels!
+#   --cache-mb CACHE_MB   Memory in MB kept for decoded image chunks. Images are read lazily, one chunk of the
+#                         visible region and zoom level at a time
+#   --cell-types CELL_TYPES
+#                         Json file with the cell type rules (Default is cell_type_rules.json)
+#   --save-format {parquet,feather,csv}
+#                         Format of the gated cell table written on save (Default is parquet)
+#   --load-threads LOAD_THREADS
+#                         Channels of an image read at the same time. Images, cell data and boundaries are loaded in
+#                         the background, so the window stays responsive (Default is one per channel, up to the number of cpus)
+#   --max-points MAX_POINTS
+#                         Most cells drawn as points. Only the cells in view are drawn, and zoomed out past this
+#                         many a cell density image is drawn instead (Default is 50000)
 
 #################################################################################################################
 #TODO: Add DEBUG information
 #TODO: Fix Same File Load Bug
 
-from PIL import Image
-from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime as dt
 from magicgui import magicgui
+from napari.qt.threading import thread_worker
 from napari_properties_plotter import PropertyPlotter as propplot
+from qtpy.QtCore import QTimer
 from random import randrange
 
-import aicspylibczi
-import json
 import napari
 import numpy as np
 import os
 import pandas as pd
 import pathlib
+import time
 import traceback
 import warnings
-from segmentation_utils import print_colored, napari_viewer_parser
+from cell_store import CellStore
+from cell_table_io import CELL_TABLE_FORMATS, DEFAULT_CELL_TABLE_FORMAT, read_cell_table, write_cell_table
+from cell_type_rules import load_cell_type_rules
+from multiscale_utils import ChunkCache, DEFAULT_CACHE_MB, find_pyramid, get_pyramid_channels, lazy_czi_pyramid, lazy_zarr_pyramid, stitch_boundaries
+from intensity_stats import get_arcsinh_max, load_intensity_stats
+from label_store import CellIdIndex, get_cell_id_offsets, get_cell_ids, lazy_border_pyramid, lazy_cell_id_pyramid, open_label_store
+from spatial_index import CellGridIndex
+from segmentation_utils import print_colored, napari_viewer_parser, get_peak_rss_mb, load_slide_metadata, profile_span, enable_profiling
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -56,16 +80,64 @@ DEFAULT_CHANNELS_TO_USE = 1
 
 channel_names = all_channels[DEFAULT_CHANNELS_TO_USE]
 
-cell_type_col = False
+#Columns of the cell table the viewer needs besides the markers. Only these are read when the points are loaded
+CELL_TABLE_COLUMNS = ['fov', 'label', 'cell_size', 'centroid-0', 'centroid-1']
+
+DEFAULT_CONTRAST_LIMITS = [0, 2**16]
+CONTRAST_PERCENTILE = '99.9' #Upper contrast limit of a channel, a percentile of the intensity stats of tiling
+DEFAULT_SLIDER_MAX = 20
+
+#Layers of the cells. The points layers only have the cells in view, zoomed out the density layer is drawn instead
+POINTS_LAYERS = ['points', 'cell type results']
+DENSITY_LAYER = 'cell density'
+ROI_LAYER = 'ROI'
+BOUNDARIES_LAYER = 'cell borders'
+CELL_IDS_LAYER = 'picked cell' #Slide wide cell ids of the label store, only the picked cell is drawn
+
+DEFAULT_MAX_POINTS = 50000
+VIEW_MARGIN = 0.25 #Fraction of the view added on every side of it, so small pans do not show missing points
+CULL_DELAY_MS = 100 #The cells in view are looked up this long after the camera stops moving
+ELLIPSE_VERTICES = 64 #Vertices of the polygon ellipse ROIs are turned into
+
+cell_store = None #CellStore of the loaded cell data
+cell_index = None #CellGridIndex of the centroids of the loaded cell data
+visible_cells = np.empty(0, dtype=np.int64) #Rows of the cell store in the points layers
+shown_marker = None #Marker whose positive cells the points layer shows, the last one thresholded
+zoomed_out = False #Whether the density is drawn instead of the points
+points_layers_visible = {} #Visibility of the points layers before zooming out, restored when zooming back in
+loaders = {} #Running background load of every kind, see start_loader
+cell_id_levels = None #Lazy multiscale slide wide cell ids of the loaded label store
+cell_id_offsets = None #Offset of the cell ids of every fov of the loaded label store
+cell_id_count = None #Largest cell id of the loaded label store
+cell_id_index = None #CellIdIndex from the cell ids to the rows of the cell store
 
 #Using argument parser to organize the input
 napari_viewer_parser.add_argument("--channel", "-c", dest='channel', action="store_true",
                     help="View, Select, and Add Channels!")
 
+napari_viewer_parser.add_argument("--cache-mb", dest='cache_mb', action="store", type=float, default=DEFAULT_CACHE_MB,
+                    help=f"Memory in MB kept for decoded image chunks (Default is {DEFAULT_CACHE_MB})")
+
+napari_viewer_parser.add_argument("--cell-types", dest='cell_types', action="store", type=pathlib.Path, default=None,
+                    help="Json file with the cell type rules (Default is cell_type_rules.json)")
+
+napari_viewer_parser.add_argument("--save-format", dest='save_format', action="store", choices=list(CELL_TABLE_FORMATS),
+                    default=DEFAULT_CELL_TABLE_FORMAT,
+                    help=f"Format of the gated cell table written on save (Default is {DEFAULT_CELL_TABLE_FORMAT})")
+
+napari_viewer_parser.add_argument("--load-threads", dest='load_threads', action="store", type=int,
+                    default=min(len(all_channels[DEFAULT_CHANNELS_TO_USE]), os.cpu_count() or 1),
+                    help="Channels of an image read at the same time (Default is one per channel, up to the number of cpus)")
+
+napari_viewer_parser.add_argument("--max-points", dest='max_points', action="store", type=int, default=DEFAULT_MAX_POINTS,
+                    help=f"Most cells drawn as points. Only the cells in view are drawn, and zoomed out past this many "
+                         f"a cell density image is drawn instead (Default is {DEFAULT_MAX_POINTS})")
+
 napari_viewer_parser_args = napari_viewer_parser.parse_args()
 
 if napari_viewer_parser_args.debug:
     DEBUG = True
+enable_profiling(napari_viewer_parser_args)
 
 #Gets proper channels from above for tiling
 def get_channel_choice(len_of_channels):
@@ -98,10 +170,20 @@ if napari_viewer_parser_args.channel:
 
 # initialize dictionary to store thresholds for each channel
 threshold_dict = {}
+#Range of the threshold slider of each channel. Set from the intensity stats of tiling when an image is loaded
+slider_max_dict = {}
 
 for c in channel_names:
     threshold_dict[c] = 0.0
 
+#Cell types and the markers they need to be positive/negative for, shared with headless gating
+cell_type_rules = load_cell_type_rules(napari_viewer_parser_args.cell_types)
+default_cell_type = 'cd4_t_cell' if 'cd4_t_cell' in cell_type_rules else list(cell_type_rules)[0]
+
+#Decoded image chunks of every channel layer and the cell borders. Only the chunks of the visible region and level are
+#ever read
+chunk_cache = ChunkCache(napari_viewer_parser_args.cache_mb)
+
 @magicgui(
     # call_button connects to save method
     call_button="Save thresholds",
@@ -109,94 +191,267 @@ for c in channel_names:
     marker={"choices": [('DAPI', 'DAPI'), ('CD3', 'CD3'), ('CD4', 'CD4'), ('CD8', 'CD8'), ('CD163', 'CD163'),
                         ('XCR1', 'XCR1'), ('HLADR', 'HLADR'), ('PDL1', 'PDL1'), ('Tumor', 'PanCK')]},
     # cell type dropdown list
-    cell_type={"choices": ['double_neg_t_cell',
-                           'cd4_t_cell',
-                           'cd8_t_cell',
-                           'mac',
-                           'cdc1',
-                           'other_myeloid_and_b_cells',
-                           'double_pos_t_cell']},
-    threshold_slider={"widget_type": "FloatSlider", 'max': 20}
+    cell_type={"choices": list(cell_type_rules)},
+    threshold_slider={"widget_type": "FloatSlider", 'max': DEFAULT_SLIDER_MAX}
 )
 def threshold_widget(
         threshold_value: float,
         threshold_slider=0.0,
         marker='DAPI',
-        cell_type='cd4_t_cell',
+        cell_type=default_cell_type,
         czi_image_filename = pathlib.Path("<Select File>"),
         cell_data_filename = pathlib.Path("<Select File>"),
         cell_boundaries_filename=pathlib.Path("<Select File>")
 ): pass
-from aicsimageio import AICSImage
+
+#Logs how long it took until napari could draw the first frame after loading, and the memory used so far
+def log_first_frame(load_start, name):
+    print_colored("cyan", f"First frame of {name} after {time.perf_counter() - load_start:.2f}s. "
+                          f"Peak memory: {get_peak_rss_mb():.1f} MB, chunk cache: {chunk_cache.nbytes / 2**20:.1f} MB")
+
+#Starts a background load of a kind ('image', 'cells' or 'boundaries'), quitting the earlier load of that kind.
+#Results of a load that was quit or replaced are dropped, the callbacks run in the event thread
+def start_loader(kind, worker, on_yielded=None, on_returned=None):
+    if kind in loaders:
+        loaders[kind].quit()
+    loaders[kind] = worker
+
+    def is_current():
+        return loaders.get(kind) is worker
+
+    def yielded(result):
+        if is_current() and on_yielded is not None:
+            on_yielded(result)
+
+    def returned(result):
+        if is_current() and on_returned is not None:
+            on_returned(result)
+
+    def errored(error):
+        print_colored("red", f"Could not load the {kind}: {error}")
+        print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    def finished():
+        if is_current():
+            del loaders[kind]
+
+    worker.yielded.connect(yielded)
+    worker.returned.connect(returned)
+    worker.errored.connect(errored)
+    worker.finished.connect(finished)
+    worker.start()
+    return worker
+
+#Lazy pyramid of one channel, with its smallest level decoded. That level is what napari draws first when zoomed
+#out, so decoding it here keeps the first frame off the event thread
+def read_channel(czi_file_path, pyramid_path, pyramid_channels, index, channel_name):
+    with profile_span("load image layer", category='viewer', channel=channel_name):
+        if pyramid_path is not None:
+            pyramid_index = pyramid_channels.index(channel_name) if channel_name in pyramid_channels else index
+            image = lazy_zarr_pyramid(pyramid_path, pyramid_index, chunk_cache)
+        else:
+            image = lazy_czi_pyramid(czi_file_path, index, chunk_cache)
+        image[-1].compute()
+    return image
+
+#Contrast limits of every channel from the intensity stats written while tiling the slide: the lowest value and a high
+#percentile of the tissue. The whole uint16 range for slides tiled without them. The threshold slider ranges are set
+#from the same stats
+def get_contrast_limits(slide_name):
+    contrast_limits = {channel_name: DEFAULT_CONTRAST_LIMITS for channel_name in channel_names}
+    slider_max_dict.clear()
+
+    intensity_stats = load_intensity_stats(slide_name)
+    if intensity_stats is None:
+        return contrast_limits
+    print_colored("cyan", f"Using the intensity stats of {slide_name} for the contrast limits")
+    for channel_name in channel_names:
+        channel_stats = intensity_stats['channels'].get(channel_name)
+        if channel_stats is None or channel_stats['percentiles'] is None:
+            continue
+        contrast_limits[channel_name] = [channel_stats['min'], max(channel_stats['percentiles'][CONTRAST_PERCENTILE], channel_stats['min'] + 1)]
+        slider_max_dict[channel_name] = float(np.ceil(get_arcsinh_max(channel_stats)))
+    return contrast_limits
+
+def set_slider_max(marker):
+    threshold_widget.threshold_slider.max = max(slider_max_dict.get(marker, DEFAULT_SLIDER_MAX), threshold_dict.get(marker, 0.0))
+
+#Reads the channels --load-threads at a time, yielding (channel name, pyramid) as each is ready. Quitting the load
+#cancels the channels that have not started
+def read_channels(czi_file_path, pyramid_path, pyramid_channels):
+    executor = ThreadPoolExecutor(napari_viewer_parser_args.load_threads)
+    try:
+        futures = {executor.submit(read_channel, czi_file_path, pyramid_path, pyramid_channels, index, channel_name): channel_name
+                   for index, channel_name in enumerate(channel_names)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 @threshold_widget.czi_image_filename.changed.connect
 def load_new_image(value: str):
     #TODO: Make large tiff files viewable, and integrate with imagej/fiji
-    contrast_limits = []
+    load_start = time.perf_counter()
 
-    czi_file = aicspylibczi.CziFile(value)
+    #Channels are lazy multiscale arrays. A pyramid written by tile_czi.py --pyramid is used when there is one,
+    #otherwise chunks are decoded straight from the czi
+    pyramid_path = find_pyramid(value)
+    contrast_limits = get_contrast_limits(pathlib.Path(value).stem)
+    pyramid_channels = get_pyramid_channels(pyramid_path) if pyramid_path is not None else []
+    if pyramid_path is not None:
+        print_colored("cyan", f"Using pyramid {pyramid_path}")
 
     #TODO: Make optional
-    #Clears out old channel values when a new image is loaded using widget gui
-    while(len(viewer.layers) != 0):
-        viewer.layers.pop()
-    #Add each channel img to layers with associated name
-    for index, channel_name in enumerate(channel_names):
-        print_colored("cyan", f"Loading channel {index} - {channel_name}")
-        image = czi_file.read_mosaic(C=index, scale_factor=1)
-        contrast_limits.append([0, 2**16])
-        # add each channel
-        viewer.add_image(image, name=channel_name, visible=False, contrast_limits=contrast_limits[index])
+    #Clears out old channel values when a new image is loaded using widget gui. Only the channel layers go, the layers
+    #of the cell data and boundaries (points, density, ROI, borders) stay with the cell store they were made from
+    for layer in [layer for layer in viewer.layers if layer.name in channel_names]:
+        viewer.layers.remove(layer)
+    chunk_cache.clear()
+
+    #Add each channel img to layers with associated name, as soon as it is read. Channels go under the cell layers
+    def add_channel(result):
+        channel_name, image = result
+        print_colored("cyan", f"Loaded channel {channel_names.index(channel_name)} - {channel_name}")
+        viewer.add_image(image, name=channel_name, visible=False, contrast_limits=contrast_limits[channel_name], multiscale=True)
+        viewer.layers.move(viewer.layers.index(channel_name), 0)
         viewer.layers[channel_name].colormap = LUTs[randrange(len(LUTs))]
         viewer.layers[channel_name].opacity = 1.0
         viewer.layers[channel_name].blending = 'additive'
         viewer.layers[channel_name].interpolation = 'gaussian'
 
+    def channels_loaded(result):
+        QTimer.singleShot(0, lambda: log_first_frame(load_start, pathlib.Path(value).name))
+
     threshold_widget.marker.set_choice('Tumor',channel_names[-1])
+    set_slider_max(threshold_widget.marker.value)
+
+    worker = thread_worker(read_channels, progress={'total': len(channel_names), 'desc': "Loading channels"})(
+        value, pyramid_path, pyramid_channels)
+    start_loader('image', worker, on_yielded=add_channel, on_returned=channels_loaded)
+
+#Reads the cell table and builds the cell store and spatial index. Yields between the steps so the load can be quit
+def read_cell_data(cell_data_file_path):
+    #Only the centroids and the markers are read, parquet and feather tables do not even decode the other columns
+    data = read_cell_table(cell_data_file_path, columns=CELL_TABLE_COLUMNS + channel_names) #(15960, 14)
+    yield
+
+    #The store owns the cell data. The layers are views of it that only get the columns that change updated
+    with profile_span("build cell store", category='viewer', cells=len(data)):
+        store = CellStore(data, channel_names, threshold_dict, cell_type_rules)
+    yield
+
+    with profile_span("build spatial index", category='viewer', cells=len(store)):
+        index = CellGridIndex(store.centroids())
+    return store, index
 
 @threshold_widget.cell_data_filename.changed.connect
 def load_cell_data(cell_data_file_path: str):
     #TODO: Keep track of number points and output to napari
+    worker = thread_worker(read_cell_data, progress={'total': 2, 'desc': "Loading cell data"})(cell_data_file_path)
+    start_loader('cells', worker, on_returned=add_cell_data)
 
-    # clear old points data
-    if ('points' in viewer.layers):
-        del viewer.layers['points']
-
-    if ('cell type results' in viewer.layers):
-        del viewer.layers['cell type results']
-
-    data = pd.read_csv(cell_data_file_path) #(15960, 56)
-    x = np.array(data['centroid-0']) # (15960,)
-    y = np.array(data['centroid-1']) # (15960,)
-
-    # Initalized column for threshold results (data --> (15960, 64))
-    for c in channel_names:
-        data[c + "_expressed"] = np.array(data[c] > threshold_dict[c], dtype=np.int8)
-    # format data for adding as layer
-    points = np.stack((x, y)).transpose() #(15960, 2))
-
-    points_layer = viewer.add_points(points,
-        size=25,
-        properties=data,
-        face_color=threshold_widget.marker.value,
-        name='points',
-        visible=True,
-        shown=np.array([True] * len(data)),
-    )
-
-    if("cell_type" in data.columns):
-        cell_type_col = True
-        shown_data = data['cell_type'] == threshold_widget.cell_type.value
-    else:
-        shown_data = np.array([True]) * len(data)
+#Swaps in the cell data read by read_cell_data and adds its layers
+def add_cell_data(result):
+    global cell_store, cell_index, visible_cells, shown_marker, zoomed_out
 
-    cell_type_layer = viewer.add_points(points,
-        size=25,
-        properties=data,
-        name='cell type results',
-        visible=True,
-        shown=shown_data)
+    # clear old points data
+    for layer_name in POINTS_LAYERS + [DENSITY_LAYER]:
+        if layer_name in viewer.layers:
+            del viewer.layers[layer_name]
+
+    cell_store, cell_index = result
+    shown_marker = None
+    zoomed_out = False
+
+    #The layers start with the cells in view, or the first --max-points cells when there are too many to draw. napari
+    #colors the points by a property, so the layers are never left empty
+    visible_cells = get_cells_in_view()
+    if visible_cells is None:
+        visible_cells = np.arange(min(len(cell_store), napari_viewer_parser_args.max_points))
+    properties = cell_store.layer_properties(visible_cells) #Adds the threshold results (data --> (15960, 64))
+    marker = threshold_widget.marker.value
+
+    with profile_span("load points layers", category='viewer', cells=len(visible_cells)):
+        viewer.add_image(cell_index.density(), name=DENSITY_LAYER, scale=(cell_index.bin_size, cell_index.bin_size),
+            translate=cell_index.get_density_translate(), colormap='inferno', blending='additive', opacity=0.7, visible=False)
+
+        points_layer = viewer.add_points(cell_index.centroids[visible_cells],
+            size=25,
+            properties=properties,
+            face_color=marker,
+            face_contrast_limits=(float(cell_store.intensities[marker].min()), float(cell_store.intensities[marker].max()))
+                                 if marker in cell_store.intensities else None,
+            name='points',
+            visible=True,
+            shown=np.ones(len(visible_cells), dtype=bool),
+        )
+
+        cell_type_layer = viewer.add_points(cell_index.centroids[visible_cells],
+            size=25,
+            properties={'cell_type': properties['cell_type']},
+            name='cell type results',
+            visible=True,
+            shown=cell_store.is_cell_type(threshold_widget.cell_type.value, visible_cells))
+
+    if ROI_LAYER not in viewer.layers:
+        viewer.add_shapes(name=ROI_LAYER, edge_color='yellow', face_color='transparent', edge_width=10)
+
+    update_cell_id_index()
+    show_cells_in_view()
+
+#Cells in the view of the camera (with a margin), or None when there are none or more than --max-points
+def get_cells_in_view():
+    center = np.asarray(viewer.camera.center[-2:])
+    half_extent = np.asarray(viewer._canvas_size[-2:]) / viewer.camera.zoom / 2 * (1 + 2 * VIEW_MARGIN)
+    (row_min, col_min), (row_max, col_max) = center - half_extent, center + half_extent
+
+    #The bins overlapping the view give an upper bound of the cells in it without looking at any cell
+    if cell_index.count_rect(row_min, row_max, col_min, col_max) > napari_viewer_parser_args.max_points:
+        return None
+    cells = cell_index.query_rect(row_min, row_max, col_min, col_max)
+    return cells if len(cells) > 0 else None
+
+#Swaps the points layers for the density layer when zooming out, and back when zooming in
+def set_zoomed_out(value):
+    global zoomed_out, points_layers_visible
+    if value == zoomed_out:
+        return
+    zoomed_out = value
+    if zoomed_out:
+        points_layers_visible = {name: viewer.layers[name].visible for name in POINTS_LAYERS}
+    for name in POINTS_LAYERS:
+        viewer.layers[name].visible = False if zoomed_out else points_layers_visible.get(name, True)
+    viewer.layers[DENSITY_LAYER].visible = zoomed_out
+
+#Whether the cell data is loaded and its points and density layers are in the viewer. They can be deleted from the
+#layer list by hand, so every handler that updates them checks first
+def cell_layers_loaded():
+    return cell_store is not None and all(name in viewer.layers for name in POINTS_LAYERS + [DENSITY_LAYER])
+
+#Puts the cells in view in the points layers. Called when the camera stops moving
+def show_cells_in_view():
+    global visible_cells
+    if not cell_layers_loaded():
+        return
 
+    with profile_span("show cells in view", category='viewer'):
+        cells = get_cells_in_view()
+        if cells is None:
+            #The layers keep their last cells while hidden
+            set_zoomed_out(True)
+            return
+
+        if not np.array_equal(cells, visible_cells):
+            visible_cells = cells
+            properties = cell_store.layer_properties(visible_cells)
+            viewer.layers['points'].data = cell_index.centroids[visible_cells]
+            viewer.layers['points'].properties = properties
+            viewer.layers['cell type results'].data = cell_index.centroids[visible_cells]
+            viewer.layers['cell type results'].properties = {'cell_type': properties['cell_type']}
+            viewer.layers['points'].shown = (cell_store.expressed(shown_marker, visible_cells) if shown_marker is not None
+                                             else np.ones(len(visible_cells), dtype=bool))
+            viewer.layers['cell type results'].shown = cell_store.is_cell_type(threshold_widget.cell_type.value, visible_cells)
+        set_zoomed_out(False)
 
 @threshold_widget.threshold_slider.changed.connect
 def threshold_slider_change(value: float):
@@ -204,15 +459,25 @@ def threshold_slider_change(value: float):
     channel = threshold_widget.marker.value
     threshold_dict[channel] = value
 
-    data = pd.DataFrame.from_dict(viewer.layers['points'].properties)
-    thresholded_idx = data[channel] > value
+    if cell_store is None or channel not in cell_store.marker_bits:
+        return
+
+    global shown_marker
+    with profile_span("threshold update", category='viewer', marker=channel, value=value):
+        #Only the column of this marker and the cell types that use it are recomputed
+        with profile_span("recompute thresholds", category='viewer', marker=channel):
+            thresholded_idx = cell_store.set_threshold(channel, value)
+        shown_marker = channel
+        if not cell_layers_loaded():
+            return
 
-    data[channel + "_expressed"] = np.array(thresholded_idx, dtype=np.uint8)
-    viewer.layers['points'].shown = thresholded_idx
-    viewer.layers['points'].properties = data
+        #The points layers only have the cells in view, the density layer counts every positive cell
+        viewer.layers['points'].features[channel + "_expressed"] = thresholded_idx[visible_cells].astype(np.uint8)
+        viewer.layers['points'].shown = thresholded_idx[visible_cells]
+        viewer.layers[DENSITY_LAYER].data = cell_index.density(thresholded_idx)
 
-    update_cell_types()
-    cell_type_changed(threshold_widget.cell_type.value)
+        update_cell_types()
+        cell_type_changed(threshold_widget.cell_type.value)
 
 @threshold_widget.threshold_value.changed.connect
 def threshold_value_changed(value: float):
@@ -220,6 +485,7 @@ def threshold_value_changed(value: float):
 
 @threshold_widget.marker.changed.connect
 def marker_changed(value: str):
+    set_slider_max(value)
     threshold_widget.threshold_value.value = threshold_dict[value]
     threshold_widget.threshold_slider.value = threshold_dict[value]
 
@@ -235,141 +501,191 @@ def save():
 
     print("Thresholds saved at " + str(pathlib.Path(filepath, name[:-4] + "_thresholds.txt")))
 
-    data = pd.DataFrame.from_dict(viewer.layers['points'].properties)
-    for channel in threshold_dict.keys():
-        data[channel + "_expressed"] = np.array(data[channel] > threshold_dict[channel], dtype=np.int8)
+    #The gated table has every column of the cell data, not only the ones the viewer loaded
+    data = cell_store.to_frame(read_cell_table(threshold_widget.cell_data_filename.value))
 
-    data.to_csv(pathlib.Path(filepath, name[:-4] + "_single_cell_data_gated" + dt.now().strftime('%Y%m%d') + ".csv"))
+    write_cell_table(data, pathlib.Path(filepath, name[:-4] + "_single_cell_data_gated" + dt.now().strftime('%Y%m%d') +
+                                        CELL_TABLE_FORMATS[napari_viewer_parser_args.save_format]))
 
 @threshold_widget.cell_type.changed.connect
 def cell_type_changed(value: str):
-    if(cell_type_col):
-        data = pd.DataFrame.from_dict(viewer.layers['points'].properties)
-        ct_idx = data['cell_type'] == value
-        viewer.layers['cell type results'].shown = ct_idx
+    if cell_layers_loaded():
+        viewer.layers['cell type results'].shown = cell_store.is_cell_type(value, visible_cells)
 
+#Cell types are kept up to date by the store as thresholds change, this pushes them to the layers
 def update_cell_types():
-    data = pd.DataFrame.from_dict(viewer.layers['points'].properties)
-
-    cell_types = ['double_neg_t_cell',
-                  'cd4_t_cell',
-                  'cd8_t_cell',
-                  'mac',
-                  'cdc1',
-                  'other_myeloid_and_b_cells',
-                  'double_pos_t_cell']
-
-    data['cell_type'] = ['other'] * len(data)
-
-    ct_idx = np.zeros((len(data), len(cell_types)), dtype=bool)
-
-    ct_idx[:, 0] = (data['DAPI_expressed'] == 1) & \
-                   (data['CD3_expressed'] == 1) & \
-                   (data['CD4_expressed'] == 0) & \
-                   (data['CD8_expressed'] == 0) & \
-                   (data['XCR1_expressed'] == 0)
-
-    ct_idx[:, 1] = (data['DAPI_expressed'] == 1) & \
-                   (data['CD4_expressed'] == 1) & \
-                   (data['CD3_expressed'] == 1) & \
-                   (data['CD8_expressed'] == 0) & \
-                   (data['XCR1_expressed'] == 0)
-
-    ct_idx[:, 2] = (data['DAPI_expressed'] == 1) & \
-                   (data['CD8_expressed'] == 1) & \
-                   (data['CD3_expressed'] == 1) & \
-                   (data['CD4_expressed'] == 0) & \
-                   (data['XCR1_expressed'] == 0)
-
-    ct_idx[:, 3] = (data['DAPI_expressed'] == 1) & \
-                   (data['CD163_expressed'] == 1) & \
-                   (data['HLADR_expressed'] == 1) & \
-                   (data['XCR1_expressed'] == 0) & \
-                   (data['CD3_expressed'] == 0)
-
-    ct_idx[:, 4] = (data['DAPI_expressed'] == 1) & \
-                   (data['XCR1_expressed'] == 1) & \
-                   (data['HLADR_expressed'] == 1) & \
-                   (data['CD3_expressed'] == 0) & \
-                   (data['CD163_expressed'] == 0)
-
-    ct_idx[:, 5] = (data['DAPI_expressed'] == 1) & \
-                   (data['HLADR_expressed'] == 1) & \
-                   (data['CD163_expressed'] == 0) & \
-                   (data['CD3_expressed'] == 0) & \
-                   (data['XCR1_expressed'] == 0)
-
-    ct_idx[:, 6] = (data['DAPI_expressed'] == 1) & \
-                   (data['CD3_expressed'] == 1) & \
-                   (data['CD4_expressed'] == 1) & \
-                   (data['CD8_expressed'] == 1) & \
-                   (data['XCR1_expressed'] == 0)
-
-    assigned_twice = np.sum(ct_idx, axis=1) > 1
-
-    for i, ct in enumerate(cell_types):
-        data.loc[ct_idx[:, i], 'cell_type'] = ct
-
-    data.loc[assigned_twice, 'cell_type'] = 'assigned_twice'
-
-    viewer.layers['points'].properties = data
+    if not cell_layers_loaded():
+        return
+    with profile_span("update cell types", category='viewer'):
+        cell_types = cell_store.get_cell_types(visible_cells)
+        viewer.layers['points'].features['cell_type'] = cell_types
+        viewer.layers['cell type results'].features['cell_type'] = cell_types
+
+#Polygon (row, col) of an ROI shape. Ellipses are stored by the corners of their bounding box
+def get_roi_polygon(vertices, shape_type):
+    if shape_type != 'ellipse':
+        return vertices
+    angles = np.linspace(0, 2 * np.pi, ELLIPSE_VERTICES, endpoint=False)[:, np.newaxis]
+    return (vertices.mean(axis=0) + np.cos(angles) * (vertices[1] - vertices[0]) / 2
+                                  + np.sin(angles) * (vertices[3] - vertices[0]) / 2)
+
+@magicgui(call_button="Count cells in ROI")
+def roi_widget(): pass
+
+#Prints the cells of every cell type inside each shape of the ROI layer. Only the cells near the shape are looked at
+@roi_widget.call_button.clicked.connect
+def count_roi_cells():
+    if cell_store is None or ROI_LAYER not in viewer.layers:
+        print_colored("red", "Load cell data and draw shapes in the ROI layer first!")
+        return
+
+    roi_layer = viewer.layers[ROI_LAYER]
+    for index, (vertices, shape_type) in enumerate(zip(roi_layer.data, roi_layer.shape_type)):
+        if shape_type in ('line', 'path'):
+            continue
+        with profile_span("count roi cells", category='viewer', shape=shape_type):
+            cells = cell_index.query_polygon(get_roi_polygon(vertices[:, -2:], shape_type))
+            cell_type_counts = pd.Series(cell_store.get_cell_types(cells)).value_counts()
+        print_colored("cyan", f"ROI {index} ({shape_type}): {len(cells)} cells")
+        print(cell_type_counts[cell_type_counts > 0].to_string())
+
+#Cell borders of a slide: lazy multiscale borders of its label store (segmentation_labels-*.zarr), with the lazy
+#slide wide cell ids and their offsets, or the borders of an older segmentation_borders_current-*.npy stack stitched
+#into one mask. Returns None when they could not be loaded
+def read_boundaries(boundaries_file_path):
+    if boundaries_file_path.suffix == '.zarr':
+        try:
+            with profile_span("load border pyramid", category='viewer', path=boundaries_file_path.name):
+                borders = lazy_border_pyramid(boundaries_file_path, chunk_cache)
+                #The smallest level is what napari draws first. The borders of its tiles are found here, in parallel
+                borders[-1].compute()
+            labels_array = open_label_store(boundaries_file_path)
+            return {'borders': borders, 'cell_ids': lazy_cell_id_pyramid(boundaries_file_path, chunk_cache),
+                    'cell_id_offsets': get_cell_id_offsets(labels_array), 'cell_id_count': labels_array.attrs['cell_id_count']}
+        except Exception as e:
+            print_colored("red", f"Could not open or load {boundaries_file_path}")
+            print(e)
+            print(traceback.format_exc())
+            return None
 
-@threshold_widget.cell_boundaries_filename.changed.connect
-def get_boundaries(boundaries_file_path: str):
     segmented_cell_borders_filename = boundaries_file_path.stem.split('-')[-1]
 
     try:
-        with open(f'{CURRENT_DIR}/final_data/.{segmented_cell_borders_filename}_metadata.json', 'rb') as stitching_dims_file:
-            data = json.load(stitching_dims_file)
+        data = load_slide_metadata(segmented_cell_borders_filename)
     except Exception as e:
         print_colored("red", f"Could not open or load {CURRENT_DIR}/final_data/.{segmented_cell_borders_filename}.czi'."
                              f"Ensure that the czi file was tiled the associated meta data is in the final_data directory!")
         print(e)
         print(traceback.format_exc())
-        return
-
-    rows = data['dims']['rows']
-    cols = data['dims']['cols']
+        return None
+    yield
 
     try:
-        with open(boundaries_file_path, 'rb') as boundaries_file:
-            a = np.load(boundaries_file).reshape(rows*cols, 2048, 2048)
+        with profile_span("stitch boundaries", category='viewer', path=boundaries_file_path.name):
+            return {'borders': stitch_boundaries(boundaries_file_path, data)}
     except Exception as e:
         print_colored("red", f"Could not open or load {boundaries_file_path}")
         print(e)
         print(traceback.format_exc())
-        return
-
-    #Need to get czi dimensions to properly stitch boundaries together
-
-    final_concat = None
-    for i in range(rows):
-        row_concat = a[cols * i].reshape(2048, 2048)
-        row_concat = np.where(row_concat > 0, 1, 0)  # fov + (3135 * i*3+j), 0)
+        return None
 
-        for j in range(1, cols):
-            fov = a[i*cols+j].reshape(2048, 2048)
-            fov = np.where(fov > 0, 1, 0) #ensure it is all 0 (Black) and 1(White)
-            row_concat = np.concatenate([row_concat, fov], axis=1)
-
-        if(i == 0):
-            final_concat = row_concat
-        else:
-            final_concat = np.concatenate([final_concat, row_concat], axis=0)
-
-    #Here we are taking the image, converting it to RBA so we can make deadspace transparent
-    #Then adding it a an image to the layers
-
-    temp_img = Image.fromarray((final_concat * 255).astype(np.uint8)) #Need to alter to 255 scale as it is grayscale
-    temp_img_with_transparency = temp_img.convert("RGBA") #A is Alpha for transparency
-    array_with_transparency = np.asarray(temp_img_with_transparency)
-    array_with_transparency[:, :, 3] = final_concat * 255 #Adjust transparency
-    viewer.add_image(array_with_transparency, name="NPY Bounds")
+@threshold_widget.cell_boundaries_filename.changed.connect
+def get_boundaries(boundaries_file_path: str):
+    worker = thread_worker(read_boundaries, progress={'total': 1, 'desc': "Loading boundaries"})(pathlib.Path(boundaries_file_path))
+    start_loader('boundaries', worker, on_returned=add_boundaries)
 
+def add_boundaries(bounds):
+    global cell_id_levels, cell_id_offsets, cell_id_count
+    if bounds is None:
+        return
+    for layer_name in [BOUNDARIES_LAYER, CELL_IDS_LAYER]:
+        if layer_name in viewer.layers:
+            del viewer.layers[layer_name]
+    cell_id_levels = bounds.get('cell_ids')
+    cell_id_offsets = bounds.get('cell_id_offsets')
+    cell_id_count = bounds.get('cell_id_count')
+
+    with profile_span("load boundaries layer", category='viewer'):
+        viewer.add_labels(bounds['borders'], name=BOUNDARIES_LAYER, color={1: 'white'},
+                          multiscale=isinstance(bounds['borders'], list))
+        #Only the picked cell is drawn, see pick_cell
+        if cell_id_levels is not None:
+            viewer.add_labels(cell_id_levels, name=CELL_IDS_LAYER, multiscale=True, opacity=0.6, show_selected_label=True)
+            viewer.layers[CELL_IDS_LAYER].selected_label = 0
+    update_cell_id_index()
+
+#Maps the cell ids of the label store to the rows of the cell data, once both are loaded
+def update_cell_id_index():
+    global cell_id_index
+    cell_id_index = None
+    if cell_store is None or cell_id_offsets is None:
+        return
+    try:
+        with profile_span("build cell id index", category='viewer', cells=len(cell_store)):
+            cell_ids = get_cell_ids(cell_store.table['fov'].to_numpy(), cell_store.table['label'].to_numpy(), cell_id_offsets)
+            cell_id_index = CellIdIndex(cell_ids, cell_id_count)
+    except (KeyError, IndexError) as e:
+        print_colored("red", f"The cell data does not match the label store of the boundaries: {e}")
+
+#Cell id under a position of the viewer, read from the largest level so it is exact at any zoom. 0 outside the slide
+#and on the background
+def get_cell_id(position):
+    row, col = (int(np.floor(coordinate)) for coordinate in position[-2:])
+    if not (0 <= row < cell_id_levels[0].shape[0] and 0 <= col < cell_id_levels[0].shape[1]):
+        return 0
+    return int(cell_id_levels[0][row, col].compute())
+
+#Cell id under a position and the properties of the cell, a single row of the cell store found in constant time. No
+#properties for the background, for cells the cell data does not have or before the cell data is loaded
+def get_picked_cell(position):
+    if cell_id_levels is None:
+        return None, None
+    cell_id = get_cell_id(position)
+    row = cell_id_index.get_row(cell_id) if cell_id_index is not None else None
+    if row is None:
+        return cell_id, None
+    return cell_id, cell_store.cell_properties(row)
+
+def describe_cell(cell_id, properties):
+    positive_markers = [marker for marker in cell_store.markers if properties[marker + "_expressed"]]
+    return (f"Cell {cell_id} ({properties['fov']} label {properties['label']}): {properties['cell_type']}, "
+            f"{properties['cell_size']} pixels, positive for {', '.join(positive_markers) or 'no markers'}")
+
+#Shows the cell under the cursor in the status bar
+def hover_cell(viewer, event):
+    if cell_id_index is None:
+        return
+    cell_id, properties = get_picked_cell(event.position)
+    if properties is not None:
+        viewer.status = describe_cell(cell_id, properties)
+
+#Highlights the clicked cell in the picked cell layer and prints all of its properties
+def pick_cell(viewer, event):
+    cell_id, properties = get_picked_cell(event.position)
+    if cell_id is None or CELL_IDS_LAYER not in viewer.layers:
+        return
+    viewer.layers[CELL_IDS_LAYER].selected_label = cell_id
+    if properties is not None:
+        with profile_span("pick cell", category='viewer'):
+            print_colored("cyan", describe_cell(cell_id, properties))
+            print(pd.Series(properties).to_string())
 
 viewer = None
 viewer = napari.Viewer()
 viewer.window.add_dock_widget(threshold_widget)
+viewer.window.add_dock_widget(roi_widget)
+
+#The cells in view are looked up once the camera stops moving, not on every event of a pan or zoom
+cull_timer = QTimer()
+cull_timer.setSingleShot(True)
+cull_timer.setInterval(CULL_DELAY_MS)
+cull_timer.timeout.connect(show_cells_in_view)
+viewer.camera.events.center.connect(lambda event: cull_timer.start())
+viewer.camera.events.zoom.connect(lambda event: cull_timer.start())
+
+#With the boundaries of a label store and the cell data loaded, hovering a cell shows it and clicking highlights it
+viewer.mouse_move_callbacks.append(hover_cell)
+viewer.mouse_drag_callbacks.append(pick_cell)
 
 pp = propplot(viewer)
 viewer.window.add_dock_widget(pp, area='bottom')
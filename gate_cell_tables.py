@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: gate_cell_tables.py
+
+# GOAL: Gate and cell type the stitched cell tables of a whole cohort without the viewer, with the thresholds saved by
+#the viewer and the cell type rules it uses, so a threshold change can be applied to every slide at once
+
+# INPUT: A thresholds file (--thresholds), either the {slide}_thresholds.txt the viewer saves or a json of
+#{marker: threshold}, and 1 or more stitched cell tables
+#(single_cell_output/cell_table_arcsinh_transformed_stitched-{cell_file_name}.parquet, .feather or .csv)
+
+# OUTPUT: For every cell table, the gated table the viewer's save writes ({cell_file_name}_single_cell_data_gated{date},
+#with the {marker}_expressed and cell_type columns added) and {cell_file_name}_cell_type_counts{date}.csv, next to the
+#cell table or in --output-dir. Also cell_type_counts{date}.csv with the counts of every slide in one table
+
+# usage: gate_cell_tables.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] --thresholds THRESHOLDS [--cell-types CELL_TYPES]
+#                            [--workers WORKERS] [--output-dir OUTPUT_DIR] [--format {parquet,feather,csv}] files [files ...]
+#
+# positional arguments:
+#   files          Input 1 or more stitched cell tables to gate
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information while gating. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --thresholds THRESHOLDS, -t THRESHOLDS
+#                  Thresholds saved by the viewer ({slide}_thresholds.txt, the last save of every marker is used) or a
+#                  json of {marker: threshold}
+#   --cell-types CELL_TYPES
+#                  Json file with the cell type rules. (Default is cell_type_rules.json)
+#   --workers WORKERS, -w WORKERS
+#                  Number of slides gated at the same time, each in its own process. (Default is the number of cpus)
+#   --output-dir OUTPUT_DIR, -o OUTPUT_DIR
+#                  Where the gated tables and counts are written. (Default is next to each cell table, and the cohort
+#                  counts in the current directory)
+#   --format {parquet,feather,csv}
+#                  Format of the gated cell tables. (Default is parquet)
+
+#################################################################################################################
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime as dt
+from pathlib import Path
+
+from cell_store import CellStore
+from cell_table_io import CELL_TABLE_FORMATS, DEFAULT_CELL_TABLE_FORMAT, read_cell_table, write_cell_table
+from cell_type_rules import load_cell_type_rules, load_thresholds
+from segmentation_utils import print_colored, gating_parser, profile_span, profiler, enable_profiling
+
+import os
+import sys
+import traceback
+
+import pandas as pd
+
+DEBUG = False
+
+#Gets the cell_file_name of a stitched cell table. Ex: cell_table_arcsinh_transformed_stitched-cell_to_segment.parquet -> cell_to_segment
+def get_cell_file_name(cell_table_path):
+    return Path(cell_table_path).stem.split('-', 1)[-1]
+
+#Gates one cell table like the viewer's save and writes the gated table and its cell type counts. Returns the counts
+def gate_cell_table(cell_table_path, thresholds, cell_type_rules, output_dir=None, cell_table_format=DEFAULT_CELL_TABLE_FORMAT,
+                    date=None):
+    cell_file_name = get_cell_file_name(cell_table_path)
+    output_dir = Path(output_dir) if output_dir is not None else Path(cell_table_path).parent
+    date = date or dt.now().strftime('%Y%m%d')
+
+    with profile_span("gate slide", category='gating', slide=cell_file_name):
+        table = read_cell_table(cell_table_path)
+        markers = [marker for marker in thresholds if marker in table.columns]
+        if DEBUG: print(f"DEBUG: {cell_file_name} has {len(table)} cells, gating {markers}")
+
+        with profile_span("gate cells", category='gating', cells=len(table)):
+            gated = CellStore(table, markers, thresholds, cell_type_rules).to_frame()
+        write_cell_table(gated, Path(output_dir, cell_file_name + "_single_cell_data_gated" + date +
+                                     CELL_TABLE_FORMATS[cell_table_format]))
+
+        #Every cell type has a count, also the ones with no cells
+        counts = gated['cell_type'].value_counts(sort=False)
+        counts.rename_axis('cell_type').rename('count').to_csv(Path(output_dir, f"{cell_file_name}_cell_type_counts{date}.csv"))
+    return {'slide': cell_file_name, 'cells': len(gated), **counts.to_dict()}
+
+def gate_cell_table_safely(cell_table_path, *args):
+    try:
+        return gate_cell_table(cell_table_path, *args), None, profiler.take_events()
+    except Exception:
+        return None, traceback.format_exc(), profiler.take_events()
+
+#Gates every cell table, workers at once. A table that fails does not stop the others. Returns the counts of every
+#slide that was gated (in the order of cell_table_paths) and the tables that failed
+def gate_cohort(cell_table_paths, thresholds, cell_type_rules, workers=None, output_dir=None,
+                cell_table_format=DEFAULT_CELL_TABLE_FORMAT):
+    date = dt.now().strftime('%Y%m%d')
+    if output_dir is not None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    counts = {}
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(gate_cell_table_safely, cell_table_path, thresholds, cell_type_rules, output_dir,
+                                   cell_table_format, date): cell_table_path
+                   for cell_table_path in cell_table_paths}
+        for future in as_completed(futures):
+            slide_counts, error, trace_events = future.result()
+            profiler.add_events(trace_events)
+            name = Path(futures[future]).name
+            if error is not None:
+                failed.append(name)
+                print_colored("red", f"{name} failed:\n{error}")
+            else:
+                counts[futures[future]] = slide_counts
+                print_colored("green", f"{name} gated: {slide_counts['cells']} cells")
+
+    cohort_counts = pd.DataFrame([counts[path] for path in cell_table_paths if path in counts])
+    if len(cohort_counts):
+        cohort_counts_path = Path(output_dir or os.path.curdir, f"cell_type_counts{date}.csv")
+        cohort_counts.to_csv(cohort_counts_path, index=False)
+        print_colored("green", f"Created {cohort_counts_path}")
+    return cohort_counts, failed
+
+if __name__ == "__main__":
+    gating_parser.add_argument("--thresholds", "-t", dest='thresholds', action="store", type=Path, required=True,
+                        help="Thresholds saved by the viewer ({slide}_thresholds.txt) or a json of {marker: threshold}")
+    gating_parser.add_argument("--cell-types", dest='cell_types', action="store", type=Path, default=None,
+                        help="Json file with the cell type rules (Default is cell_type_rules.json)")
+    gating_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=os.cpu_count(),
+                        help="Number of slides gated at the same time (Default is the number of cpus)")
+    gating_parser.add_argument("--output-dir", "-o", dest='output_dir', action="store", type=Path, default=None,
+                        help="Where the gated tables and counts are written (Default is next to each cell table)")
+    gating_parser.add_argument("--format", dest='cell_table_format', action="store", choices=list(CELL_TABLE_FORMATS),
+                        default=DEFAULT_CELL_TABLE_FORMAT,
+                        help=f"Format of the gated cell tables (Default is {DEFAULT_CELL_TABLE_FORMAT})")
+
+    gating_parser_args = gating_parser.parse_args()
+
+    if gating_parser_args.debug:
+        DEBUG = True
+    enable_profiling(gating_parser_args)
+
+    thresholds = load_thresholds(gating_parser_args.thresholds)
+    print_colored("cyan", "Thresholds: " + ", ".join(f"{marker} {threshold}" for marker, threshold in thresholds.items()))
+
+    _, failed = gate_cohort(gating_parser_args.files, thresholds, load_cell_type_rules(gating_parser_args.cell_types),
+                            gating_parser_args.workers, gating_parser_args.output_dir, gating_parser_args.cell_table_format)
+    sys.exit(1 if failed else 0)
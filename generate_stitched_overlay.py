@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: generate_stitched_overlay.py
+
+# GOAL: Create the stitched overlay of a segmented slide (nuclear and membrane channels with the cell borders in
+#white) without ever holding the whole slide in memory
+
+# INPUT: 1 or more segmented slide directories (the czi_filename_dir moved back from ark-analysis), containing
+#tile_metadata.txt, input_data/deepcell_input/{fov}.tif and the labels, from
+#single_cell_output/segmentation_labels-{cell_file_name}.zarr (label_store.py) or else deepcell_output/{fov}_feature_0.tif
+
+# OUTPUT: final_overlay-{cell_file_name}.tiff in every slide directory. A tiled, compressed uint8 RGB BigTIFF
+
+#The rescaling limits of the channels come from the histograms tile_czi.py gathered while tiling when they are in
+#final_data/, otherwise from a first pass over every fov
+
+# usage: generate_stitched_overlay.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--workers WORKERS] [--tile TILE] files [files ...]
+#
+# positional arguments:
+#   files          Input 1 or more segmented slide directories to create the overlay of
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information when creating the overlay. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --workers WORKERS, -w WORKERS
+#                  Number of processes rendering fovs at the same time. (Default is 1)
+#   --tile TILE    Size of the tiles of the output tiff. (Default is 512)
+
+#################################################################################################################
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from skimage.exposure import rescale_intensity
+
+from intensity_stats import DEEPCELL_INPUT_PLANES, add_histograms, get_histogram, get_histogram_percentiles, \
+    get_intensity_histograms_path, get_positive_histogram, load_intensity_histograms
+from label_store import get_borders, get_label_store_path, keep_owned_labels, load_fov_labels
+from segmentation_utils import print_colored, cell_segment_parser, load_tile_metadata, get_tile_cores, get_peak_rss_mb, \
+    profile_span, add_profiled_bytes, enable_profiling
+from stitch_cell_data import get_cell_file_name
+
+import numpy as np
+import tifffile
+import time
+
+DEBUG = False
+
+RGB_CHANNELS = 3
+RESCALE_PERCENTILES = (5, 95)
+DEFAULT_TIFF_TILE = 512
+
+#Input image of a fov with the channels last, in its native dtype. None for fovs that were never segmented (empty)
+def load_fov_image(data_dir, fov):
+    fov_image_path = Path(data_dir, fov + '.tif')
+    if not fov_image_path.exists():
+        return None
+    image = tifffile.imread(fov_image_path)
+    if image.ndim == 2:
+        image = image[..., np.newaxis]
+    elif image.shape[0] <= RGB_CHANNELS < image.shape[-1]: #Channels first
+        image = np.moveaxis(image, 0, -1)
+    return image
+
+#Same channel order as ark's tif_overlay_preprocess: the nuclear channel is blue and the membrane channel green
+def to_rgb(image):
+    assert image.shape[-1] <= RGB_CHANNELS, f"At most {RGB_CHANNELS} channels can be overlaid, got {image.shape[-1]}"
+    rgb = np.zeros(image.shape[:2] + (RGB_CHANNELS,), dtype=image.dtype)
+    rgb[..., :image.shape[-1]] = image
+    return np.flip(rgb, axis=2)
+
+#First pass. Histogram of the positive values of every RGB channel of a fov, indexed by value (see get_histogram)
+def get_fov_histograms(work_item):
+    image = load_fov_image(work_item['data_dir'], work_item['fov'])
+    if image is None:
+        return [np.zeros(1, dtype=np.int64)] * RGB_CHANNELS
+    return [get_positive_histogram(get_histogram(channel)) for channel in np.moveaxis(to_rgb(image), 2, 0)]
+
+#The histograms of the first pass, from the deepcell input histograms tile_czi.py gathered while tiling. None when the
+#slide was tiled without them or its deepcell input was written after them (Ex: by the notebook)
+def load_tiling_histograms(slide_name, data_dir):
+    histograms_path = get_intensity_histograms_path(slide_name)
+    if not histograms_path.exists():
+        return None
+    histograms_time = histograms_path.stat().st_mtime
+    if any(fov_image_path.stat().st_mtime > histograms_time for fov_image_path in Path(data_dir).glob('*.tif')):
+        return None
+
+    histograms = load_intensity_histograms(slide_name)
+    planes = [get_positive_histogram(histograms[f"deepcell_input-{plane}"]) for plane in DEEPCELL_INPUT_PLANES]
+    #Same order as to_rgb: the nuclear plane is blue and the membrane plane green
+    return list(reversed(planes + [np.zeros(1, dtype=np.int64)] * (RGB_CHANNELS - len(planes))))
+
+#Second pass. The uint8 RGB overlay of a fov: every channel rescaled with the limits of the whole slide, and the
+#borders of the cells in white. When fovs overlap only the borders of the cells the fov keeps are drawn, the other cells
+#on its seams are drawn by the fov next to it
+def render_fov_overlay(work_item):
+    image = load_fov_image(work_item['data_dir'], work_item['fov'])
+    overlay = np.zeros(work_item['tile_shape'] + (RGB_CHANNELS,), dtype=np.uint8)
+    if image is None:
+        return overlay
+
+    rgb = to_rgb(image)
+    for index, in_range in enumerate(work_item['in_ranges']):
+        if in_range is not None:
+            overlay[..., index] = rescale_intensity(rgb[..., index], in_range=tuple(in_range), out_range='uint8')
+
+    labels = load_fov_labels(work_item['fov'], work_item['segmentation_dir'], work_item['label_store'])
+    if labels is not None:
+        overlay[get_borders(keep_owned_labels(labels, work_item['origin'], work_item['core'])), :] = 255
+    return overlay
+
+#Like executor.map, but with at most max_in_flight items submitted at once, so finished results do not pile up in
+#memory while the output is written
+def map_bounded(executor, function, items, max_in_flight):
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(function, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+#Groups the tiles of tile_metadata.txt into bands of tiles with the same starting row, top to bottom and left to right
+def get_tile_bands(tiles):
+    bands = {}
+    for tile in tiles:
+        bands.setdefault(int(tile['x1']), []).append(tile)
+    return [sorted(bands[x1], key=lambda tile: int(tile['y1'])) for x1 in sorted(bands)]
+
+#With histograms (of the positive values of every RGB channel, see load_tiling_histograms) the first pass is skipped.
+#With a label store the labels are read from it instead of segmentation_dir
+def generate_stitched_overlay(tile_metadata_path, segmentation_dir, data_dir, output_path, workers=1,
+                              tiff_tile=DEFAULT_TIFF_TILE, histograms=None, label_store_path=None):
+    start = time.perf_counter()
+    tiles = load_tile_metadata(tile_metadata_path)
+    bands = get_tile_bands(tiles)
+
+    sample_image = next((image for image in (load_fov_image(data_dir, tile['fov']) for tile in tiles) if image is not None), None)
+    assert sample_image is not None, f"No fov of {tile_metadata_path} has a deepcell input in {data_dir}"
+    tile_shape = sample_image.shape[:2]
+    shape = (int(bands[-1][0]['x1']) + tile_shape[0], max(int(tile['y1']) for tile in tiles) + tile_shape[1], RGB_CHANNELS)
+    tile_cores = get_tile_cores(tiles)
+
+    work_items = [{'fov': tile['fov'], 'data_dir': data_dir, 'segmentation_dir': segmentation_dir, 'label_store': label_store_path,
+                   'tile_shape': tile_shape, 'origin': (int(tile['x1']), int(tile['y1'])), 'core': tile_cores[tile['fov']]}
+                  for band in bands for tile in band]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        #First pass: the 5/95 percentile limits of every channel come from histograms summed over all fovs
+        if histograms is None:
+            histograms = [np.zeros(1, dtype=np.int64)] * RGB_CHANNELS
+            with profile_span("overlay histograms", fovs=len(work_items)):
+                for fov_histograms in map_bounded(executor, get_fov_histograms, work_items, 2 * workers):
+                    histograms = [add_histograms(total, fov_histogram) for total, fov_histogram in zip(histograms, fov_histograms)]
+        elif DEBUG: print("DEBUG: Using the histograms gathered while tiling")
+        in_ranges = [get_histogram_percentiles(histogram, RESCALE_PERCENTILES) for histogram in histograms]
+        if DEBUG: print(f"DEBUG: Rescaling channels from {in_ranges}")
+        for work_item in work_items:
+            work_item['in_ranges'] = in_ranges
+
+        #Second pass: fovs are rendered in parallel and written one band of fovs at a time, as tiff tiles. Overlapping
+        #fovs have the same pixels and each draws the borders of the cells it keeps, so they are merged with a maximum
+        #(borders are white). The rows of the slide not yet written are kept until no band after them can reach them
+        overlays = map_bounded(executor, render_fov_overlay, work_items, 2 * workers)
+
+        def get_tiff_tiles():
+            pending = np.zeros((0, shape[1], RGB_CHANNELS), dtype=np.uint8)
+            pending_row = 0 #Row of the slide the first pending row is
+            for index, band in enumerate(bands):
+                band_row = int(band[0]['x1'])
+                band_end = band_row + tile_shape[0] - pending_row
+                if band_end > len(pending):
+                    pending = np.concatenate([pending, np.zeros((band_end - len(pending),) + pending.shape[1:], dtype=np.uint8)])
+                with profile_span("render overlay band", row=band_row, fovs=len(band)):
+                    for tile in band:
+                        if DEBUG: print(f"DEBUG: Rendering overlay of {tile['fov']}")
+                        y1 = int(tile['y1'])
+                        band_overlay = pending[band_row - pending_row:band_end, y1:y1 + tile_shape[1]]
+                        np.maximum(band_overlay, next(overlays), out=band_overlay)
+
+                done_row = int(bands[index + 1][0]['x1']) if index + 1 < len(bands) else shape[0]
+                while pending_row + tiff_tile <= done_row or (done_row == shape[0] and pending_row < shape[0]):
+                    for col in range(0, shape[1], tiff_tile):
+                        yield pending[:tiff_tile, col:col + tiff_tile]
+                    pending = pending[tiff_tile:]
+                    pending_row += tiff_tile
+
+        with profile_span("write overlay", path=Path(output_path).name):
+            tifffile.imwrite(output_path, get_tiff_tiles(), shape=shape, dtype=np.uint8, tile=(tiff_tile, tiff_tile),
+                             photometric='rgb', compression='zlib', bigtiff=True)
+            add_profiled_bytes(written=Path(output_path).stat().st_size)
+
+    print_colored("green", f"Created {output_path} {shape} in {time.perf_counter() - start:.1f}s, "
+                           f"peak memory {get_peak_rss_mb():.0f} MB (workers {get_peak_rss_mb(children=True):.0f} MB)")
+
+def generate_slide_overlay(segmented_cell_dir, workers=1, tiff_tile=DEFAULT_TIFF_TILE):
+    cell_file_name = get_cell_file_name(segmented_cell_dir)
+    data_dir = Path(segmented_cell_dir, "input_data", "deepcell_input")
+    label_store_path = get_label_store_path(Path(segmented_cell_dir, "single_cell_output"), cell_file_name)
+    generate_stitched_overlay(Path(segmented_cell_dir, "tile_metadata.txt"),
+                              Path(segmented_cell_dir, "deepcell_output"),
+                              data_dir,
+                              Path(segmented_cell_dir, f"final_overlay-{cell_file_name}.tiff"),
+                              workers, tiff_tile, load_tiling_histograms(cell_file_name, data_dir),
+                              label_store_path if label_store_path.exists() else None)
+
+if __name__ == "__main__":
+    cell_segment_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=1,
+                        help="Number of processes rendering fovs at the same time (Default is 1)")
+    cell_segment_parser.add_argument("--tile", dest='tiff_tile', action="store", type=int, default=DEFAULT_TIFF_TILE,
+                        help=f"Size of the tiles of the output tiff (Default is {DEFAULT_TIFF_TILE})")
+
+    cell_segment_parser_args = cell_segment_parser.parse_args()
+
+    if cell_segment_parser_args.debug:
+        DEBUG = True
+    enable_profiling(cell_segment_parser_args)
+
+    for segmented_cell_dir in cell_segment_parser_args.files:
+        generate_slide_overlay(segmented_cell_dir, cell_segment_parser_args.workers, cell_segment_parser_args.tiff_tile)
@@ -0,0 +1,151 @@
+import json
+import numpy as np
+
+from segmentation_utils import get_slide_metadata_path
+
+#Intensity statistics of every channel of a slide, gathered by tile_czi.py while it tiles so nothing has to rescan the
+#pixels later. Stored next to the slide metadata in final_data/:
+#   .{czi_filename}_intensity_stats.json       min, max, mean and percentiles of every channel and of the deepcell
+#                                               input planes, and the min, max and mean of every tile
+#   .{czi_filename}_intensity_histograms.npz   the histograms they come from: the full histogram of every channel and
+#                                               deepcell input plane, and a coarse histogram of every tile
+# Includes
+#   1. Histogram helpers: the histogram of an image indexed by value, adding histograms and percentiles from histograms
+#   2. An IntensityStats class that adds up the histograms of the tiles as they are written, and writes the sidecars
+#   3. load_intensity_stats and load_intensity_histograms for the viewer and the overlay
+
+STATS_PERCENTILES = (0.1, 1, 5, 50, 95, 99, 99.9) #Percentiles of the positive values of every channel
+TILE_HISTOGRAM_BINS = 256 #Bins of the coarse histogram of every tile
+ARCSINH_LINEAR_FACTOR = 100 #Cell tables hold arcsinh(100 * size normalized intensity), like ark's
+
+DEEPCELL_INPUT_PLANES = ['nuclear', 'membrane']
+
+def get_intensity_stats_path(slide_name):
+    return get_slide_metadata_path(slide_name).with_name(f".{slide_name}_intensity_stats.json")
+
+def get_intensity_histograms_path(slide_name):
+    return get_slide_metadata_path(slide_name).with_name(f".{slide_name}_intensity_histograms.npz")
+
+#Histogram of the values of an image, indexed by value. Float images are rounded to the nearest integer and negative
+#values are counted as 0, so their percentiles are within half an intensity unit
+def get_histogram(image):
+    values = image.ravel()
+    if not np.issubdtype(values.dtype, np.integer):
+        values = np.rint(np.clip(values, 0, None))
+    return np.bincount(values.astype(np.int64), minlength=1)
+
+def add_histograms(histogram_a, histogram_b):
+    if len(histogram_a) < len(histogram_b):
+        histogram_a, histogram_b = histogram_b, histogram_a
+    histogram_a = histogram_a.copy()
+    histogram_a[:len(histogram_b)] += histogram_b
+    return histogram_a
+
+#Percentiles of the values counted in a histogram, interpolated between the closest values like np.percentile does.
+#None if the histogram is empty
+def get_histogram_percentiles(histogram, percentiles):
+    cumulative = np.cumsum(histogram)
+    count = cumulative[-1]
+    if count == 0:
+        return None
+    ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (count - 1)
+    lower_ranks = np.floor(ranks)
+    lower_values = np.searchsorted(cumulative, lower_ranks, side='right')
+    upper_values = np.searchsorted(cumulative, np.minimum(lower_ranks + 1, count - 1), side='right')
+    return lower_values + (ranks - lower_ranks) * (upper_values - lower_values)
+
+#The same histogram without the zeros, which are background and padding
+def get_positive_histogram(histogram):
+    histogram = histogram.copy()
+    histogram[0] = 0
+    return histogram
+
+#Min, max and mean of the values of a histogram, and the percentiles of its positive values (None without any)
+def summarize_histogram(histogram, percentiles=STATS_PERCENTILES):
+    counted = np.flatnonzero(histogram)
+    count = int(histogram.sum())
+    positive_percentiles = get_histogram_percentiles(get_positive_histogram(histogram), percentiles)
+    return {
+        'min': int(counted[0]) if count else None,
+        'max': int(counted[-1]) if count else None,
+        'mean': round(float(np.dot(np.arange(len(histogram)), histogram) / count), 3) if count else None,
+        'count': count,
+        'positive_count': count - int(histogram[0]),
+        'percentiles': {str(percentile): round(float(value), 3) for percentile, value in zip(percentiles, positive_percentiles)}
+                       if positive_percentiles is not None else None,
+    }
+
+#Width of the bins of the coarse tile histograms, so TILE_HISTOGRAM_BINS bins cover the values of the dtype.
+#Floats are binned like uint16
+def get_tile_bin_width(dtype):
+    dtype = np.dtype(dtype)
+    bits = dtype.itemsize * 8 if np.issubdtype(dtype, np.integer) else 16
+    return max(2**bits // TILE_HISTOGRAM_BINS, 1)
+
+def get_coarse_histogram(histogram, bin_width):
+    bins = np.minimum(np.arange(len(histogram)) // bin_width, TILE_HISTOGRAM_BINS - 1)
+    return np.bincount(bins, weights=histogram, minlength=TILE_HISTOGRAM_BINS).astype(np.int64)
+
+class IntensityStats:
+    #Adds up the histograms of the tiles of a slide as they are written, in any order. Only a coarse histogram and the
+    #min, max and mean of every tile are kept, so the memory does not grow with the full histograms of every tile
+    def __init__(self):
+        self.channels = {} #Channel -> histogram of the whole slide
+        self.tiles = {} #fov -> channel -> min, max, mean and coarse histogram of the tile
+        self.deepcell_input = [np.zeros(1, dtype=np.int64) for _ in DEEPCELL_INPUT_PLANES]
+        self.bin_width = None
+
+    def add_tile(self, fov, channel, histogram, dtype):
+        self.channels[channel] = add_histograms(self.channels.get(channel, np.zeros(1, dtype=np.int64)), histogram)
+        self.bin_width = self.bin_width or get_tile_bin_width(dtype)
+        tile_stats = {key: value for key, value in summarize_histogram(histogram, []).items() if key in ('min', 'max', 'mean')}
+        tile_stats['histogram'] = get_coarse_histogram(histogram, self.bin_width)
+        self.tiles.setdefault(fov, {})[channel] = tile_stats
+
+    def add_deepcell_input(self, histograms):
+        self.deepcell_input = [add_histograms(total, histogram) for total, histogram in zip(self.deepcell_input, histograms)]
+
+    #Writes the stats and histograms of the slide next to its metadata
+    def write(self, slide_name, channels, fovs):
+        tile_fovs = [fov for fov in fovs if fov in self.tiles]
+        stats = {
+            'percentiles': list(STATS_PERCENTILES),
+            'channels': {channel: summarize_histogram(self.channels[channel]) for channel in channels if channel in self.channels},
+            'deepcell_input': {plane: summarize_histogram(histogram) for plane, histogram in zip(DEEPCELL_INPUT_PLANES, self.deepcell_input)},
+            'tiles': {"fov" + str(fov): {channel: {key: value for key, value in tile_stats.items() if key != 'histogram'}
+                                         for channel, tile_stats in self.tiles[fov].items()}
+                      for fov in tile_fovs},
+            'tile_histogram_bin_width': self.bin_width,
+        }
+        with open(get_intensity_stats_path(slide_name), 'w') as f:
+            json.dump(stats, f)
+
+        histograms = {f"channel-{channel}": histogram for channel, histogram in self.channels.items()}
+        histograms.update({f"deepcell_input-{plane}": histogram for plane, histogram in zip(DEEPCELL_INPUT_PLANES, self.deepcell_input)})
+        histograms['tile_fovs'] = np.array(["fov" + str(fov) for fov in tile_fovs])
+        for channel in self.channels:
+            histograms[f"tiles-{channel}"] = np.stack([self.tiles[fov][channel]['histogram'] if channel in self.tiles[fov]
+                                                       else np.zeros(TILE_HISTOGRAM_BINS, dtype=np.int64) for fov in tile_fovs])
+        np.savez_compressed(get_intensity_histograms_path(slide_name), **histograms)
+
+#Stats written by tile_czi.py for a slide, or None if it was tiled without them
+def load_intensity_stats(slide_name):
+    stats_path = get_intensity_stats_path(slide_name)
+    if not stats_path.exists():
+        return None
+    with open(stats_path) as f:
+        return json.load(f)
+
+#Histograms written by tile_czi.py for a slide, by name (channel-{channel}, deepcell_input-{plane}, tiles-{channel}),
+#or None if it was tiled without them
+def load_intensity_histograms(slide_name):
+    histograms_path = get_intensity_histograms_path(slide_name)
+    if not histograms_path.exists():
+        return None
+    with np.load(histograms_path) as histograms:
+        return {name: histograms[name] for name in histograms.files}
+
+#Largest arcsinh transformed value a cell can have for a channel, for the range of the threshold slider. A cell's
+#size normalized intensity is never over the brightest pixel of the channel
+def get_arcsinh_max(channel_stats):
+    return float(np.arcsinh(channel_stats['max'] * ARCSINH_LINEAR_FACTOR))
@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
+from numcodecs import Blosc
+from pathlib import Path
+from skimage.segmentation import find_boundaries
+
+import numpy as np
+import pandas as pd
+import tifffile
+import zarr
+
+from multiscale_utils import fit_chunk, get_level_count, lazy_level
+from segmentation_utils import load_tile_metadata, get_tile_cores, profile_span, add_profiled_bytes
+
+#Compact store of the whole cell labels of a segmented slide, written once after segmentation, with the cell borders
+#derived from it when they are shown instead of being saved. Replaces the segmentation_labels_current-*.npy and
+#segmentation_borders_current-*.npy stacks the notebook used to save
+#   single_cell_output/segmentation_labels-{cell_file_name}.zarr
+#A zarr array of the labels of every fov, compressed and chunked by tile, so every chunk is the labels of one fov
+#(fov local, like deepcell wrote them). The chunks are laid out in the grid of the tiles, which is the slide itself
+#unless the tiles overlap (tile_czi.py --overlap). Tiles with no cells are never written and read back as 0. Its attrs
+#have the shape of the tiles, the shape of the slide and, for every segmented fov, its chunk, its position in the slide,
+#its core (see get_tile_cores), its largest label and its offset. The labels of a fov plus its offset are the slide
+#wide cell ids, unique over the whole slide (cell_id_count in total)
+# Includes
+#   1. write_label_store to build the store from the deepcell output, several tiles at a time
+#   2. read_tile_labels and load_fov_labels to read the labels of one fov back
+#   3. get_borders, the cell borders of the labels of a fov (like ark's save_segmentation_labels)
+#   4. keep_owned_labels to drop the cells of a fov that another overlapping fov keeps, and read_slide_cell_ids to read
+#      the cell ids of a region of the slide with every cell on a seam drawn once
+#   5. lazy_border_pyramid, multiscale lazy arrays of the borders for the viewer. The borders of a tile are only found
+#      when the tile is first shown, in dask's threads for the tiles shown at once, and then kept in the chunk cache
+#   6. lazy_cell_id_pyramid, multiscale lazy arrays of the slide wide cell ids, and a CellIdIndex from the ids to the
+#      rows of the cell table, so the viewer can tell which cell is under the cursor
+
+LABEL_STORE_COMPRESSOR = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE) #Labels are mostly runs of a few values
+CELL_ID_DTYPE = np.uint32
+
+def get_label_store_path(single_cell_dir, cell_file_name):
+    return Path(single_cell_dir, f"segmentation_labels-{cell_file_name}.zarr")
+
+def load_segmentation_labels(segmentation_dir, fov):
+    return np.squeeze(tifffile.imread(Path(segmentation_dir, fov + '_feature_0.tif')))
+
+#Writes the whole cell labels of every segmented fov of tile_metadata.txt into one store, workers tiles at a time.
+#Returns the store
+def write_label_store(label_store_path, segmentation_dir, tile_metadata_path, workers=None):
+    tiles = load_tile_metadata(tile_metadata_path)
+    segmented_tiles = [tile for tile in tiles if Path(segmentation_dir, tile['fov'] + '_feature_0.tif').exists()]
+    assert segmented_tiles, f"No fov of {tile_metadata_path} has labels in {segmentation_dir}"
+
+    tile_shape = load_segmentation_labels(segmentation_dir, segmented_tiles[0]['fov']).shape
+    tile_cores = get_tile_cores(tiles)
+    #Chunk of every tile in the grid of the tiles, by its start in the slide
+    grid_rows = {x1: index * tile_shape[0] for index, x1 in enumerate(sorted({int(tile['x1']) for tile in tiles}))}
+    grid_cols = {y1: index * tile_shape[1] for index, y1 in enumerate(sorted({int(tile['y1']) for tile in tiles}))}
+    shape = (len(grid_rows) * tile_shape[0], len(grid_cols) * tile_shape[1])
+    labels_array = zarr.open(str(label_store_path), mode='w', shape=shape, chunks=tile_shape, dtype=np.int32,
+                             compressor=LABEL_STORE_COMPRESSOR, fill_value=0)
+
+    #Every tile is its own chunk, so tiles can be written from several threads at once
+    def write_tile(tile):
+        with profile_span("write label tile", category='labels', fov=tile['fov']):
+            labels = load_segmentation_labels(segmentation_dir, tile['fov'])
+            add_profiled_bytes(read=labels.nbytes)
+            x1, y1 = int(tile['x1']), int(tile['y1'])
+            row, col = grid_rows[x1], grid_cols[y1]
+            if labels.any():
+                labels_array[row:row + tile_shape[0], col:col + tile_shape[1]] = labels
+        #The core clipped to the tile, which keeps the same cells and can be saved as json
+        core_x1, core_x2, core_y1, core_y2 = tile_cores[tile['fov']]
+        core = [max(core_x1, x1), min(core_x2, x1 + tile_shape[0]), max(core_y1, y1), min(core_y2, y1 + tile_shape[1])]
+        return tile['fov'], {'row': row, 'col': col, 'slide_row': x1, 'slide_col': y1, 'core': core, 'max_label': int(labels.max())}
+
+    with profile_span("write label store", category='labels', fovs=len(segmented_tiles)):
+        with ThreadPoolExecutor(workers) as executor:
+            segmented_fovs = dict(executor.map(write_tile, segmented_tiles))
+
+        #Fovs in fov order, each starting its cell ids after the largest id of the fov before it
+        cell_id_count = 0
+        for position in segmented_fovs.values():
+            position['offset'] = cell_id_count
+            cell_id_count += position['max_label']
+        assert cell_id_count <= np.iinfo(CELL_ID_DTYPE).max, f"{cell_id_count} cells do not fit in {np.dtype(CELL_ID_DTYPE)} ids"
+
+        labels_array.attrs['tile_shape'] = list(tile_shape)
+        labels_array.attrs['slide_shape'] = [max(int(tile['x1']) for tile in tiles) + tile_shape[0],
+                                             max(int(tile['y1']) for tile in tiles) + tile_shape[1]]
+        labels_array.attrs['fovs'] = segmented_fovs
+        labels_array.attrs['cell_id_count'] = cell_id_count
+        add_profiled_bytes(written=labels_array.nbytes_stored)
+    return labels_array
+
+def open_label_store(label_store_path):
+    return zarr.open_array(str(label_store_path), mode='r')
+
+#Labels of one fov. All 0 for fovs that were not segmented
+def read_tile_labels(labels_array, fov):
+    tile_shape = labels_array.attrs['tile_shape']
+    position = labels_array.attrs['fovs'].get(fov)
+    if position is None:
+        return np.zeros(tile_shape, dtype=labels_array.dtype)
+    return labels_array[position['row']:position['row'] + tile_shape[0], position['col']:position['col'] + tile_shape[1]]
+
+#Whole cell labels of a fov, from the label store of the slide when it has one, else as written by deepcell. None for
+#fovs that were never segmented
+def load_fov_labels(fov, segmentation_dir, label_store_path=None):
+    if label_store_path is not None:
+        return read_tile_labels(open_label_store(label_store_path), fov)
+    if not Path(segmentation_dir, fov + '_feature_0.tif').exists():
+        return None
+    return load_segmentation_labels(segmentation_dir, fov)
+
+def get_borders(labels):
+    return find_boundaries(labels, connectivity=1, mode='inner')
+
+#Chunk, position in the slide and core of every fov of a store, by fov. Stores written before tiles could overlap have
+#every fov at its chunk and keep every cell
+def get_fov_positions(labels_array):
+    positions = {}
+    for fov, position in labels_array.attrs['fovs'].items():
+        positions[fov] = {'slide_row': position['row'], 'slide_col': position['col'], 'core': None, **position}
+    return positions
+
+def get_slide_shape(labels_array):
+    return tuple(labels_array.attrs.get('slide_shape', labels_array.shape))
+
+#The labels of a fov without the cells another overlapping fov keeps: only the cells whose centroid (in the slide, the
+#fov starting at origin) is in the core of the fov stay, the rule stitch_cell_data.py keeps the rows of the cell table
+#by. The centroids are added up like quantify_cells.py does, so both keep the same cells. A core of None or one around
+#the whole fov keeps every cell
+def keep_owned_labels(labels, origin, core):
+    if core is None or (core[0] <= origin[0] and core[1] >= origin[0] + labels.shape[0] and
+                        core[2] <= origin[1] and core[3] >= origin[1] + labels.shape[1]):
+        return labels
+    pixels = np.flatnonzero(labels)
+    if not len(pixels):
+        return labels
+    cell_labels = labels.ravel()[pixels].astype(np.int64)
+    bins = int(cell_labels.max()) + 1
+    area = np.bincount(cell_labels, minlength=bins)
+    present = np.flatnonzero(area)
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    centroid_row = np.bincount(cell_labels, weights=rows.astype(np.float64), minlength=bins)[present] / area[present] + origin[0]
+    centroid_col = np.bincount(cell_labels, weights=cols.astype(np.float64), minlength=bins)[present] / area[present] + origin[1]
+
+    owned = np.zeros(bins, dtype=bool)
+    owned[present] = (centroid_row >= core[0]) & (centroid_row < core[1]) & (centroid_col >= core[2]) & (centroid_col < core[3])
+    return np.where(owned[labels], labels, 0).astype(labels.dtype, copy=False)
+
+#Slide wide cell ids of the cells a fov keeps
+def read_fov_cell_ids(labels_array, position):
+    tile_shape = labels_array.attrs['tile_shape']
+    labels = labels_array[position['row']:position['row'] + tile_shape[0], position['col']:position['col'] + tile_shape[1]]
+    labels = keep_owned_labels(labels, (position['slide_row'], position['slide_col']), position['core'])
+    cell_ids = labels.astype(CELL_ID_DTYPE)
+    cell_ids[labels > 0] += CELL_ID_DTYPE(position['offset'])
+    return cell_ids
+
+#Slide wide cell ids of the region of the slide the size of a tile starting at (y0, x0), from every fov over it.
+#fov_cell_ids(fov, position) gives the cell ids of the cells a fov keeps, so a cell on the seam of two overlapping fovs
+#is drawn once, whole. Without overlap the region is a single fov
+def read_slide_cell_ids(positions, tile_shape, y0, x0, fov_cell_ids):
+    cell_ids = np.zeros(tile_shape, dtype=CELL_ID_DTYPE)
+    for fov, position in positions.items():
+        row, col = position['slide_row'], position['slide_col']
+        rows = (max(y0, row), min(y0 + tile_shape[0], row + tile_shape[0]))
+        cols = (max(x0, col), min(x0 + tile_shape[1], col + tile_shape[1]))
+        if rows[0] >= rows[1] or cols[0] >= cols[1]:
+            continue
+        fov_ids = fov_cell_ids(fov, position)[rows[0] - row:rows[1] - row, cols[0] - col:cols[1] - col]
+        np.copyto(cell_ids[rows[0] - y0:rows[1] - y0, cols[0] - x0:cols[1] - x0], fov_ids, where=fov_ids > 0)
+    return cell_ids
+
+#read_tile(y0, x0) for the lazy pyramids: the cell ids of the tile of the slide starting at (y0, x0). When the fovs
+#overlap a tile of the slide is made from up to 4 fovs, so the cell ids of every fov are kept in the cache too
+def get_slide_tile_reader(label_store_path, labels_array, cache):
+    positions = get_fov_positions(labels_array)
+    tile_shape = tuple(labels_array.attrs['tile_shape'])
+    overlapping = any((position['slide_row'], position['slide_col']) != (position['row'], position['col'])
+                      for position in positions.values())
+
+    def fov_cell_ids(fov, position):
+        if not overlapping:
+            return read_fov_cell_ids(labels_array, position)
+        return cache.get((str(label_store_path), 'fov cell ids', fov), lambda: read_fov_cell_ids(labels_array, position))
+
+    return lambda y0, x0: read_slide_cell_ids(positions, tile_shape, y0, x0, fov_cell_ids)
+
+#Multiscale lazy arrays (largest first) of a slide of the given shape built one tile at a time: every chunk is one
+#tile, read_tile(y0, x0) gives the full size tile starting at (y0, x0) and downsample(tile, scale) the tile of a smaller
+#level. The full size tile is the chunk of the largest level, so it is only read once for every level while it stays
+#in the cache
+def lazy_tile_pyramid(shape, tile_size, key, dtype, read_tile, downsample, cache):
+    #Tiles at the bottom and right of the slide are cut to the slide
+    def read_slide_tile(y0, x0):
+        return read_tile(y0, x0)[:shape[0] - y0, :shape[1] - x0]
+
+    levels = []
+    for level in range(get_level_count(shape)):
+        scale = 2**level
+        if tile_size % scale:
+            break
+        level_shape = (-(-shape[0] // scale), -(-shape[1] // scale))
+
+        def read_region(y0, y1, x0, x1, scale=scale):
+            if scale == 1:
+                return read_slide_tile(y0, x0)
+            tile = cache.get(((*key, 0), y0 * scale, x0 * scale), lambda: read_slide_tile(y0 * scale, x0 * scale))
+            return downsample(fit_chunk(tile, (tile_size, tile_size)), scale)[:y1 - y0, :x1 - x0]
+
+        levels.append(lazy_level(level_shape, tile_size // scale, dtype, read_region, cache, (*key, level)))
+    return levels
+
+#Multiscale lazy arrays of the cell borders of a slide, 1 on a border and 0 elsewhere (transparent in a labels layer).
+#The borders of a tile are found the first time it is shown, and the smaller levels are the borders max pooled, so
+#thin borders do not disappear when zoomed out
+def lazy_border_pyramid(label_store_path, cache):
+    labels_array = open_label_store(label_store_path)
+    tile_size = labels_array.chunks[0]
+    read_tile_cell_ids = get_slide_tile_reader(label_store_path, labels_array, cache)
+
+    def read_tile_borders(y0, x0):
+        with profile_span("find tile borders", category='viewer'):
+            cell_ids = read_tile_cell_ids(y0, x0)
+            borders = np.zeros(cell_ids.shape, dtype=np.uint8)
+            if cell_ids.any():
+                borders[get_borders(cell_ids)] = 1
+        return borders
+
+    def max_pool(borders, scale):
+        return borders.reshape(tile_size // scale, scale, tile_size // scale, scale).max(axis=(1, 3))
+
+    return lazy_tile_pyramid(get_slide_shape(labels_array), tile_size, (str(label_store_path), 'borders'), np.uint8,
+                             read_tile_borders, max_pool, cache)
+
+#Multiscale lazy arrays of the cell ids of a slide: the labels of every fov moved by the offset of the fov, so every
+#cell of the slide has its own id (0 is the background). The smaller levels take every scale-th pixel
+def lazy_cell_id_pyramid(label_store_path, cache):
+    labels_array = open_label_store(label_store_path)
+
+    def subsample(cell_ids, scale):
+        return np.ascontiguousarray(cell_ids[::scale, ::scale])
+
+    return lazy_tile_pyramid(get_slide_shape(labels_array), labels_array.chunks[0], (str(label_store_path), 'cell_ids'),
+                             CELL_ID_DTYPE, get_slide_tile_reader(label_store_path, labels_array, cache), subsample, cache)
+
+#Offset of the labels of every fov in the slide wide cell ids
+def get_cell_id_offsets(labels_array):
+    return {fov: position['offset'] for fov, position in labels_array.attrs['fovs'].items()}
+
+#Slide wide id of every cell of a cell table, from its fov and label
+def get_cell_ids(fovs, labels, offsets):
+    fov_codes = pd.Categorical(fovs, categories=list(offsets)).codes
+    if np.any(fov_codes < 0):
+        raise KeyError(f"Cells from fovs {sorted(set(np.asarray(fovs)[fov_codes < 0]))} are not in the label store")
+    return (np.asarray(labels, dtype=np.int64) + np.array(list(offsets.values()), dtype=np.int64)[fov_codes]).astype(CELL_ID_DTYPE)
+
+class CellIdIndex:
+    #Row of the cell table of every cell id, so the cell under the cursor is found in constant time. -1 for ids with
+    #no row (cells quantification dropped)
+    def __init__(self, cell_ids, cell_id_count):
+        self.rows = np.full(cell_id_count + 1, -1, dtype=np.int64)
+        self.rows[cell_ids] = np.arange(len(cell_ids))
+
+    def get_row(self, cell_id):
+        if cell_id <= 0 or cell_id >= len(self.rows):
+            return None
+        row = int(self.rows[cell_id])
+        return row if row >= 0 else None
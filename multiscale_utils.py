@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import aicspylibczi
+import dask.array as da
+import numpy as np
+import os
+import threading
+import zarr
+
+from segmentation_utils import load_slide_metadata, get_tile_geometry, profile_span, add_profiled_bytes
+
+#Useful utilities for viewing slides lazily, at any zoom level, without reading the whole slide
+# Includes
+#   1. A ChunkCache class, a bounded LRU cache of decoded chunks shared by every layer
+#   2. A lazy_czi_pyramid function to get multiscale lazy (dask) arrays of a channel decoded straight from the czi
+#   3. A lazy_zarr_pyramid function to get the same from a pyramid written by tile_czi.py --pyramid
+#   4. A find_pyramid function to find the pyramid written for a czi, if there is one
+#   5. A stitch_boundaries function to stitch the segmentation borders of every fov into one slide sized mask, for
+#      slides segmented before the label store (label_store.py)
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+DEFAULT_CHUNK_SIZE = 1024 #Chunk size used when reading the czi lazily
+DEFAULT_CACHE_MB = 1024
+SMALLEST_LEVEL_SIZE = 2048 #Levels are added until the slide fits in this many pixels
+
+class ChunkCache:
+    #Least recently used cache of decoded chunks, bounded by the bytes it holds. Napari reads chunks from several
+    #threads so every access goes through a lock
+    def __init__(self, max_mb=DEFAULT_CACHE_MB):
+        self.max_bytes = max_mb * 2**20
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, read_chunk):
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return self._chunks[key]
+        with profile_span("decode chunk", category='viewer'):
+            chunk = read_chunk()
+            add_profiled_bytes(read=chunk.nbytes)
+        with self._lock:
+            self.misses += 1
+            if key not in self._chunks:
+                self._chunks[key] = chunk
+                self.nbytes += chunk.nbytes
+            while self.nbytes > self.max_bytes and len(self._chunks) > 1:
+                _, evicted = self._chunks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return chunk
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+
+#Dask chunks of a level of the given shape. Ex: get_chunks((2500, 1500), 1024) -> ((1024, 1024, 452), (1024, 476))
+def get_chunks(shape, chunk_size):
+    return tuple(tuple([chunk_size] * (length // chunk_size) + ([length % chunk_size] if length % chunk_size else []))
+                 for length in shape)
+
+#A lazy 2D array where every chunk is read with read_region(y0, y1, x0, x1) the first time it is shown, and then
+#kept in the cache under (key, y0, x0)
+def lazy_level(shape, chunk_size, dtype, read_region, cache, key):
+    def read_block(block_info=None):
+        (y0, y1), (x0, x1) = block_info[None]['array-location']
+        return cache.get((key, y0, x0), lambda: read_region(y0, y1, x0, x1))
+
+    return da.map_blocks(read_block, dtype=dtype, chunks=get_chunks(shape, chunk_size), meta=np.empty((0, 0), dtype=dtype))
+
+#Crops or zero pads a chunk to the expected shape, the czi can be a pixel off when it scales a region
+def fit_chunk(chunk, shape):
+    fitted = np.zeros(shape, dtype=chunk.dtype)
+    rows, cols = min(shape[0], chunk.shape[0]), min(shape[1], chunk.shape[1])
+    fitted[:rows, :cols] = chunk[:rows, :cols]
+    return fitted
+
+#Number of levels needed until the largest side fits in SMALLEST_LEVEL_SIZE
+def get_level_count(shape):
+    levels = 1
+    while max(shape) / 2**(levels - 1) > SMALLEST_LEVEL_SIZE:
+        levels += 1
+    return levels
+
+#Multiscale lazy arrays (largest first) of one channel of the czi. Each chunk is read with a region bounded, scaled
+#read_mosaic so only the visible region of the visible level is decoded
+def lazy_czi_pyramid(czi_file_path, channel, cache, chunk_size=DEFAULT_CHUNK_SIZE):
+    czi = aicspylibczi.CziFile(czi_file_path)
+    czi_lock = threading.Lock() #libCZI reads of a file are not done from several threads at once
+    mosaic_box = czi.get_mosaic_bounding_box()
+    full_shape = (mosaic_box.h, mosaic_box.w)
+    dtype = czi.read_mosaic(region=(mosaic_box.x, mosaic_box.y, 1, 1), scale_factor=1, C=channel).dtype
+
+    levels = []
+    for level in range(get_level_count(full_shape)):
+        scale = 2**level
+        shape = (-(-full_shape[0] // scale), -(-full_shape[1] // scale))
+
+        def read_region(y0, y1, x0, x1, scale=scale):
+            width = min((x1 - x0) * scale, full_shape[1] - x0 * scale)
+            height = min((y1 - y0) * scale, full_shape[0] - y0 * scale)
+            with czi_lock:
+                chunk = czi.read_mosaic(region=(mosaic_box.x + x0 * scale, mosaic_box.y + y0 * scale, width, height),
+                                        scale_factor=1 / scale, C=channel)[0]
+            return fit_chunk(chunk, (y1 - y0, x1 - x0))
+
+        levels.append(lazy_level(shape, chunk_size, dtype, read_region, cache, (str(czi_file_path), channel, level)))
+    return levels
+
+#Multiscale lazy arrays (largest first) of one channel of a pyramid written by tile_czi.py --pyramid. The chunks of
+#the lazy arrays match the zarr chunks, so each zarr chunk is decoded at most once while it stays in the cache
+def lazy_zarr_pyramid(pyramid_path, channel, cache):
+    root = zarr.open_group(str(pyramid_path), mode='r')
+    levels = []
+    for dataset in root.attrs['multiscales'][0]['datasets']:
+        level_array = root[dataset['path']]
+
+        def read_region(y0, y1, x0, x1, level_array=level_array):
+            return level_array[channel, y0:y1, x0:x1]
+
+        levels.append(lazy_level(level_array.shape[1:], level_array.chunks[1], level_array.dtype, read_region, cache,
+                                 (str(pyramid_path), channel, dataset['path'])))
+    return levels
+
+#Channel names stored in the pyramid, in the order of its channel axis
+def get_pyramid_channels(pyramid_path):
+    root = zarr.open_group(str(pyramid_path), mode='r')
+    return [channel['label'] for channel in root.attrs.get('omero', {}).get('channels', [])]
+
+#Looks for the pyramid tile_czi.py --pyramid wrote for a czi: first where the slide metadata says it is, then in the
+#<czi>_dir next to the czi. Returns None when the slide was tiled without one
+def find_pyramid(czi_file_path):
+    czi_file_path = Path(czi_file_path)
+    candidates = []
+    try:
+        pyramid = load_slide_metadata(czi_file_path.stem).get('pyramid')
+        if pyramid:
+            candidates.append(Path(pyramid['path']))
+    except (OSError, ValueError):
+        pass
+    candidates.append(Path(czi_file_path.parent, czi_file_path.stem + '_dir', czi_file_path.stem + '_pyramid.zarr'))
+
+    for candidate in candidates:
+        if candidate.is_dir():
+            return candidate
+    return None
+
+#Stitches the borders of every segmented fov (segmentation_borders_current-*.npy, saved by older versions of the
+#notebook) into one slide sized byte mask, 0 is the deadspace (transparent in a labels layer) and 1 is a boundary.
+#Empty tiles are never segmented, so the borders file only has the other fovs, in fov order. The size and overlap of
+#the fovs come from the tile geometry of the slide metadata
+def stitch_boundaries(boundaries_file_path, slide_metadata):
+    rows = slide_metadata['dims']['rows']
+    cols = slide_metadata['dims']['cols']
+    geometry = get_tile_geometry(slide_metadata)
+    tile_size = geometry['tile_size']
+    tile_step = tile_size - geometry['overlap']
+    empty_fovs = set(slide_metadata.get('empty_fovs', []))
+    segmented_fovs = [i for i in range(rows*cols) if 'fov' + str(i) not in empty_fovs]
+
+    #Memory mapped, so only the fov being stitched is read from disk at a time
+    borders = np.load(boundaries_file_path, mmap_mode='r').reshape(len(segmented_fovs), tile_size, tile_size)
+
+    bounds = np.zeros(geometry['padded_shape'], dtype=np.uint8)
+    for index, fov in enumerate(segmented_fovs):
+        i, j = divmod(fov, cols)
+        bounds[i*tile_step:i*tile_step + tile_size, j*tile_step:j*tile_step + tile_size] |= borders[index] > 0
+        add_profiled_bytes(read=borders[index].nbytes)
+    return bounds
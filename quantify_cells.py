@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: quantify_cells.py
+
+# GOAL: Create the cell tables of a segmented slide without ark: the same size normalized and arcsinh transformed
+#expression matrices as ark's marker_quantification.generate_cell_table. The size, centroid, shape and total intensity
+#of every channel of all the cells of a fov are computed at once with bincounts over the fov's labels, and the fovs are
+#quantified in parallel. Fovs without cells just add no rows
+
+# INPUT: 1 or more segmented slide directories (the czi_filename_dir), containing
+#input_data/single_channel_inputs/{fov}/TIFs/{channel}.tiff and the labels, from
+#single_cell_output/segmentation_labels-{cell_file_name}.zarr (label_store.py) or else deepcell_output/{fov}_feature_0.tif
+
+# OUTPUT: single_cell_output/cell_table_size_normalized-{cell_file_name} and
+#single_cell_output/cell_table_arcsinh_transformed-{cell_file_name} (.parquet or the --format chosen) in every slide
+#directory. Columns are cell_size, the channels, label, the regionprops columns (QUANTIFIED_PROPERTIES) and fov
+
+# usage: quantify_cells.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--workers WORKERS] [--channels CHANNELS]
+#                          [--format {parquet,feather,csv}] files [files ...]
+#
+# positional arguments:
+#   files          Input 1 or more segmented slide directories to quantify
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information while quantifying. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --workers WORKERS, -w WORKERS
+#                  Number of processes quantifying fovs at the same time. (Default is 1)
+#   --channels CHANNELS
+#                  Comma separated channels to quantify, in the order of the table columns. (Default is every channel
+#                  tiff of the first fov, sorted by name)
+#   --format {parquet,feather,csv}
+#                  Format of the cell tables. (Default is parquet)
+
+#################################################################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cell_table_io import CELL_TABLE_FORMATS, DEFAULT_CELL_TABLE_FORMAT, get_cell_table_path, write_cell_table
+from intensity_stats import ARCSINH_LINEAR_FACTOR
+from label_store import get_label_store_path, load_fov_labels
+from segmentation_utils import print_colored, cell_segment_parser, profile_span, add_profiled_bytes, profiler, enable_profiling
+from stitch_cell_data import get_cell_file_name
+
+import re
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+DEBUG = False
+
+#Properties of every cell besides its size, intensities and label, named like ark's regionprops columns. They only
+#need the moments of the cell's pixels, so they are computed for every cell at once
+QUANTIFIED_PROPERTIES = ['area', 'eccentricity', 'major_axis_length', 'minor_axis_length', 'equivalent_diameter',
+                         'centroid-0', 'centroid-1', 'major_minor_axis_ratio']
+
+def get_cell_table_columns(channels):
+    return ['cell_size'] + list(channels) + ['label'] + QUANTIFIED_PROPERTIES + ['fov']
+
+#Fovs of single_channel_inputs, in fov number order
+def get_fovs(tiff_dir):
+    return sorted((fov_dir.name for fov_dir in Path(tiff_dir).iterdir() if fov_dir.is_dir()),
+                  key=lambda fov: int(re.sub(r'\D', '', fov) or 0))
+
+def get_fov_channels(tiff_dir, fov, img_sub_folder="TIFs"):
+    return sorted(channel_path.stem for channel_path in Path(tiff_dir, fov, img_sub_folder).glob('*.tiff'))
+
+#Total intensity of every channel in every cell of a fov, with the cell size, label and the regionprops columns,
+#cells in label order like regionprops. images is one 2D image per channel. Only the pixels of cells are looked at,
+#and every per cell sum is one bincount over them
+def quantify_labels(labels, images, channels, fov):
+    pixels = np.flatnonzero(labels)
+    cell_labels = labels.ravel()[pixels].astype(np.int64)
+    bins = int(cell_labels.max()) + 1 if len(cell_labels) else 1
+    area = np.bincount(cell_labels, minlength=bins)
+    present = np.flatnonzero(area)
+    area = area[present]
+
+    def sum_per_cell(weights):
+        return np.bincount(cell_labels, weights=weights, minlength=bins)[present].astype(np.float64, copy=False)
+
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    rows, cols = rows.astype(np.float64), cols.astype(np.float64)
+    centroid_row = sum_per_cell(rows) / area
+    centroid_col = sum_per_cell(cols) / area
+
+    #Eigenvalues of the covariance of the pixel coordinates of every cell, the inertia tensor regionprops gets the
+    #axes and eccentricity from. The coordinates are taken from the centroid of their cell first, so small cells far
+    #from the origin do not lose precision
+    cell_index = np.zeros(bins, dtype=np.int64)
+    cell_index[present] = np.arange(len(present))
+    rows -= centroid_row[cell_index[cell_labels]]
+    cols -= centroid_col[cell_index[cell_labels]]
+    row_variance = sum_per_cell(rows * rows) / area
+    col_variance = sum_per_cell(cols * cols) / area
+    covariance = sum_per_cell(rows * cols) / area
+    half_trace = (row_variance + col_variance) / 2
+    spread = np.sqrt(((row_variance - col_variance) / 2) ** 2 + covariance ** 2)
+    major_eigenvalue = half_trace + spread
+    minor_eigenvalue = np.clip(half_trace - spread, 0, None)
+    major_axis_length = 4 * np.sqrt(np.clip(major_eigenvalue, 0, None))
+    minor_axis_length = 4 * np.sqrt(minor_eigenvalue)
+
+    counts = {'cell_size': area}
+    for channel, image in zip(channels, images):
+        counts[channel] = sum_per_cell(image.ravel()[pixels].astype(np.float64))
+    counts['label'] = present
+    counts['area'] = area
+    counts['eccentricity'] = np.sqrt(1 - np.divide(minor_eigenvalue, major_eigenvalue, out=np.ones(len(area)),
+                                                   where=major_eigenvalue > 0))
+    counts['major_axis_length'] = major_axis_length
+    counts['minor_axis_length'] = minor_axis_length
+    counts['equivalent_diameter'] = np.sqrt(4 * area / np.pi)
+    counts['centroid-0'] = centroid_row
+    counts['centroid-1'] = centroid_col
+    counts['major_minor_axis_ratio'] = np.divide(major_axis_length, minor_axis_length, out=np.full(len(area), np.nan),
+                                                 where=minor_axis_length > 0)
+    counts['fov'] = fov
+    return pd.DataFrame(counts, columns=get_cell_table_columns(channels))
+
+#Runs in a worker process. The spans it profiled are handed back with the result
+def quantify_fov(work_item):
+    fov = work_item['fov']
+    with profile_span("quantify fov", category='quantify', fov=fov):
+        labels = load_fov_labels(fov, work_item['segmentation_dir'], work_item['label_store'])
+        if labels is None or not labels.any():
+            if DEBUG: print(f"DEBUG: {fov} has no cells")
+            counts = quantify_labels(np.zeros((1, 1), dtype=np.int32), [np.zeros((1, 1))] * len(work_item['channels']),
+                                     work_item['channels'], fov)
+        else:
+            images = [tifffile.imread(Path(work_item['tiff_dir'], fov, work_item['img_sub_folder'], channel + ".tiff"))
+                      for channel in work_item['channels']]
+            add_profiled_bytes(read=labels.nbytes + sum(image.nbytes for image in images))
+            counts = quantify_labels(labels, images, work_item['channels'], fov)
+    return counts, profiler.take_events()
+
+#Size normalized (total intensity / cell size) and arcsinh transformed (arcsinh(ARCSINH_LINEAR_FACTOR * size normalized))
+#tables of the counts, like ark's
+def transform_counts(counts, channels):
+    size_normalized = counts.copy()
+    cell_size = size_normalized['cell_size'].to_numpy(dtype=np.float64)
+    for channel in channels:
+        size_normalized[channel] = np.divide(counts[channel].to_numpy(dtype=np.float64), cell_size,
+                                             out=np.zeros(len(counts)), where=cell_size > 0)
+    arcsinh_transformed = size_normalized.copy()
+    for channel in channels:
+        arcsinh_transformed[channel] = np.arcsinh(size_normalized[channel].to_numpy() * ARCSINH_LINEAR_FACTOR)
+    return size_normalized, arcsinh_transformed
+
+#Drop in for ark's marker_quantification.generate_cell_table: the size normalized and arcsinh transformed cell tables
+#of every fov, workers fovs at a time. The labels come from the label store when one is given
+def generate_cell_table(segmentation_dir, tiff_dir, fovs, channels=None, img_sub_folder="TIFs", label_store_path=None,
+                        workers=1):
+    channels = list(channels) if channels is not None else get_fov_channels(tiff_dir, fovs[0], img_sub_folder)
+    work_items = [{'fov': fov, 'segmentation_dir': segmentation_dir, 'label_store': label_store_path, 'tiff_dir': tiff_dir,
+                   'img_sub_folder': img_sub_folder, 'channels': channels} for fov in fovs]
+
+    tables = []
+    with profile_span("quantify cells", category='quantify', fovs=len(fovs)):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for counts, trace_events in executor.map(quantify_fov, work_items):
+                profiler.add_events(trace_events)
+                tables.append(counts)
+        counts = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=get_cell_table_columns(channels))
+    if DEBUG: print(f"DEBUG: Quantified {len(counts)} cells of {len(fovs)} fovs")
+    return transform_counts(counts, channels)
+
+#Quantifies a slide directory and writes its size normalized and arcsinh transformed cell tables. Returns their paths
+def quantify_slide(segmented_cell_dir, channels=None, workers=1, cell_table_format=DEFAULT_CELL_TABLE_FORMAT, fovs=None):
+    cell_file_name = get_cell_file_name(segmented_cell_dir)
+    tiff_dir = Path(segmented_cell_dir, "input_data", "single_channel_inputs")
+    single_cell_dir = Path(segmented_cell_dir, "single_cell_output")
+    label_store_path = get_label_store_path(single_cell_dir, cell_file_name)
+
+    tables = generate_cell_table(Path(segmented_cell_dir, "deepcell_output"), tiff_dir, fovs or get_fovs(tiff_dir), channels,
+                                 label_store_path=label_store_path if label_store_path.exists() else None, workers=workers)
+
+    single_cell_dir.mkdir(exist_ok=True)
+    table_paths = []
+    for name, table in zip(('cell_table_size_normalized', 'cell_table_arcsinh_transformed'), tables):
+        table_path = get_cell_table_path(single_cell_dir, f"{name}-{cell_file_name}", cell_table_format)
+        write_cell_table(table, table_path, index=False)
+        table_paths.append(table_path)
+        print_colored("green", f"Created {table_path} with {len(table)} cells")
+    return table_paths
+
+def split_channels(channels):
+    return [channel for channel in channels.replace(" ", "").split(',') if channel]
+
+if __name__ == "__main__":
+    cell_segment_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=1,
+                        help="Number of processes quantifying fovs at the same time (Default is 1)")
+    cell_segment_parser.add_argument("--channels", dest='channels', action="store", type=split_channels, default=None,
+                        help="Comma separated channels to quantify (Default is every channel tiff of the first fov)")
+    cell_segment_parser.add_argument("--format", dest='cell_table_format', action="store", choices=list(CELL_TABLE_FORMATS),
+                        default=DEFAULT_CELL_TABLE_FORMAT, help=f"Format of the cell tables (Default is {DEFAULT_CELL_TABLE_FORMAT})")
+
+    cell_segment_parser_args = cell_segment_parser.parse_args()
+
+    if cell_segment_parser_args.debug:
+        DEBUG = True
+    enable_profiling(cell_segment_parser_args)
+
+    for segmented_cell_dir in cell_segment_parser_args.files:
+        quantify_slide(segmented_cell_dir, cell_segment_parser_args.channels, cell_segment_parser_args.workers,
+                       cell_segment_parser_args.cell_table_format)
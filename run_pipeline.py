@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: run_pipeline.py
+
+# GOAL: Run every step of the segmentation of a slide without jupyter or moving directories by hand: tiling (straight
+#into the deepcell layout), segmentation, quantification, stitching and the stitched overlay. Every stage is checkpointed under a hash
+#of its inputs and parameters, so running the same command again only reruns what changed or failed
+
+# INPUT: 1 or more czi files
+
+# OUTPUT: A {czi_filename}_dir per czi in --output-dir, laid out like the ark-analysis data directory the viewer
+#expects (single_cell_output/ has the cell tables and the segmentation label store). Checkpoints go in
+#--output-dir/.pipeline/{czi_filename}/
+
+#Stages (each runs after the stages it depends on):
+#   tile      czi -> fov tiffs, deepcell inputs and tile_metadata.txt (tile_czi.py)
+#   segment   nuclear/membrane inputs -> whole cell and nuclear labels (segmentation_backends.py) and the label store (label_store.py)
+#   quantify  label store + channel tiffs -> size normalized and arcsinh cell tables (quantify_cells.py)
+#   stitch    cell table -> stitched cell table                      (stitch_cell_data.py)
+#   overlay   label store + deepcell input -> stitched overlay tiff   (generate_stitched_overlay.py)
+
+# usage: run_pipeline.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--output-dir OUTPUT_DIR] [--slides-parallel SLIDES_PARALLEL] [--workers WORKERS]
+#                        [--channels CHANNELS] [--nucs NUCS] [--mems MEMS] [--tile-size TILE_SIZE] [--overlap OVERLAP]
+#                        [--segmentation {threshold,mesmer,deepcell}] [--model-path MODEL_PATH] [--image-mpp IMAGE_MPP] [--scale SCALE] [--format {parquet,feather,csv}]
+#                        [--until STAGE] [--force STAGE [STAGE ...]] files [files ...]
+#
+# positional arguments:
+#   files          Input 1 or more CZI File Paths to run the pipeline on
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information while running. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --output-dir OUTPUT_DIR, -o OUTPUT_DIR
+#                  Where the slide directories are created. (Default is the current directory)
+#   --slides-parallel SLIDES_PARALLEL, -p SLIDES_PARALLEL
+#                  Number of slides run at the same time, each in its own process. (Default is 1)
+#   --workers WORKERS, -w WORKERS
+#                  Number of processes used inside the stages of a slide that run in parallel. (Default is 1)
+#   --channels CHANNELS
+#                  Comma separated channels of the czi, in order. (Default is the tile_czi.py default)
+#   --nucs NUCS    Comma separated nuclear channels summed for segmentation. (Default is the tile_czi.py default)
+#   --mems MEMS    Comma separated membrane channels summed for segmentation. (Default is the tile_czi.py default)
+#   --tile-size TILE_SIZE
+#                  Size in pixels of the square tiles, or auto to pick it from the memory available and --workers.
+#                  (Default is 2048)
+#   --overlap OVERLAP
+#                  Pixels neighbouring tiles overlap by. Cells on a seam are segmented whole and stitched once.
+#                  (Default is 0)
+#   --segmentation {threshold,mesmer,deepcell}
+#                  Segmentation backend. threshold runs offline with no model, mesmer runs a local Mesmer model and
+#                  deepcell uploads to deepcell.org. (Default is threshold)
+#   --model-path MODEL_PATH
+#                  Saved Mesmer model for the mesmer backend. (Default downloads the deepcell model)
+#   --image-mpp IMAGE_MPP
+#                  Microns per pixel of the slide for the mesmer backend. (Default is 0.5)
+#   --scale SCALE  Rescale factor for the deepcell backend. (Default is 1.0)
+#   --format {parquet,feather,csv}
+#                  Format of the cell tables. (Default is parquet)
+#   --until STAGE  Stop after this stage. (Default runs every stage)
+#   --force STAGE [STAGE ...]
+#                  Rerun these stages (and so the stages after them) even if their checkpoint is up to date. 'all'
+#                  reruns everything
+
+#################################################################################################################
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime as dt
+from pathlib import Path
+
+from cell_table_io import CELL_TABLE_FORMATS, DEFAULT_CELL_TABLE_FORMAT, get_cell_table_path, write_cell_table
+from generate_stitched_overlay import generate_slide_overlay
+from intensity_stats import get_intensity_histograms_path, get_intensity_stats_path
+from label_store import get_label_store_path, write_label_store
+from quantify_cells import generate_cell_table
+from segmentation_backends import SEGMENTATION_BACKENDS, DEFAULT_SEGMENTATION_BACKEND, DEFAULT_IMAGE_MPP
+from segmentation_utils import print_colored, pipeline_parser, get_peak_rss_mb, get_slide_metadata_path, profile_span, profiler, \
+    enable_profiling
+from stitch_cell_data import stich_cell_data
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import traceback
+
+import tile_czi
+
+DEBUG = False
+
+CHECKPOINT_DIR = '.pipeline'
+HASH_BLOCK_BYTES = 2**24 #Files are hashed this many bytes at a time
+
+#Paths of everything a slide's stages read and write
+def get_slide(czi_file_path, output_dir):
+    czi_file_path = Path(czi_file_path).resolve()
+    slide_dir = Path(output_dir, czi_file_path.stem + '_dir')
+    input_dir = Path(slide_dir, "input_data")
+    return {
+        'czi': czi_file_path,
+        'name': czi_file_path.stem,
+        'dir': slide_dir,
+        'tile_metadata': Path(slide_dir, "tile_metadata.txt"),
+        'tiff_dir': Path(input_dir, "single_channel_inputs"),
+        'deepcell_input_dir': Path(input_dir, "deepcell_input"),
+        'deepcell_output_dir': Path(slide_dir, "deepcell_output"),
+        'single_cell_dir': Path(slide_dir, "single_cell_output"),
+        'checkpoint_dir': Path(output_dir, CHECKPOINT_DIR, czi_file_path.stem),
+    }
+
+#Fovs that made it into single_channel_inputs (empty tiles did not), in fov number order
+def get_segmented_fovs(slide):
+    return sorted((fov_dir.name for fov_dir in slide['tiff_dir'].iterdir() if fov_dir.is_dir()),
+                  key=lambda fov: int(re.sub(r'\D', '', fov)))
+
+#sha256 of a file. Hashes are cached by path, size and modification time, so a czi is only read once
+def hash_file(file_path, hash_cache):
+    stat = Path(file_path).stat()
+    cache_key = f"{Path(file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    if cache_key not in hash_cache:
+        file_hash = hashlib.sha256()
+        with open(file_path, 'rb') as file_to_hash:
+            for block in iter(lambda: file_to_hash.read(HASH_BLOCK_BYTES), b''):
+                file_hash.update(block)
+        hash_cache[cache_key] = file_hash.hexdigest()
+    return hash_cache[cache_key]
+
+def hash_values(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+#Tile size the slide is tiled with. --tile-size auto is picked here for this machine's memory and --workers, so the
+#tile stage is hashed with the tile size it really uses and a tiling made at another tile size is never reused
+def get_tile_size(slide, options):
+    if options['tile_size'] != tile_czi.AUTO_TILE_SIZE:
+        return options['tile_size']
+    return tile_czi.pick_tile_size(tile_czi.CziFile(slide['czi']), options['workers'], overlap=options['overlap'])
+
+# Stages. Each takes the slide and the options and returns the paths it wrote, relative to the slide directory
+#(or absolute when outside of it)
+
+def run_tile(slide, options):
+    #Everything in the slide directory comes from the tiles, so a new tiling starts from an empty directory
+    if slide['dir'].exists():
+        shutil.rmtree(slide['dir'])
+    nuclear_channel = options['nucs'][0] if options['nucs'] and options['nucs'][0] in options['channels'] else None
+    tile_czi.tile_czi_file([slide['czi']], options['channels'], workers=options['workers'],
+                           nuclear_channel=nuclear_channel, output_dir=slide['dir'].parent,
+                           nucs=options['nucs'], mems=options['mems'], overlap=options['overlap'],
+                           tile_size=options['tile_size'])
+    #The slide metadata and intensity stats are written to final_data/, outside of the slide directory
+    return ["tile_metadata.txt", "input_data/single_channel_inputs", "input_data/deepcell_input", "deepcell_output",
+            get_slide_metadata_path(slide['name']), get_intensity_stats_path(slide['name']),
+            get_intensity_histograms_path(slide['name'])]
+
+def run_segment(slide, options):
+    fovs = get_segmented_fovs(slide)
+    SEGMENTATION_BACKENDS[options['segmentation']](slide['deepcell_input_dir'], slide['deepcell_output_dir'], fovs,
+                                                   model_path=options['model_path'], image_mpp=options['image_mpp'],
+                                                   scale=options['scale'])
+
+    #Labels of every fov in one compressed store, for the viewer's --bounds and the overlay. Borders are derived from it
+    slide['single_cell_dir'].mkdir(exist_ok=True)
+    label_store_path = get_label_store_path(slide['single_cell_dir'], slide['name'])
+    write_label_store(label_store_path, slide['deepcell_output_dir'], slide['tile_metadata'], options['workers'])
+    return ["deepcell_output", label_store_path.relative_to(slide['dir'])]
+
+def run_quantify(slide, options):
+    label_store_path = get_label_store_path(slide['single_cell_dir'], slide['name'])
+    tables = generate_cell_table(slide['deepcell_output_dir'], slide['tiff_dir'], get_segmented_fovs(slide), options['channels'],
+                                 label_store_path=label_store_path, workers=options['workers'])
+
+    outputs = []
+    for name, table in zip(('cell_table_size_normalized', 'cell_table_arcsinh_transformed'), tables):
+        table_path = get_cell_table_path(slide['single_cell_dir'], f"{name}-{slide['name']}", options['format'])
+        write_cell_table(table, table_path, index=False)
+        outputs.append(table_path.relative_to(slide['dir']))
+    return outputs
+
+def run_stitch(slide, options):
+    stich_cell_data(slide['dir'], slide['name'], cell_table_format=options['format'])
+    return [get_cell_table_path(slide['single_cell_dir'], f"cell_table_arcsinh_transformed_stitched-{slide['name']}",
+                                options['format']).relative_to(slide['dir'])]
+
+def run_overlay(slide, options):
+    generate_slide_overlay(slide['dir'], options['workers'])
+    return [f"final_overlay-{slide['name']}.tiff"]
+
+#The DAG of stages in an order where every stage comes after the stages it depends on. params are the options that
+#change what a stage writes, they are part of its checkpoint hash
+PIPELINE_STAGES = {
+    'tile': {'deps': [], 'run': run_tile, 'params': ['channels', 'nucs', 'mems', 'tile_size', 'overlap']},
+    'segment': {'deps': ['tile'], 'run': run_segment, 'params': ['segmentation', 'model_path', 'image_mpp', 'scale']},
+    'quantify': {'deps': ['segment'], 'run': run_quantify, 'params': ['channels', 'format']},
+    'stitch': {'deps': ['quantify'], 'run': run_stitch, 'params': ['format']},
+    'overlay': {'deps': ['segment'], 'run': run_overlay, 'params': []},
+}
+
+def get_stages_to_run(until=None):
+    stages = list(PIPELINE_STAGES)
+    if until is None:
+        return stages
+    #Only until and what it depends on
+    needed = {until}
+    for stage in reversed(stages):
+        if stage in needed:
+            needed.update(PIPELINE_STAGES[stage]['deps'])
+    return [stage for stage in stages if stage in needed]
+
+def read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+
+#A stage is up to date when its checkpoint has the same hash and everything it wrote is still there
+def is_up_to_date(checkpoint, key, slide):
+    return (checkpoint is not None and checkpoint['key'] == key and
+            all(Path(slide['dir'], output).exists() for output in checkpoint['outputs']))
+
+#Runs the stages of one slide in order, skipping the ones that are up to date. Returns what was done for each stage
+def run_slide(czi_file_path, options):
+    slide = get_slide(czi_file_path, options['output_dir'])
+    slide['checkpoint_dir'].mkdir(parents=True, exist_ok=True)
+    hash_cache_path = Path(slide['checkpoint_dir'], "file_hashes.json")
+    hash_cache = read_checkpoint(hash_cache_path) or {}
+    options = dict(options, tile_size=get_tile_size(slide, options))
+
+    keys = {}
+    ran = set()
+    summary = {}
+    for stage in get_stages_to_run(options['until']):
+        stage_info = PIPELINE_STAGES[stage]
+        inputs = [keys[dep] for dep in stage_info['deps']] or [hash_file(slide['czi'], hash_cache)]
+        keys[stage] = hash_values(stage, {param: options[param] for param in stage_info['params']}, inputs)
+
+        #Stages after a stage that ran are rerun too, the outputs they read were just rewritten
+        checkpoint_path = Path(slide['checkpoint_dir'], stage + ".json")
+        forced = 'all' in options['force'] or stage in options['force'] or any(dep in ran for dep in stage_info['deps'])
+        if not forced and is_up_to_date(read_checkpoint(checkpoint_path), keys[stage], slide):
+            print_colored("cyan", f"{slide['name']}: {stage} is up to date")
+            summary[stage] = 'skipped'
+            continue
+
+        #A stage that fails leaves no checkpoint, so the next run starts it again
+        if checkpoint_path.exists():
+            os.remove(checkpoint_path)
+        print_colored("cyan", f"{slide['name']}: running {stage}")
+        start = time.perf_counter()
+        with profile_span(stage, category='pipeline', slide=slide['name']):
+            outputs = stage_info['run'](slide, options)
+        seconds = time.perf_counter() - start
+
+        with open(checkpoint_path, "w") as checkpoint_file:
+            json.dump({
+                'stage': stage,
+                'key': keys[stage],
+                'inputs': inputs,
+                'params': {param: options[param] for param in stage_info['params']},
+                'outputs': [str(output) for output in outputs],
+                'seconds': round(seconds, 3),
+                'finished': dt.now().isoformat(timespec='seconds'),
+            }, checkpoint_file, indent=4)
+        with open(hash_cache_path, "w") as hash_cache_file:
+            json.dump(hash_cache, hash_cache_file, indent=4)
+        if DEBUG: print(f"DEBUG: {slide['name']}: {stage} took {seconds:.1f}s, peak memory {get_peak_rss_mb():.0f} MB")
+        ran.add(stage)
+        summary[stage] = f"ran in {seconds:.1f}s"
+    return summary
+
+#Runs in a worker process. The spans it profiled are handed back with the result
+def run_slide_safely(czi_file_path, options):
+    try:
+        return run_slide(czi_file_path, options), None, profiler.take_events()
+    except Exception:
+        return None, traceback.format_exc(), profiler.take_events()
+
+#Runs every slide, up to slides_parallel at once. A slide that fails does not stop the others
+def run_pipeline(czi_file_paths, options, slides_parallel=1):
+    Path(options['output_dir']).mkdir(parents=True, exist_ok=True)
+    failed = []
+    with ProcessPoolExecutor(max_workers=slides_parallel) as executor:
+        futures = {executor.submit(run_slide_safely, czi_file_path, options): czi_file_path for czi_file_path in czi_file_paths}
+        for future in as_completed(futures):
+            summary, error, trace_events = future.result()
+            profiler.add_events(trace_events)
+            name = Path(futures[future]).name
+            if error is not None:
+                failed.append(name)
+                print_colored("red", f"{name} failed:\n{error}")
+            else:
+                print_colored("green", f"{name} done: " + ", ".join(f"{stage} {result}" for stage, result in summary.items()))
+    return failed
+
+def split_channels(channels):
+    return [channel for channel in channels.replace(" ", "").split(',') if channel]
+
+if __name__ == "__main__":
+    pipeline_parser.add_argument("--output-dir", "-o", dest='output_dir', action="store", type=Path, default=Path(os.path.curdir),
+                        help="Where the slide directories are created (Default is the current directory)")
+    pipeline_parser.add_argument("--slides-parallel", "-p", dest='slides_parallel', action="store", type=int, default=1,
+                        help="Number of slides run at the same time (Default is 1)")
+    pipeline_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=1,
+                        help="Number of processes used inside the stages of a slide (Default is 1)")
+    pipeline_parser.add_argument("--channels", dest='channels', action="store", type=split_channels,
+                        default=tile_czi.channels_to_use, help="Comma separated channels of the czi, in order")
+    pipeline_parser.add_argument("--nucs", dest='nucs', action="store", type=split_channels, default=tile_czi.DEFAULT_NUCS,
+                        help=f"Comma separated nuclear channels (Default is {','.join(tile_czi.DEFAULT_NUCS)})")
+    pipeline_parser.add_argument("--mems", dest='mems', action="store", type=split_channels, default=tile_czi.DEFAULT_MEMS,
+                        help=f"Comma separated membrane channels (Default is {','.join(tile_czi.DEFAULT_MEMS)})")
+    pipeline_parser.add_argument("--tile-size", dest='tile_size', action="store",
+                        type=lambda tile_size: tile_size if tile_size == tile_czi.AUTO_TILE_SIZE else int(tile_size),
+                        default=tile_czi.DEFAULT_TILE_SIZE,
+                        help=f"Size of the tiles, or {tile_czi.AUTO_TILE_SIZE} to pick it from the memory (Default is {tile_czi.DEFAULT_TILE_SIZE})")
+    pipeline_parser.add_argument("--overlap", dest='overlap', action="store", type=int, default=tile_czi.DEFAULT_OVERLAP,
+                        help=f"Pixels neighbouring tiles overlap by (Default is {tile_czi.DEFAULT_OVERLAP})")
+    pipeline_parser.add_argument("--segmentation", dest='segmentation', action="store", choices=list(SEGMENTATION_BACKENDS),
+                        default=DEFAULT_SEGMENTATION_BACKEND,
+                        help=f"Segmentation backend (Default is {DEFAULT_SEGMENTATION_BACKEND}, which runs offline)")
+    pipeline_parser.add_argument("--model-path", dest='model_path', action="store", type=Path, default=None,
+                        help="Saved Mesmer model for the mesmer backend")
+    pipeline_parser.add_argument("--image-mpp", dest='image_mpp', action="store", type=float, default=DEFAULT_IMAGE_MPP,
+                        help=f"Microns per pixel of the slide for the mesmer backend (Default is {DEFAULT_IMAGE_MPP})")
+    pipeline_parser.add_argument("--scale", dest='scale', action="store", type=float, default=1.0,
+                        help="Rescale factor for the deepcell backend (Default is 1.0)")
+    pipeline_parser.add_argument("--format", dest='format', action="store", choices=list(CELL_TABLE_FORMATS),
+                        default=DEFAULT_CELL_TABLE_FORMAT, help=f"Format of the cell tables (Default is {DEFAULT_CELL_TABLE_FORMAT})")
+    pipeline_parser.add_argument("--until", dest='until', action="store", choices=list(PIPELINE_STAGES), default=None,
+                        help="Stop after this stage")
+    pipeline_parser.add_argument("--force", dest='force', action="store", nargs='+', choices=list(PIPELINE_STAGES) + ['all'],
+                        default=[], help="Rerun these stages even if they are up to date")
+
+    pipeline_parser_args = pipeline_parser.parse_args()
+
+    if pipeline_parser_args.debug:
+        DEBUG = True
+    enable_profiling(pipeline_parser_args)
+
+    options = {
+        'output_dir': pipeline_parser_args.output_dir.resolve(),
+        'workers': pipeline_parser_args.workers,
+        'channels': pipeline_parser_args.channels,
+        'nucs': pipeline_parser_args.nucs,
+        'mems': pipeline_parser_args.mems,
+        'tile_size': pipeline_parser_args.tile_size,
+        'overlap': pipeline_parser_args.overlap,
+        'segmentation': pipeline_parser_args.segmentation,
+        'model_path': pipeline_parser_args.model_path,
+        'image_mpp': pipeline_parser_args.image_mpp,
+        'scale': pipeline_parser_args.scale,
+        'format': pipeline_parser_args.format,
+        'until': pipeline_parser_args.until,
+        'force': pipeline_parser_args.force,
+    }
+
+    failed = run_pipeline(pipeline_parser_args.files, options, pipeline_parser_args.slides_parallel)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,70 @@
+from pathlib import Path
+from skimage.filters import threshold_otsu
+from skimage.measure import label
+from skimage.morphology import remove_small_objects
+from skimage.segmentation import expand_labels
+
+import numpy as np
+import tifffile
+
+#Segmentation backends used by run_pipeline.py. Every backend reads the deepcell input of each fov
+#(deepcell_input/{fov}.tif, nuclear and membrane channels first) and writes what deepcell.org would:
+#deepcell_output/{fov}_feature_0.tif (whole cell labels) and deepcell_output/{fov}_feature_1.tif (nuclear labels)
+#(tile_czi.py writes the deepcell input while tiling)
+# Includes
+#   1. A local threshold backend that needs nothing but scikit-image. It is a stand-in to run the pipeline offline
+#   2. A mesmer backend that runs a local copy of the Mesmer model (needs the deepcell package)
+#   3. A deepcell backend that uploads to deepcell.org through ark-analysis, like the notebook does
+#   4. SEGMENTATION_BACKENDS, the backends by name
+
+DEFAULT_MIN_NUCLEUS_SIZE = 20 #Pixels. Smaller objects of the threshold backend are noise
+DEFAULT_CELL_EXPANSION = 5 #Pixels the nuclei of the threshold backend are grown by to get the whole cells
+DEFAULT_IMAGE_MPP = 0.5 #Microns per pixel Mesmer was trained at
+
+def load_deepcell_input(deepcell_input_dir, fov):
+    return tifffile.imread(Path(deepcell_input_dir, fov + '.tif'))
+
+def write_deepcell_output(deepcell_output_dir, fov, whole_cell_labels, nuclear_labels):
+    tifffile.imwrite(Path(deepcell_output_dir, fov + '_feature_0.tif'), whole_cell_labels.astype(np.int32))
+    tifffile.imwrite(Path(deepcell_output_dir, fov + '_feature_1.tif'), nuclear_labels.astype(np.int32))
+
+#Nuclei are the connected regions of the nuclear channel above its Otsu threshold, and the whole cells are the nuclei
+#grown by a few pixels. Not a replacement for Mesmer, but enough to run and time the rest of the pipeline offline
+def segment_threshold(deepcell_input_dir, deepcell_output_dir, fovs, min_nucleus_size=DEFAULT_MIN_NUCLEUS_SIZE,
+                      cell_expansion=DEFAULT_CELL_EXPANSION, **kwargs):
+    for fov in fovs:
+        nuclear = load_deepcell_input(deepcell_input_dir, fov)[0]
+        nuclear_labels = np.zeros(nuclear.shape, dtype=np.int32)
+        if np.any(nuclear > 0) and nuclear.min() != nuclear.max():
+            foreground = remove_small_objects(nuclear > threshold_otsu(nuclear), min_nucleus_size)
+            nuclear_labels = label(foreground).astype(np.int32)
+        write_deepcell_output(deepcell_output_dir, fov, expand_labels(nuclear_labels, cell_expansion), nuclear_labels)
+
+#Runs Mesmer on this machine. model_path is a saved keras model for machines without access to the deepcell
+#model download
+def segment_mesmer(deepcell_input_dir, deepcell_output_dir, fovs, model_path=None, image_mpp=DEFAULT_IMAGE_MPP, **kwargs):
+    from deepcell.applications import Mesmer
+
+    if model_path is not None:
+        import tensorflow as tf
+        app = Mesmer(model=tf.keras.models.load_model(model_path, compile=False))
+    else:
+        app = Mesmer()
+
+    for fov in fovs:
+        image = np.moveaxis(load_deepcell_input(deepcell_input_dir, fov), 0, -1)[np.newaxis].astype(np.float32)
+        labels = app.predict(image, image_mpp=image_mpp, compartment='both')
+        write_deepcell_output(deepcell_output_dir, fov, labels[0, ..., 0], labels[0, ..., 1])
+
+#Uploads the deepcell input to deepcell.org and downloads the labels, exactly like the notebook
+def segment_deepcell(deepcell_input_dir, deepcell_output_dir, fovs, scale=1.0, **kwargs):
+    from ark.utils import deepcell_service_utils
+
+    deepcell_service_utils.create_deepcell_output(str(deepcell_input_dir), str(deepcell_output_dir), fovs=fovs, scale=scale)
+
+SEGMENTATION_BACKENDS = {
+    'threshold': segment_threshold,
+    'mesmer': segment_mesmer,
+    'deepcell': segment_deepcell,
+}
+DEFAULT_SEGMENTATION_BACKEND = 'threshold'
@@ -1,10 +1,31 @@
+from contextlib import contextmanager
+
 import argparse
+import atexit
+import csv
+import json
+import os
 import pathlib
+import resource
+import sys
+import threading
+import time
 
 #Useful utilities for segmentation folder
 # Includes
-#   1. Argparser for taking different command line arguments
+#   1. Argparsers for taking different command line arguments (scripts, viewer, pipeline, gating and benchmarks)
 #   2. A print_colored function to print in color to help readability and debug
+#   3. A get_peak_rss_mb function to report the peak memory used by the running script
+#   4. A load_tile_metadata function to read the tile_metadata.txt written by tile_czi.py, and get_tile_cores to get
+#      the part of the slide every tile keeps its cells from when tiles overlap
+#   5. A load_slide_metadata function to read the final_data/.{czi_filename}_metadata.json written by tile_czi.py, and
+#      get_tile_geometry to get the tile size, overlap, padding and extent of the slide from it
+#   6. A Profiler shared by every script (the --profile and --trace-out flags of every parser). Named timing spans
+#      with the bytes read and written inside them and the peak memory when they end, written as a Chrome trace
+#      (chrome://tracing or https://ui.perfetto.dev) and summed per span name
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+LEGACY_TILE_SIZE = 2048 #Tile size of every slide tiled before the tile geometry was recorded in the slide metadata
 
 cell_segment_parser = argparse.ArgumentParser(description='Process some integers.')
 cell_segment_parser.add_argument(
@@ -58,6 +79,171 @@ def print_colored(output_color, *args):
     print(*args)
     print(colors.RESET, end='')
 
+def get_peak_rss_mb(children=False):
+    #Peak resident memory of this process so far in MB. ru_maxrss is in KB on linux but in bytes on mac
+    #With children=True it is the peak of the largest child process that has finished (Ex: pool workers)
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 2**20
+    return peak_rss / 2**10
+
+def load_tile_metadata(tile_metadata_path):
+    #Rows of tile_metadata.txt as dicts (fov, x1, x2, y1, y2, ...) with 'empty' as a bool.
+    #Tiles from before empty tile detection was added are never empty
+    with open(tile_metadata_path, newline='') as tile_metadata_file:
+        tiles = list(csv.DictReader(tile_metadata_file))
+    for tile in tiles:
+        tile['empty'] = tile.get('empty', '0') == '1'
+    return tiles
+
+def get_axis_cores(extents):
+    #Core of every tile along one axis from the (start, end) of the tiles, by start. The overlap of two neighbouring
+    #tiles is split in the middle, and the first and last cores go on forever
+    extents = sorted(set(extents))
+    cuts = [(next_start + end) / 2 for (_, end), (next_start, _) in zip(extents, extents[1:])]
+    bounds = [-float('inf')] + cuts + [float('inf')]
+    return {start: (bounds[index], bounds[index + 1]) for index, (start, _) in enumerate(extents)}
+
+def get_tile_cores(tiles):
+    #Core of every tile of tile_metadata.txt as (x1, x2, y1, y2) in slide coordinates, by fov. Cells whose centroid is
+    #in the core of their fov are kept, so a cell seen by two overlapping tiles (tile_czi.py --overlap) is only kept
+    #once. Without overlap the cores are the tiles themselves and every cell is kept
+    row_cores = get_axis_cores((int(tile['x1']), int(tile['x2'])) for tile in tiles)
+    col_cores = get_axis_cores((int(tile['y1']), int(tile['y2'])) for tile in tiles)
+    return {tile['fov']: row_cores[int(tile['x1'])] + col_cores[int(tile['y1'])] for tile in tiles}
+
+def get_slide_metadata_path(slide_name):
+    return pathlib.Path(CURRENT_DIR, 'final_data', f'.{slide_name}_metadata.json')
+
+def load_slide_metadata(slide_name):
+    #Dims (rows and cols of tiles), empty fovs and the other tiling information of a slide, by the stem of its czi
+    with open(get_slide_metadata_path(slide_name), 'rb') as slide_metadata_file:
+        return json.load(slide_metadata_file)
+
+def get_tile_geometry(slide_metadata):
+    #Tile size, overlap, padding ('zeros'), mosaic origin, slide shape and padded shape (rows, cols of the tiles put
+    #together) of a slide, from the tile_geometry tile_czi.py records in its metadata. Slides tiled before it was
+    #recorded have LEGACY_TILE_SIZE tiles, and their mosaic origin and slide shape are unknown (None)
+    if 'tile_geometry' in slide_metadata:
+        return slide_metadata['tile_geometry']
+    tile_size, overlap = LEGACY_TILE_SIZE, slide_metadata.get('overlap', 0)
+    rows, cols = slide_metadata['dims']['rows'], slide_metadata['dims']['cols']
+    return {'tile_size': tile_size, 'overlap': overlap, 'padding': 'zeros', 'mosaic_origin': None, 'slide_shape': None,
+            'padded_shape': [(rows - 1) * (tile_size - overlap) + tile_size, (cols - 1) * (tile_size - overlap) + tile_size]}
+
+class Profiler:
+    #Spans are only recorded once enabled, until then span() does nothing. Spans can be nested and opened from any
+    #thread, the bytes of a span are added to the span around it when it ends
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _open_spans(self):
+        if not hasattr(self._local, 'spans'):
+            self._local.spans = []
+        return self._local.spans
+
+    @contextmanager
+    def span(self, name, category='segmentation', **args):
+        if not self.enabled:
+            yield
+            return
+        open_span = {'bytes_read': 0, 'bytes_written': 0}
+        spans = self._open_spans()
+        spans.append(open_span)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            spans.pop()
+            if spans:
+                spans[-1]['bytes_read'] += open_span['bytes_read']
+                spans[-1]['bytes_written'] += open_span['bytes_written']
+            peak_rss_mb = round(get_peak_rss_mb(), 1)
+            with self._lock:
+                self.events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                                    'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'args': {**args, **open_span, 'peak_rss_mb': peak_rss_mb}})
+                self.events.append({'name': 'peak_rss_mb', 'ph': 'C', 'ts': (start + duration) * 1e6, 'pid': os.getpid(),
+                                    'args': {'peak_rss_mb': peak_rss_mb}})
+
+    #Adds bytes read or written to the innermost open span of this thread
+    def add_bytes(self, read=0, written=0):
+        if not self.enabled:
+            return
+        spans = self._open_spans()
+        if spans:
+            spans[-1]['bytes_read'] += int(read)
+            spans[-1]['bytes_written'] += int(written)
+
+    #Events recorded by this process, which are then dropped. Worker processes hand them back to the main process
+    #with their results. Forked workers start with a copy of the events of the main process, those are not theirs
+    def take_events(self):
+        with self._lock:
+            events = [event for event in self.events if event['pid'] == os.getpid()]
+            self.events = []
+        return events
+
+    def add_events(self, events):
+        with self._lock:
+            self.events.extend(events)
+
+    #Count, seconds, bytes and peak memory of the spans of every name
+    def summarize(self):
+        summary = {}
+        for event in self.events:
+            if event['ph'] != 'X':
+                continue
+            totals = summary.setdefault(event['name'], {'count': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'peak_rss_mb': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += event['dur'] / 1e6
+            totals['bytes_read'] += event['args']['bytes_read']
+            totals['bytes_written'] += event['args']['bytes_written']
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], event['args']['peak_rss_mb'])
+        return summary
+
+    def print_summary(self):
+        for name, totals in sorted(self.summarize().items(), key=lambda item: -item[1]['seconds']):
+            print_colored("cyan", f"{name}: {totals['count']} x, {totals['seconds']:.3f}s, {totals['bytes_read'] / 2**20:.1f} MB read, "
+                                  f"{totals['bytes_written'] / 2**20:.1f} MB written, peak memory {totals['peak_rss_mb']:.0f} MB")
+
+    def write_trace(self, trace_path):
+        with self._lock:
+            events = list(self.events)
+        with open(trace_path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'summary': self.summarize()}}, trace_file)
+        print_colored("green", f"Wrote the trace of {len(events)} events to {trace_path}")
+
+#The profiler of the running script. Worker processes get their own copy
+profiler = Profiler()
+
+def profile_span(name, category='segmentation', **args):
+    return profiler.span(name, category, **args)
+
+def add_profiled_bytes(read=0, written=0):
+    profiler.add_bytes(read, written)
+
+def add_profiling_arguments(parser):
+    parser.add_argument("--profile", dest='profile', action="store_true",
+                        help="Time the steps of the script and print how long each took, the bytes it read and wrote and the peak memory")
+    parser.add_argument("--trace-out", dest='trace_out', action="store", type=pathlib.Path, default=None,
+                        help="Also write the timeline of the steps to this json file, for chrome://tracing or ui.perfetto.dev")
+
+#Turns the profiler on for --profile or --trace-out. The summary (and the trace) are written when the script exits
+def enable_profiling(parsed_args):
+    if not (parsed_args.profile or parsed_args.trace_out):
+        return
+    profiler.enabled = True
+
+    def finish_profiling():
+        profiler.print_summary()
+        if parsed_args.trace_out:
+            profiler.write_trace(parsed_args.trace_out)
+    atexit.register(finish_profiling)
+
 napari_viewer_parser = argparse.ArgumentParser(description='Parse arguments for napari viewer.')
 
 napari_viewer_parser.add_argument(
@@ -86,4 +272,40 @@ napari_viewer_parser.add_argument("--bounds", "-b",
                     action="store",
                     nargs=1, #Show it is optional
                     type=pathlib.Path,
-                    help="Specify a single file with segementation boundaries to load in");
\ No newline at end of file
+                    help="Specify a single segmentation label store (segmentation_labels-*.zarr) to load the cell borders of");
+pipeline_parser = argparse.ArgumentParser(description='Run the whole segmentation pipeline on czi files.')
+
+pipeline_parser.add_argument(
+    '--debug', '-d', dest='debug',
+    action='store_true',
+    help='Print additional information to the terminal when running script'
+)
+
+pipeline_parser.add_argument(
+    'files', nargs='+', type=pathlib.Path,
+    help='Input 1 or more CZI File Paths to run the pipeline on'
+)
+
+gating_parser = argparse.ArgumentParser(description='Gate and cell type stitched cell tables of a cohort without the viewer.')
+
+gating_parser.add_argument(
+    '--debug', '-d', dest='debug',
+    action='store_true',
+    help='Print additional information to the terminal when running script'
+)
+
+gating_parser.add_argument(
+    'files', nargs='+', type=pathlib.Path,
+    help='Input 1 or more stitched cell tables to gate'
+)
+
+benchmark_parser = argparse.ArgumentParser(description='Benchmark the pipeline and viewer data paths on synthetic slides.')
+
+benchmark_parser.add_argument(
+    '--debug', '-d', dest='debug',
+    action='store_true',
+    help='Print additional information to the terminal when running script'
+)
+
+for parser in [cell_segment_parser, napari_viewer_parser, pipeline_parser, gating_parser, benchmark_parser]:
+    add_profiling_arguments(parser)
@@ -0,0 +1,85 @@
+import numpy as np
+
+from skimage.measure import points_in_poly
+
+#Spatial index over the stitched centroids of a slide, used by the viewer to only draw the cells in view
+# Includes
+#   1. A CellGridIndex class that buckets the cells into a uniform grid of square bins. The cells are sorted by bin,
+#      so the cells of a run of bins in the same grid row are one contiguous slice. Rectangle, radius and polygon
+#      queries only look at the bins they overlap, so they take time in the number of cells near the query and not in
+#      the number of cells of the slide
+#   2. Cell counts per bin (optionally only of some cells), drawn instead of the points when zoomed out
+
+DEFAULT_BIN_SIZE = 256 #Pixels. About a dozen cells across at 0.5 microns per pixel
+
+class CellGridIndex:
+    def __init__(self, centroids, bin_size=DEFAULT_BIN_SIZE):
+        self.centroids = np.ascontiguousarray(np.asarray(centroids, dtype=np.float64).reshape(-1, 2))
+        self.bin_size = bin_size
+        self.origin = np.floor(self.centroids.min(axis=0)) if len(self.centroids) else np.zeros(2)
+
+        grid_positions = ((self.centroids - self.origin) // bin_size).astype(np.int64)
+        self.shape = tuple(int(length) for length in grid_positions.max(axis=0) + 1) if len(self.centroids) else (0, 0)
+        self.bins = grid_positions[:, 0] * self.shape[1] + grid_positions[:, 1]
+
+        #Cells sorted by bin and where the cells of every bin start, so bin b has order[starts[b]:starts[b + 1]]
+        self.order = np.argsort(self.bins, kind='stable')
+        self.counts = np.bincount(self.bins, minlength=self.shape[0] * self.shape[1])
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)))
+
+    def __len__(self):
+        return len(self.centroids)
+
+    #Range of bins (row_start, row_end, col_start, col_end) overlapping a rectangle of the slide, clipped to the grid
+    def _bin_range(self, row_min, row_max, col_min, col_max):
+        row_start, col_start = np.floor((np.array([row_min, col_min]) - self.origin) / self.bin_size).astype(np.int64)
+        row_end, col_end = np.floor((np.array([row_max, col_max]) - self.origin) / self.bin_size).astype(np.int64) + 1
+        return (max(row_start, 0), min(row_end, self.shape[0]), max(col_start, 0), min(col_end, self.shape[1]))
+
+    #Cells in the bins overlapping a rectangle, a slice of the sorted cells per grid row
+    def _candidates(self, row_min, row_max, col_min, col_max):
+        row_start, row_end, col_start, col_end = self._bin_range(row_min, row_max, col_min, col_max)
+        if row_start >= row_end or col_start >= col_end:
+            return np.empty(0, dtype=np.int64)
+        slices = [self.order[self.starts[grid_row * self.shape[1] + col_start]:self.starts[grid_row * self.shape[1] + col_end]]
+                  for grid_row in range(row_start, row_end)]
+        return np.concatenate(slices)
+
+    #Number of cells in the bins overlapping a rectangle, without looking at any cell. An upper bound of query_rect
+    def count_rect(self, row_min, row_max, col_min, col_max):
+        row_start, row_end, col_start, col_end = self._bin_range(row_min, row_max, col_min, col_max)
+        if row_start >= row_end or col_start >= col_end:
+            return 0
+        return int(self.counts.reshape(self.shape)[row_start:row_end, col_start:col_end].sum())
+
+    #Indices (sorted) of the cells inside a rectangle, edges included
+    def query_rect(self, row_min, row_max, col_min, col_max):
+        candidates = self._candidates(row_min, row_max, col_min, col_max)
+        rows, cols = self.centroids[candidates, 0], self.centroids[candidates, 1]
+        inside = (rows >= row_min) & (rows <= row_max) & (cols >= col_min) & (cols <= col_max)
+        return np.sort(candidates[inside])
+
+    #Indices (sorted) of the cells within radius of center (row, col)
+    def query_radius(self, center, radius):
+        candidates = self._candidates(center[0] - radius, center[0] + radius, center[1] - radius, center[1] + radius)
+        distances = np.sum((self.centroids[candidates] - np.asarray(center, dtype=np.float64)) ** 2, axis=1)
+        return np.sort(candidates[distances <= radius ** 2])
+
+    #Indices (sorted) of the cells inside a polygon of (row, col) vertices, like an ROI drawn in napari
+    def query_polygon(self, vertices):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        (row_min, col_min), (row_max, col_max) = vertices.min(axis=0), vertices.max(axis=0)
+        candidates = self._candidates(row_min, row_max, col_min, col_max)
+        if len(candidates) == 0:
+            return candidates
+        return np.sort(candidates[points_in_poly(self.centroids[candidates], vertices)])
+
+    #Cells per bin as a 2D array, only counting the cells where mask is True. Drawn with a scale of bin_size and a
+    #translate of get_density_translate() it lines up with the slide
+    def density(self, mask=None):
+        counts = self.counts if mask is None else np.bincount(self.bins[mask], minlength=self.shape[0] * self.shape[1])
+        return counts.reshape(self.shape).astype(np.float32)
+
+    #Position of the center of the first bin, where napari puts pixel (0, 0) of the density
+    def get_density_translate(self):
+        return tuple(float(position) for position in self.origin + self.bin_size / 2)
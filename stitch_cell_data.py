@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#################################################################################################################
+#Filename: stitch_cell_data.py
+
+# GOAL: Stitch the cell table of a segmented slide back together. The centroids of every cell are moved from the
+#coordinates of its fov to the coordinates of the whole slide, using the tile offsets in tile_metadata.txt. When the
+#tiles overlap (tile_czi.py --overlap) the cells on a seam are in the table of both fovs, and only the one whose
+#centroid is in the core of its fov is kept (see get_tile_cores)
+
+# INPUT: 1 or more segmented slide directories (the czi_filename_dir moved back from ark-analysis), containing
+#tile_metadata.txt and single_cell_output/cell_table_arcsinh_transformed-{cell_file_name} (.parquet, .feather or .csv)
+
+# OUTPUT: single_cell_output/cell_table_arcsinh_transformed_stitched-{cell_file_name}.parquet (or the --format chosen)
+#in every slide directory
+
+# usage: stitch_cell_data.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--chunksize CHUNKSIZE] [--format {parquet,feather,csv}] files [files ...]
+#
+# positional arguments:
+#   files          Input 1 or more segmented slide directories to stitch
+#
+# optional arguments:
+#   -h, --help     show this help message and exit
+#   --debug, -d    Prints out information when stitching. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
+#   --chunksize CHUNKSIZE
+#                  Stitch the cell table this many rows at a time, for tables larger than memory. (Default is all at once)
+#   --format {parquet,feather,csv}
+#                  Format of the stitched cell table. csv is only meant for exporting. (Default is parquet)
+
+#################################################################################################################
+
+from pathlib import Path
+from cell_table_io import CELL_TABLE_FORMATS, DEFAULT_CELL_TABLE_FORMAT, CellTableWriter, get_cell_table_path, iter_cell_table, read_cell_table
+from segmentation_utils import print_colored, cell_segment_parser, load_tile_metadata, get_tile_cores, profile_span, add_profiled_bytes, \
+    enable_profiling
+
+import numpy as np
+import pandas as pd
+
+DEBUG = False
+
+#Gets the cell_file_name used by the notebook outputs from the slide directory. Ex: cell_to_segment_dir -> cell_to_segment
+def get_cell_file_name(segmented_cell_dir):
+    name = Path(segmented_cell_dir).resolve().name
+    return name[:-4] if name.endswith('_dir') else name
+
+CORE_COLUMNS = ['core_x1', 'core_x2', 'core_y1', 'core_y2']
+
+#Row and column offsets of every fov and the core its cells are kept from (in slide coordinates), indexed by fov name
+def load_tile_offsets(tile_metadata_path):
+    tiles = load_tile_metadata(tile_metadata_path)
+    tile_offsets = pd.DataFrame({
+        'x1': [float(tile['x1']) for tile in tiles],
+        'y1': [float(tile['y1']) for tile in tiles],
+    }, index=pd.Index([tile['fov'] for tile in tiles], name='fov'))
+    tile_offsets[CORE_COLUMNS] = pd.DataFrame.from_dict(get_tile_cores(tiles), orient='index', columns=CORE_COLUMNS)
+    return tile_offsets
+
+#Moves the centroids of every cell by the offsets of its fov in one vectorized pass, and drops the cells whose
+#stitched centroid is outside the core of their fov: the second copy of a cell on the seam of overlapping tiles. The fov
+#column is looked up once as a categorical over the fovs of the tile metadata
+def stitch_cell_table(cell_data, tile_offsets):
+    fov_codes = pd.Categorical(cell_data['fov'], categories=tile_offsets.index).codes
+    if np.any(fov_codes < 0):
+        unknown_fovs = sorted(set(cell_data['fov'][fov_codes < 0]))
+        raise KeyError(f"Cells from fovs {unknown_fovs} are not in tile_metadata.txt")
+
+    centroid_row = cell_data['centroid-0'].to_numpy(dtype=np.float64) + tile_offsets['x1'].to_numpy()[fov_codes]
+    centroid_col = cell_data['centroid-1'].to_numpy(dtype=np.float64) + tile_offsets['y1'].to_numpy()[fov_codes]
+    cell_data['centroid-0'] = centroid_row
+    cell_data['centroid-1'] = centroid_col
+
+    core_x1, core_x2, core_y1, core_y2 = (tile_offsets[column].to_numpy()[fov_codes] for column in CORE_COLUMNS)
+    in_core = (centroid_row >= core_x1) & (centroid_row < core_x2) & (centroid_col >= core_y1) & (centroid_col < core_y2)
+    if in_core.all():
+        return cell_data
+    if DEBUG: print(f"DEBUG: Dropping {np.count_nonzero(~in_core)} cells that are on a seam of another fov")
+    return cell_data[in_core]
+
+#Stitches a cell table into output_path, in the format of its suffix. With chunksize the table is read, stitched and
+#written that many rows at a time, so it never has to fit in memory. Returns the number of cells dropped as seam copies
+def stitch_cell_table_file(cell_table_path, tile_metadata_path, output_path, chunksize=None):
+    tile_offsets = load_tile_offsets(tile_metadata_path)
+    cells_read = 0
+
+    with profile_span("stitch cell table", path=Path(cell_table_path).name), CellTableWriter(output_path) as writer:
+        if chunksize is None:
+            chunks = [read_cell_table(cell_table_path)]
+        else:
+            chunks = iter_cell_table(cell_table_path, chunksize)
+            add_profiled_bytes(read=Path(cell_table_path).stat().st_size)
+        for chunk in chunks:
+            if DEBUG: print(f"DEBUG: Stitching rows {writer.rows_written} to {writer.rows_written + len(chunk) - 1}")
+            cells_read += len(chunk)
+            with profile_span("stitch chunk", cells=len(chunk)):
+                writer.write(stitch_cell_table(chunk, tile_offsets))
+    return cells_read - writer.rows_written
+
+def stich_cell_data(segmented_cell_dir, cell_file_name=None, chunksize=None, cell_table_format=DEFAULT_CELL_TABLE_FORMAT):
+    cell_file_name = cell_file_name or get_cell_file_name(segmented_cell_dir)
+    tile_position_metadata_path = Path(segmented_cell_dir, "tile_metadata.txt")
+    single_cell_output_dir = Path(segmented_cell_dir, "single_cell_output")
+    single_cell_table_output_path = get_cell_table_path(single_cell_output_dir, f"cell_table_arcsinh_transformed-{cell_file_name}")
+    stitched_output_path = get_cell_table_path(single_cell_output_dir, f"cell_table_arcsinh_transformed_stitched-{cell_file_name}",
+                                               cell_table_format)
+
+    seam_copies = stitch_cell_table_file(single_cell_table_output_path, tile_position_metadata_path, stitched_output_path, chunksize)
+    print_colored("green", f"Created {stitched_output_path}" + (f", without {seam_copies} second copies of cells on tile seams"
+                                                                if seam_copies else ""))
+
+if __name__ == "__main__":
+    cell_segment_parser.add_argument("--chunksize", dest='chunksize', action="store", type=int, default=None,
+                        help="Stitch the cell table this many rows at a time, for tables larger than memory")
+    cell_segment_parser.add_argument("--format", dest='cell_table_format', action="store", choices=list(CELL_TABLE_FORMATS),
+                        default=DEFAULT_CELL_TABLE_FORMAT,
+                        help=f"Format of the stitched cell table. csv is only meant for exporting (Default is {DEFAULT_CELL_TABLE_FORMAT})")
+
+    cell_segment_parser_args = cell_segment_parser.parse_args()
+
+    if cell_segment_parser_args.debug:
+        DEBUG = True
+    enable_profiling(cell_segment_parser_args)
+
+    for segmented_cell_dir in cell_segment_parser_args.files:
+        stich_cell_data(segmented_cell_dir, chunksize=cell_segment_parser_args.chunksize,
+                        cell_table_format=cell_segment_parser_args.cell_table_format)
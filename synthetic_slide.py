@@ -0,0 +1,105 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+#Synthetic slides and cell tables, so the benchmarks can run on any machine without patient data
+# Includes
+#   1. write_synthetic_slide to write a multi-channel uint16 mosaic of cells on a jittered grid to a .npy file. The
+#      nuclear channels have the nuclei of the cells, the other channels a membrane ring for the cells positive for them,
+#      and the last columns of the slide have no tissue so some tiles are empty
+#   2. A SyntheticCzi class that reads that .npy with the parts of the aicspylibczi CziFile api tile_czi.py uses, so it
+#      can stand in for a czi (tile_czi.CziFile = SyntheticCzi)
+#   3. make_synthetic_cell_table to make a cell table with the columns ark writes, for any number of cells
+
+CELL_SPACING = 24 #Pixels between the centers of neighbouring cells
+NUCLEUS_RADIUS = 5
+CELL_RADIUS = 9
+MEMBRANE_WIDTH = 2
+MAX_JITTER = 3 #Pixels cell centers are moved off the grid by
+NOISE_LEVEL = 40 #Background noise of the tissue
+POSITIVE_FRACTION = 0.3 #Fraction of the cells positive for each membrane marker
+TISSUE_FRACTION = 0.8 #Fraction of the columns of the slide covered by tissue
+BAND_ROWS = 1024 #Rows of the slide generated at a time
+
+class SyntheticBoundingBox:
+    def __init__(self, x, y, w, h):
+        self.x, self.y, self.w, self.h = x, y, w, h
+
+class SyntheticCzi:
+    #Reads a mosaic written by write_synthetic_slide (channels, rows, cols) like aicspylibczi reads a czi. The mosaic
+    #is memory mapped so only the regions read are loaded, like reading a czi region
+    PIXEL_TYPES = {np.dtype(np.uint8): 'gray8', np.dtype(np.uint16): 'gray16', np.dtype(np.float32): 'gray32float'}
+
+    def __init__(self, slide_path):
+        self.mosaic = np.load(slide_path, mmap_mode='r')
+        self.pixel_type = self.PIXEL_TYPES[self.mosaic.dtype]
+
+    def get_dims_shape(self):
+        channels, rows, cols = self.mosaic.shape
+        return [{'C': (0, channels), 'Y': (0, rows), 'X': (0, cols)}]
+
+    def get_mosaic_bounding_box(self):
+        _, rows, cols = self.mosaic.shape
+        return SyntheticBoundingBox(0, 0, cols, rows)
+
+    #region is (x0, y0, width, height) with x the column axis, like aicspylibczi
+    def read_mosaic(self, region=None, scale_factor=1, C=0):
+        assert scale_factor == 1, "Only full resolution reads are supported"
+        if region is None:
+            return np.array(self.mosaic[C][np.newaxis])
+        x0, y0, width, height = region
+        return np.array(self.mosaic[C, y0:y0 + height, x0:x0 + width][np.newaxis])
+
+#Jitter and per channel intensity of every cell of the grid. Nuclear channels are positive in every cell
+def get_cell_grid(rows, cols, nchannels, nuclear_channels, rng):
+    grid_shape = (-(-rows // CELL_SPACING), -(-cols // CELL_SPACING))
+    jitter = rng.integers(-MAX_JITTER, MAX_JITTER + 1, size=(2,) + grid_shape)
+    intensities = rng.uniform(500, 4000, size=(nchannels,) + grid_shape)
+    positive = rng.random((nchannels,) + grid_shape) < POSITIVE_FRACTION
+    positive[list(nuclear_channels)] = True
+    return jitter, (intensities * positive).astype(np.float32)
+
+#Squared distance of every pixel of rows row_start:row_end to the center of its cell, and the grid index of the cell
+def get_cell_distances(row_start, row_end, cols, jitter):
+    grid_rows = np.arange(row_start, row_end)[:, np.newaxis] // CELL_SPACING
+    grid_cols = np.arange(cols)[np.newaxis, :] // CELL_SPACING
+    center_rows = grid_rows * CELL_SPACING + CELL_SPACING // 2 + jitter[0][grid_rows, grid_cols]
+    center_cols = grid_cols * CELL_SPACING + CELL_SPACING // 2 + jitter[1][grid_rows, grid_cols]
+    distances = (np.arange(row_start, row_end)[:, np.newaxis] - center_rows) ** 2 + (np.arange(cols)[np.newaxis, :] - center_cols) ** 2
+    return distances, grid_rows, grid_cols
+
+#Writes a (channels, rows, cols) uint16 mosaic to slide_path (.npy) one band of rows at a time, so slides larger than
+#memory can be made. The first nuclear_channels have the nuclei, the others membrane rings
+def write_synthetic_slide(slide_path, rows, cols, nchannels, nuclear_channels=(0,), seed=0, tissue_fraction=TISSUE_FRACTION):
+    rng = np.random.default_rng(seed)
+    jitter, intensities = get_cell_grid(rows, cols, nchannels, nuclear_channels, rng)
+    tissue_cols = int(cols * tissue_fraction)
+
+    mosaic = np.lib.format.open_memmap(slide_path, mode='w+', dtype=np.uint16, shape=(nchannels, rows, cols))
+    for row_start in range(0, rows, BAND_ROWS):
+        row_end = min(row_start + BAND_ROWS, rows)
+        distances, grid_rows, grid_cols = get_cell_distances(row_start, row_end, cols, jitter)
+        nucleus = distances <= NUCLEUS_RADIUS ** 2
+        membrane = (distances <= CELL_RADIUS ** 2) & (distances > (CELL_RADIUS - MEMBRANE_WIDTH) ** 2)
+        for channel in range(nchannels):
+            band = rng.integers(0, NOISE_LEVEL, size=(row_end - row_start, cols)).astype(np.float32)
+            band += np.where(nucleus if channel in nuclear_channels else membrane, intensities[channel][grid_rows, grid_cols], 0)
+            band[:, tissue_cols:] = 0
+            mosaic[channel, row_start:row_end] = band.astype(np.uint16)
+    mosaic.flush()
+    return Path(slide_path)
+
+#Cell table like ark's cell_table_arcsinh_transformed: cell_size, the markers, label, centroids and fov, with the
+#cells spread evenly over the given fovs. Centroids are in the coordinates of the fov
+def make_synthetic_cell_table(ncells, markers, fovs, tile_size, seed=0):
+    rng = np.random.default_rng(seed)
+    cell_fovs = np.sort(rng.integers(0, len(fovs), size=ncells))
+    table = pd.DataFrame({'cell_size': rng.integers(50, 400, size=ncells).astype(np.float64)})
+    for marker in markers:
+        table[marker] = np.arcsinh(rng.gamma(1.0, 0.05, size=ncells) * 100)
+    table['label'] = np.arange(ncells) - np.searchsorted(cell_fovs, cell_fovs) + 1 #Labels start at 1 in every fov
+    table['centroid-0'] = rng.uniform(0, tile_size, size=ncells)
+    table['centroid-1'] = rng.uniform(0, tile_size, size=ncells)
+    table['fov'] = np.asarray(fovs, dtype=object)[cell_fovs]
+    return table
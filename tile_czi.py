@@ -4,23 +4,37 @@
 #################################################################################################################
 #Filename: tile_czi.py
 
-# GOAL: Goal of this script is to take a czi file, and to create a directory of subdirectories containing
-#single channel tiffs  to prepare their organization for deep_cell segmntation
+# GOAL: Goal of this script is to take a czi file, and to create a directory already laid out for deep_cell
+#segmntation: single channel tiffs of every FOV and the summed nuclear/membrane deepcell input of every FOV
 
 # INPUT: .czi file (Example: cell_to_segment.czi)
 
-# OUTPUT: Directory containing subdirectories for each FOV, themselves containing single-channel .tiff images
+# OUTPUT: Directory in the layout ark-analysis expects, so it can be moved to ark-analysis/data as is
 #Output loks like:
-    #Cell_to_segment/
-    #   Fov0/
-    #       channel0.tiff
-    #       channel1.tiff ...
-    #   Fov1/
-    #       channel0.tiff
-    #       channel1.tiff ...
+    #Cell_to_segment_dir/
+    #   deepcell_output/
+    #   input_data/
+    #       deepcell_input/
+    #           fov0.tif                (nuclear and membrane channels summed, channels first)
+    #       mibitiff_inputs/
+    #       single_channel_inputs/
+    #           fov0/
+    #               TIFs/
+    #                   channel0.tiff
+    #                   channel1.tiff ...
+    #   empty_fovs/
+    #       fov2/TIFs/...               (tiles found to be empty, so later steps skip them)
+    #   tile_metadata.txt
+    #   Cell_to_segment_pyramid.zarr/   (only with --pyramid)
+#And in final_data/ the slide metadata (.Cell_to_segment_metadata.json) with the intensity stats of every channel next
+#to it (.Cell_to_segment_intensity_stats.json and .Cell_to_segment_intensity_histograms.npz)
 
 #Arguments that you can use!
-# usage: tile_czi.py [-h] [--debug] [--channel] files [files ...]
+# usage: tile_czi.py [-h] [--debug] [--profile] [--trace-out TRACE_OUT] [--channel] [--stream] [--max-memory MAX_MEMORY]
+#                    [--compression {none,zlib,zstd,lzw}] [--compression-level LEVEL] [--workers WORKERS]
+#                    [--nuclear-channel NUCLEAR_CHANNEL] [--background-level BACKGROUND_LEVEL]
+#                    [--empty-threshold EMPTY_THRESHOLD] [--tile-size TILE_SIZE] [--overlap OVERLAP] [--pyramid]
+#                    [--pyramid-levels PYRAMID_LEVELS] [--chunk-size CHUNK_SIZE] [--nucs NUCS] [--mems MEMS] files [files ...]
 #
 # positional arguments:
 #   files          Input 1 or more CZI File Paths to Tile
@@ -28,24 +42,95 @@
 # optional arguments:
 #   -h, --help     show this help message and exit
 #   --debug, -d    Prints out information when tiling the czi. (Default is False)
+#   --profile      Prints how long every step took, the bytes it read and wrote and the peak memory. (Default is False)
+#   --trace-out TRACE_OUT
+#                  Also writes the timeline of the steps as a Chrome trace json (chrome://tracing or ui.perfetto.dev)
 #   --channel, -c  View, Select, and Add Channels!
+#   --stream, -s   Read each tile's region straight from the czi instead of the full mosaic. Peak memory then
+#                  depends on the tile size and not on the size of the slide
+#   --max-memory MAX_MEMORY, -m MAX_MEMORY
+#                  Memory limit in MB. Falls back to --stream if the full mosaic does not fit, and stops tiling
+#                  if the peak memory of the script goes over it
+#   --compression {none,zlib,zstd,lzw}
+#                  Compression used for the tile tiffs (Default is zlib). zstd and lzw need imagecodecs installed
+#   --compression-level LEVEL
+#                  Compression level for zlib and zstd
+#   --workers WORKERS, -w WORKERS
+#                  Number of processes reading, compressing and writing tiles at once across all files. Each process
+#                  tiles every channel of one tile. With more than 1 worker each tile region is streamed from the czi.
+#                  (Default is 1)
+#   --nuclear-channel NUCLEAR_CHANNEL
+#                  Channel used to find empty tiles (Default is the first channel)
+#   --background-level BACKGROUND_LEVEL
+#                  Nuclear channel pixels above this level count as signal (Default is 0)
+#   --empty-threshold EMPTY_THRESHOLD
+#                  Tiles with less than this fraction of signal pixels are marked as empty in tile_metadata.txt,
+#                  and later steps skip them (Default is 0.001)
+#   --tile-size TILE_SIZE
+#                  Size in pixels of the square tiles, recorded in the slide metadata for the later steps. auto picks the
+#                  largest of 2048, 1024 and 512 at which every worker can hold a tile, to tile and to quantify it, in
+#                  half the memory available (and under --max-memory). (Default is 2048)
+#   --overlap OVERLAP
+#                  Pixels neighbouring tiles overlap by, so cells on the seam between two tiles are whole in at least
+#                  one of them. stitch_cell_data.py keeps one copy of every cell seen by two tiles. Should be more than
+#                  the diameter of a cell (Default is 0)
+#   --pyramid      Also write a chunked multi-resolution pyramid of every channel (OME-Zarr) in the same pass, so
+#                  the slide can be opened at any zoom level by reading only the chunks needed
+#   --pyramid-levels PYRAMID_LEVELS
+#                  Number of pyramid levels, each half the size of the one before (Default is 4)
+#   --chunk-size CHUNK_SIZE
+#                  Chunk size of the pyramid. Has to divide the tile size (Default is 512)
+#   --nucs NUCS    Comma separated nuclear channels summed into the deepcell input (Default is DAPI)
+#   --mems MEMS    Comma separated membrane channels summed into the deepcell input (Default is CD8,CD4,CD163,CD3).
+#                  Pass --nucs '' --mems '' to skip the deepcell input
 
 #################################################################################################################
 
 from aicspylibczi import CziFile
 from pathlib import Path
-from segmentation_utils import print_colored, cell_segment_parser
+from intensity_stats import IntensityStats, get_histogram, get_intensity_stats_path
+from segmentation_utils import print_colored, cell_segment_parser, get_peak_rss_mb, get_slide_metadata_path, \
+    profile_span, add_profiled_bytes, profiler, enable_profiling
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import io
 import json
+import psutil
+import shutil
+import time
 
 import numpy as np
 import tifffile as tf
+import zarr
 
 import os
 
 DEBUG = False #Used to output additional infomation when the czi is being filed
-TILE_SIZE = 2048 # Using this tile size because it is the largest that can be done
+DEFAULT_TILE_SIZE = 2048 # Using this tile size because it is the largest that can be done
+AUTO_TILE_SIZE = 'auto' #--tile-size that picks the tile size of every slide from the memory available (see pick_tile_size)
+MIN_AUTO_TILE_SIZE = 512 #Smallest tile size auto picks, smaller tiles cut too many cells on their seams
+AUTO_MEMORY_FRACTION = 0.5 #Share of the available memory auto plans the tiles of every worker in
+#Bytes per pixel quantify_cells.py holds for a tile besides its channels: the labels and the per pixel work arrays of the
+#bincounts, about 25 on 2048 pixel tiles
+QUANTIFY_PIXEL_BYTES = 32
 DEFAULT_CHANNELs_TO_USE = 1
-written = False
+
+#Bytes per pixel of the czi pixel types we expect to see. Used to estimate memory before reading anything
+PIXEL_TYPE_BYTES = {'gray8': 1, 'gray16': 2, 'gray32': 4, 'gray32float': 4, 'bgr24': 3, 'bgr48': 6}
+
+COMPRESSION_CHOICES = ['none', 'zlib', 'zstd', 'lzw']
+LEVELED_COMPRESSION = ['zlib', 'zstd'] #lzw has no level setting
+DEFAULT_COMPRESSION = 'zlib'
+
+DEFAULT_BACKGROUND_LEVEL = 0 #Only zero padding and blank regions count as background by default
+DEFAULT_EMPTY_THRESHOLD = 0.001 #Fraction of the tile that has to be signal for it not to be empty
+DEFAULT_OVERLAP = 0 #Pixels neighbouring tiles share
+
+DEFAULT_PYRAMID_LEVELS = 4
+DEFAULT_CHUNK_SIZE = 512
+
+#Channels summed into the nuclear and membrane planes of the deepcell input. Same as nucs and mems in the notebook
+DEFAULT_NUCS = ['DAPI']
+DEFAULT_MEMS = ['CD8', 'CD4', 'CD163', 'CD3']
 
 #All current channels. Can be added to for easier command line argument parsing.
 all_channels = [
@@ -60,10 +145,52 @@ channels_to_use = all_channels[1]
 cell_segment_parser.add_argument("--channel", "-c", dest='channel', action="store_true",
                     help="View, Select, and Add Channels!")
 
-cell_segment_parser_args = cell_segment_parser.parse_args()
+cell_segment_parser.add_argument("--stream", "-s", dest='stream', action="store_true",
+                    help="Read each tile straight from the czi instead of holding the full mosaic in memory")
+
+cell_segment_parser.add_argument("--max-memory", "-m", dest='max_memory', action="store", type=float, default=None,
+                    help="Memory limit in MB. Falls back to --stream if the mosaic does not fit, and stops if it is exceeded")
+
+cell_segment_parser.add_argument("--compression", dest='compression', action="store", choices=COMPRESSION_CHOICES,
+                    default=DEFAULT_COMPRESSION, help=f"Compression for the tile tiffs (Default is {DEFAULT_COMPRESSION})")
+
+cell_segment_parser.add_argument("--compression-level", dest='compression_level', action="store", type=int, default=None,
+                    help="Compression level for zlib and zstd. Uses the codec default if not given")
+
+cell_segment_parser.add_argument("--workers", "-w", dest='workers', action="store", type=int, default=1,
+                    help="Number of processes tiling (file, tile) regions at once, every channel of a tile in one process. More than 1 always streams tiles")
+
+cell_segment_parser.add_argument("--nuclear-channel", dest='nuclear_channel', action="store", default=None,
+                    help="Channel used to find empty tiles (Default is the first channel)")
+
+cell_segment_parser.add_argument("--background-level", dest='background_level', action="store", type=float,
+                    default=DEFAULT_BACKGROUND_LEVEL, help=f"Pixels above this level count as signal (Default is {DEFAULT_BACKGROUND_LEVEL})")
+
+cell_segment_parser.add_argument("--empty-threshold", dest='empty_threshold', action="store", type=float,
+                    default=DEFAULT_EMPTY_THRESHOLD,
+                    help=f"Tiles with a smaller fraction of signal pixels are marked empty (Default is {DEFAULT_EMPTY_THRESHOLD})")
+
+cell_segment_parser.add_argument("--tile-size", dest='tile_size', action="store",
+                    type=lambda tile_size: tile_size if tile_size == AUTO_TILE_SIZE else int(tile_size), default=DEFAULT_TILE_SIZE,
+                    help=f"Size in pixels of the square tiles, or {AUTO_TILE_SIZE} to fit a tile per worker in the memory available (Default is {DEFAULT_TILE_SIZE})")
+
+cell_segment_parser.add_argument("--overlap", dest='overlap', action="store", type=int, default=DEFAULT_OVERLAP,
+                    help=f"Pixels neighbouring tiles overlap by, more than a cell across (Default is {DEFAULT_OVERLAP})")
+
+cell_segment_parser.add_argument("--pyramid", dest='pyramid', action="store_true",
+                    help="Also write a chunked multi-resolution OME-Zarr pyramid of every channel while tiling")
+
+cell_segment_parser.add_argument("--pyramid-levels", dest='pyramid_levels', action="store", type=int,
+                    default=DEFAULT_PYRAMID_LEVELS, help=f"Number of pyramid levels (Default is {DEFAULT_PYRAMID_LEVELS})")
+
+cell_segment_parser.add_argument("--chunk-size", dest='chunk_size', action="store", type=int, default=DEFAULT_CHUNK_SIZE,
+                    help=f"Chunk size of the pyramid, has to divide the tile size (Default is {DEFAULT_CHUNK_SIZE})")
 
-if cell_segment_parser_args.debug:
-    DEBUG = True
+cell_segment_parser.add_argument("--nucs", dest='nucs', action="store", type=lambda channels: [c for c in channels.replace(" ", "").split(',') if c],
+                    default=None, help=f"Comma separated nuclear channels of the deepcell input (Default is {','.join(DEFAULT_NUCS)})")
+
+cell_segment_parser.add_argument("--mems", dest='mems', action="store", type=lambda channels: [c for c in channels.replace(" ", "").split(',') if c],
+                    default=None, help=f"Comma separated membrane channels of the deepcell input (Default is {','.join(DEFAULT_MEMS)})")
 
 #Gets proper channels from above for tiling
 def get_channel_choice(len_of_channels):
@@ -77,120 +204,726 @@ def get_channel_choice(len_of_channels):
         except Exception as  e:
             print_colored("red", f"Invalid channel choice! {e}")
 
-if cell_segment_parser_args.channel:
+def select_channels():
     print_colored("cyan", f"Select which channels you would like to use. Optionally, use your own. (Note: Current Default is option {DEFAULT_CHANNELs_TO_USE})")
 
     print_colored("green", f"CHANNEL CHOICES")
     for index, channel in enumerate(all_channels):
         print_colored("green", f"[{index}] {channel}")
     print_colored("green", f"[{len(all_channels)}] Input Custom Channels")
-    choices = list(range(0, len(all_channels) + 1))
 
     num_to_use = get_channel_choice(len(all_channels))
 
     if(num_to_use < len(all_channels)):
-        channels_to_use = all_channels[num_to_use]
-    else:
-        print_colored("cyan", f"Type each channel out separated by a comma, and custom channels will be created. (No trailing comma!)")
-        channels_to_use = input("Give Channels: ").replace(" ", "").split(',')
+        return all_channels[num_to_use]
 
-input_czi_files = cell_segment_parser_args.files
+    print_colored("cyan", f"Type each channel out separated by a comma, and custom channels will be created. (No trailing comma!)")
+    return input("Give Channels: ").replace(" ", "").split(',')
 
-#This is useful for restitching fovs back together when done.
-def write_tile_breakdown(rows, cols, czi_filename):
-    global written
-    written = True
+#This is useful for restitching fovs back together when done. Extra information about the tiling is added to it
+def write_tile_breakdown(rows, cols, czi_filename, extra_metadata=None):
     data = {
         "dims": {'rows': rows, 'cols': cols},
         "filename": czi_filename.stem
     }
+    if extra_metadata:
+        data.update(extra_metadata)
 
     print_colored("yellow", f"Writing {str(data)} to .{czi_filename.stem} in final_data/")
-    with open(os.path.dirname(os.path.realpath(__file__)) + f'/final_data/.{czi_filename.stem}_metadata.json', 'w') as f:
+    with open(get_slide_metadata_path(czi_filename.stem), 'w') as f:
         json.dump(data, f, ensure_ascii=False)
 
-#Steps
-# 1. loop through all czi_files in input
-# 2. Loop thru each channel
-# 3. Create FOV Directories if not already made
-# 4. For the czi, create fov tiles with proper size
-# 5. Create the tiff files
-
-def tile_czi_file():
-    for input_czi_file in input_czi_files:
+#Start of each tile along an axis. Ex: get_tile_starts(7290) -> [0, 2048, 4096, 6144]
+#With overlap every tile starts overlap pixels before the end of the one before it, and there are only as many tiles
+#as needed to reach the end. Ex: get_tile_starts(7290, overlap=128) -> [0, 1920, 3840, 5760]
+def get_tile_starts(length, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    return [int(start) for start in np.arange(0, max(length - overlap, 1), tile_size - overlap)]
+
+#Estimate in MB of what tiling one channel will hold in memory at once. The mosaic (or the tile region when
+#streaming) plus the tile that gets written, both in the czi pixel type. With composite the nuclear and membrane planes
+#of the deepcell input are added (in get_composite_dtype): of one tile when streaming, of every tile otherwise
+def estimate_channel_memory_mb(czi, w, h, stream, composite=False, overlap=DEFAULT_OVERLAP, tile_size=DEFAULT_TILE_SIZE):
+    pixel_bytes = PIXEL_TYPE_BYTES.get(czi.pixel_type, 8)
+    tile_bytes = tile_size * tile_size * pixel_bytes
+    composite_plane_bytes = tile_size * tile_size * (4 if pixel_bytes <= 2 else 8)
+    if stream:
+        return (tile_size * tile_size * pixel_bytes + tile_bytes + (2 * composite_plane_bytes if composite else 0)) / 2**20
+    composite_bytes = 2 * len(get_tile_regions(w, h, overlap, tile_size)) * composite_plane_bytes if composite else 0
+    return (w * h * pixel_bytes + tile_bytes + composite_bytes) / 2**20
+
+#Estimate in MB of what every worker holds for one tile of the czi in the later per tile steps: streaming every
+#channel of the tile and its deepcell input while tiling, and all the channels and labels of the tile while quantifying
+def estimate_tile_memory_mb(czi, tile_size):
+    pixel_bytes = PIXEL_TYPE_BYTES.get(czi.pixel_type, 8)
+    nchannels = czi.get_dims_shape()[0]['C'][1]
+    quantify_bytes = tile_size * tile_size * (nchannels * pixel_bytes + QUANTIFY_PIXEL_BYTES)
+    return max(estimate_channel_memory_mb(czi, tile_size, tile_size, True, True, tile_size=tile_size), quantify_bytes / 2**20)
+
+#Tile size for --tile-size auto: the largest, halving from DEFAULT_TILE_SIZE down to MIN_AUTO_TILE_SIZE, at which a
+#tile for every worker fits in AUTO_MEMORY_FRACTION of the memory available now (and under --max-memory). Always more
+#than the overlap
+def pick_tile_size(czi, workers=1, max_memory=None, overlap=DEFAULT_OVERLAP):
+    memory_mb = psutil.virtual_memory().available / 2**20 * AUTO_MEMORY_FRACTION
+    if max_memory is not None:
+        memory_mb = min(memory_mb, max_memory)
+    tile_size = DEFAULT_TILE_SIZE
+    while (tile_size // 2 >= MIN_AUTO_TILE_SIZE and tile_size // 2 > overlap and
+           workers * estimate_tile_memory_mb(czi, tile_size) > memory_mb):
+        tile_size //= 2
+    if DEBUG: print(f"DEBUG: {memory_mb:.0f} MB for {workers} workers, tiles of {tile_size} pixels need about "
+                    f"{estimate_tile_memory_mb(czi, tile_size):.1f} MB each")
+    return tile_size
+
+#Reads only the bounding box of a single tile from the czi. x is the row axis and y the column axis like in
+#tile_metadata.txt, while the czi region is (x0, y0, width, height) in mosaic coordinates starting at mosaic_origin
+def read_tile_region(czi, channel, mosaic_origin, x, x_end, y, y_end):
+    region = (mosaic_origin[0] + int(y), mosaic_origin[1] + int(x), int(y_end - y), int(x_end - x))
+    with profile_span("read tile region", channel=int(channel)):
+        tile_region = czi.read_mosaic(region=region, scale_factor=1, C=int(channel))
+        add_profiled_bytes(read=tile_region.nbytes)
+    return tile_region
+
+#Create empty tile in the czi dtype and copy the region in, useful for padding out incomplete tiles at the edges with zeros
+def pad_tile(region, tile_size=DEFAULT_TILE_SIZE):
+    tile = np.zeros((tile_size, tile_size), dtype=region.dtype)
+    tile[0:region.shape[0], 0:region.shape[1]] = region
+    return tile
+
+#Writes the tile with tifffile and returns the size of the tiff and the seconds it took
+def write_tile(tile, tiff_path, write_kwargs):
+    start = time.perf_counter()
+    with profile_span("write tile", path=tiff_path.name):
+        tf.imwrite(str(tiff_path), tile, **write_kwargs)
+        size = tiff_path.stat().st_size
+        add_profiled_bytes(written=size)
+    return size, time.perf_counter() - start
+
+#All tiles of the mosaic in fov order. Each tile is (fov, x, x_end, y, y_end)
+def get_tile_regions(w, h, overlap=DEFAULT_OVERLAP, tile_size=DEFAULT_TILE_SIZE):
+    tiles = []
+    for x in get_tile_starts(w, tile_size, overlap):
+        x_end = min(x + tile_size, w) #Get cap on width
+        for y in get_tile_starts(h, tile_size, overlap):
+            y_end = min(y + tile_size, h) #Get cap on height
+            tiles.append((len(tiles), x, x_end, y, y_end))
+    return tiles
+
+#Keyword arguments for tf.imwrite for the chosen compression. The horizontal predictor helps a lot on 16 bit images
+def get_compression_kwargs(compression, compression_level=None):
+    if compression is None or compression == 'none':
+        return {}
+    kwargs = {'compression': compression, 'predictor': True}
+    if compression_level is not None and compression in LEVELED_COMPRESSION:
+        kwargs['compressionargs'] = {'level': compression_level}
+    return kwargs
+
+#Encodes a tile in memory with every codec and measures the size and time it takes, so the codec can be picked
+#per cohort. Codecs that are not installed (imagecodecs) are recorded with their error instead
+def compare_compression(tile, compression_level=None):
+    comparison = {}
+    for codec in COMPRESSION_CHOICES:
+        buffer = io.BytesIO()
+        try:
+            start = time.perf_counter()
+            tf.imwrite(buffer, tile, **get_compression_kwargs(codec, compression_level))
+            seconds = time.perf_counter() - start
+        except Exception as e:
+            comparison[codec] = {'error': str(e)}
+            continue
+        size = len(buffer.getvalue())
+        comparison[codec] = {'bytes': size, 'seconds': round(seconds, 4), 'ratio': round(tile.nbytes / size, 3)}
+    return comparison
+
+#Cheap signal statistics of a tile of the nuclear channel, used to find background and padding tiles.
+#Occupancy is the fraction of the tile above the background level
+def get_tile_signal_stats(tile, background_level):
+    return {
+        'mean': round(float(tile.mean(dtype=np.float64)), 3),
+        'max': float(tile.max()),
+        'occupancy': round(np.count_nonzero(tile > background_level) / tile.size, 6),
+    }
 
+#Directory the single channel tiffs of a fov are written to, in the ark-analysis layout
+def get_fov_tiff_dir(slide_dir, fov):
+    return Path(slide_dir, "input_data", "single_channel_inputs", 'fov' + str(fov), "TIFs")
+
+def get_deepcell_input_path(slide_dir, fov):
+    return Path(slide_dir, "input_data", "deepcell_input", 'fov' + str(fov) + ".tif")
+
+#Channel indices summed into the nuclear and membrane planes of the deepcell input, or None to not write it. Without
+#nucs/mems the defaults that are among the channels are used
+def get_composite_channels(channels_to_use, nucs=None, mems=None):
+    if nucs is None:
+        nucs = [channel for channel in DEFAULT_NUCS if channel in channels_to_use]
+    if mems is None:
+        mems = [channel for channel in DEFAULT_MEMS if channel in channels_to_use]
+    if not nucs and not mems:
+        return None
+    missing = [channel for channel in nucs + mems if channel not in channels_to_use]
+    assert not missing, f"Deepcell input channels {missing} are not one of {channels_to_use}"
+    return [[channels_to_use.index(channel) for channel in nucs], [channels_to_use.index(channel) for channel in mems]]
+
+#Dtype the deepcell input of tiles of a dtype is summed and written in. Wide enough that summing a few 8 or 16 bit
+#channels never wraps around, so bright pixels stay bright
+def get_composite_dtype(dtype):
+    dtype = np.dtype(dtype)
+    return np.dtype(np.uint32) if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2 else np.dtype(np.float64)
+
+#Adds the region of a channel to the nuclear (0) and/or membrane (1) plane of a fov's deepcell input, creating it on
+#the first channel. Summed in get_composite_dtype of the tiles, not in their dtype, so the sums do not overflow
+def add_to_composite(composite, composite_channels, channel, region, tile_size=DEFAULT_TILE_SIZE):
+    for plane, plane_channels in enumerate(composite_channels):
+        if channel in plane_channels:
+            if composite is None:
+                composite = np.zeros((2, tile_size, tile_size), dtype=get_composite_dtype(region.dtype))
+            composite[plane, 0:region.shape[0], 0:region.shape[1]] += region
+    return composite
+
+#Writes the deepcell input of a fov. Returned like a tile so it is counted the same way
+def save_composite(fov, composite, composite_path, write_kwargs):
+    size, seconds = write_tile(composite, composite_path, write_kwargs)
+    return {'fov': fov, 'dtype': str(composite.dtype), 'bytes': size, 'decoded_bytes': composite.nbytes, 'seconds': seconds,
+            'comparison': None, 'signal_stats': None, 'composite': True, 'histograms': [get_histogram(plane) for plane in composite]}
+
+#Halves an image by averaging 2x2 blocks. Odd edges are padded by repeating the last row/column first
+def downsample_2x(image):
+    pad = ((0, image.shape[0] % 2), (0, image.shape[1] % 2))
+    if pad[0][1] or pad[1][1]:
+        image = np.pad(image, pad, mode='edge')
+    blocks = image.reshape(image.shape[0] // 2, 2, image.shape[1] // 2, 2)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+#Creates an empty OME-Zarr style pyramid for the slide: level l is a (channel, y, x) array 2**l times smaller than the
+#mosaic. Without overlap a chunk never spans two tiles, so tiles can be written into it in any order and from any
+#process. Returns the chunk layout that gets recorded in the slide metadata
+def create_pyramid(slide, channels_to_use, pyramid_levels, chunk_size):
+    tile_size = slide['tile_size']
+    tile_step = tile_size - slide['overlap']
+    assert tile_size % chunk_size == 0, f"--chunk-size {chunk_size} has to divide the tile size {tile_size}"
+    assert 0 < pyramid_levels and tile_size % 2**(pyramid_levels - 1) == 0, f"Too many pyramid levels for tile size {tile_size}"
+    assert tile_step % 2**(pyramid_levels - 1) == 0, \
+        f"Tiles {tile_step} pixels apart (--overlap {slide['overlap']}) do not line up with {pyramid_levels} pyramid levels"
+
+    #Read a single pixel to know the dtype of the mosaic without reading the mosaic
+    dtype = read_tile_region(slide['czi'], 0, slide['mosaic_origin'], 0, 1, 0, 1).dtype
+    pyramid_path = Path(slide['dir'], slide['path'].stem + '_pyramid.zarr')
+    root = zarr.open_group(str(pyramid_path), mode='w')
+
+    layout = []
+    for level in range(pyramid_levels):
+        shape = (len(channels_to_use), -(-slide['w'] // 2**level), -(-slide['h'] // 2**level))
+        chunks = (1, min(chunk_size, tile_size // 2**level), min(chunk_size, tile_size // 2**level))
+        root.zeros(str(level), shape=shape, chunks=chunks, dtype=dtype)
+        layout.append({'level': level, 'path': str(level), 'scale': 2**level, 'shape': list(shape), 'chunks': list(chunks)})
+
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': slide['path'].stem,
+        'axes': [{'name': 'c', 'type': 'channel'}, {'name': 'y', 'type': 'space'}, {'name': 'x', 'type': 'space'}],
+        'datasets': [{'path': level['path'], 'coordinateTransformations': [{'type': 'scale', 'scale': [1, level['scale'], level['scale']]}]}
+                     for level in layout]
+    }]
+    root.attrs['omero'] = {'channels': [{'label': channel_name} for channel_name in channels_to_use]}
+
+    return {
+        'format': 'zarr',
+        'name': pyramid_path.name,
+        'path': str(pyramid_path.resolve()),
+        'dtype': str(dtype),
+        'levels': pyramid_levels,
+        'chunk_size': chunk_size,
+        'layout': layout
+    }
 
-        czi_file_path = Path(input_czi_file)
-        czi = CziFile(czi_file_path)
-        im_shape = czi.get_dims_shape()
+#Rows and columns of a tile written to the pyramid: up to where the next tile starts, so overlapping tiles write every
+#pixel once. The last tiles of the slide and tiles that do not overlap are written whole
+def get_pyramid_extent(slide, x, x_end, y, y_end):
+    tile_step = slide['tile_size'] - slide['overlap']
+    return (x_end - x if x_end == slide['w'] else tile_step, y_end - y if y_end == slide['h'] else tile_step)
+
+#Pyramids opened by this process, so each is only opened once per (worker) process
+_opened_pyramids = {}
+
+#Writes a tile region into every level of the pyramid. All zero regions are skipped, they read back as the fill value.
+#Overlapping tiles share chunks, so when several processes write them the chunks are locked with pyramid_sync
+def write_pyramid_tile(pyramid_path, channel, region, x, y, pyramid_sync=None):
+    if not region.any():
+        return
+    if pyramid_path not in _opened_pyramids:
+        synchronizer = zarr.ProcessSynchronizer(pyramid_sync) if pyramid_sync is not None else None
+        _opened_pyramids[pyramid_path] = zarr.open_group(pyramid_path, mode='r+', synchronizer=synchronizer)
+    root = _opened_pyramids[pyramid_path]
+
+    level = 0
+    with profile_span("write pyramid tile", channel=int(channel)):
+        while str(level) in root:
+            if level > 0:
+                region = downsample_2x(region)
+            x_level, y_level = x // 2**level, y // 2**level
+            root[str(level)][channel, x_level:x_level + region.shape[0], y_level:y_level + region.shape[1]] = region
+            level += 1
+
+def check_memory(max_memory):
+    if max_memory is not None and get_peak_rss_mb() > max_memory:
+        raise MemoryError(f"Peak memory {get_peak_rss_mb():.1f} MB went over --max-memory {max_memory} MB")
+
+#Opens the czi and creates its output directory in the ark-analysis layout, with a directory per fov. Nothing is read
+#from the mosaic yet. Returns a dict describing the slide that the tiling fills in as it goes
+#With --tile-size auto the tile size of the slide is picked here for the workers that will tile it
+def prepare_czi_file(input_czi_file, channels_to_use, output_dir=os.path.curdir, empty_threshold=DEFAULT_EMPTY_THRESHOLD,
+                     overlap=DEFAULT_OVERLAP, tile_size=DEFAULT_TILE_SIZE, workers=1, max_memory=None):
+    czi_file_path = Path(input_czi_file)
+    czi = CziFile(czi_file_path)
+    im_shape = czi.get_dims_shape()
+
+    if tile_size == AUTO_TILE_SIZE:
+        tile_size = pick_tile_size(czi, workers, max_memory, overlap)
+        print_colored("cyan", f"Tiling {czi_file_path.name} in {tile_size}x{tile_size} tiles")
+    assert 0 <= overlap < tile_size, f"--overlap {overlap} has to be at least 0 and less than the tile size {tile_size}"
+
+    if DEBUG: print("DEBUG: CZI Image Shape:", im_shape)#  Ex: [{'X': (0, 2252), 'Y': (0, 1208), 'C': (0, 9), 'T': (0, 1), 'M': (0, 17), 'S': (0, 1), 'H': (0, 1)}]
+
+    nchannels = im_shape[0]['C'][1]
+
+    assert len(channels_to_use) == nchannels, "Number of channels for CZI and in file must match"
+
+    #Size of the stitched mosaic, known without reading any pixels
+    mosaic_box = czi.get_mosaic_bounding_box()
+    w, h = mosaic_box.h, mosaic_box.w #Ex: 7290, 4131 (rows, cols of the mosaic)
+
+    dir_to_create = Path(output_dir, czi_file_path.stem + '_dir')
+
+    try:
+        if DEBUG: print("DEBUG: Creating", dir_to_create)
+        Path.mkdir(dir_to_create)
+    except FileExistsError:
+        print_colored("yellow", f"NOTE: Tried to create {dir_to_create}, but directory {dir_to_create} is already made!")
+
+    #Here we get breakdown with tile_sizes
+    rows = get_tile_starts(w, tile_size, overlap) #Ex: [0, 2048, 4096, 6144]
+    cols = get_tile_starts(h, tile_size, overlap) #Ex: [0, 2048, 4096]
+    tiles = get_tile_regions(w, h, overlap, tile_size)
+
+    for layout_dir in [Path(dir_to_create, "deepcell_output"), Path(dir_to_create, "input_data", "mibitiff_inputs"),
+                       Path(dir_to_create, "input_data", "deepcell_input")]:
+        layout_dir.mkdir(parents=True, exist_ok=True)
+
+    for fov, x, x_end, y, y_end in tiles:
+        savedir = get_fov_tiff_dir(dir_to_create, fov)
+        if not os.path.isdir(savedir):
+            if DEBUG: print(f"Created directory {savedir}")
+            savedir.mkdir(parents=True)
+
+    return {
+        'path': czi_file_path,
+        'czi': czi,
+        'nchannels': nchannels,
+        'mosaic_origin': (mosaic_box.x, mosaic_box.y),
+        'w': w,
+        'h': h,
+        'rows': rows,
+        'cols': cols,
+        'tiles': tiles,
+        'tile_size': tile_size,
+        'overlap': overlap,
+        'dir': dir_to_create,
+        #Sample tile (middle of the slide in the first channel) used to compare the compression codecs
+        'sample_fov': (len(rows) // 2) * len(cols) + len(cols) // 2,
+        'compression_comparison': None,
+        'tile_dtype': None,
+        'tiles_written': 0,
+        'composites_written': 0,
+        'bytes_written': 0,
+        'bytes_decoded': 0,
+        'write_seconds': 0.0,
+        'tile_stats': {}, #fov -> signal stats of the nuclear channel
+        'empty_threshold': empty_threshold,
+        'intensity_stats': IntensityStats(), #Histograms of every channel and tile, written next to the slide metadata
+        'pyramid': None, #Chunk layout of the pyramid when --pyramid is used
+        'pyramid_sync': None, #Chunk locks of the pyramid when overlapping tiles are written to it from several processes
+    }
 
-        if DEBUG: print("DEBUG: CZI Image Shape:", im_shape)#  Ex: [{'X': (0, 2252), 'Y': (0, 1208), 'C': (0, 9), 'T': (0, 1), 'M': (0, 17), 'S': (0, 1), 'H': (0, 1)}]
+#Adds the result of one written tile to the totals of its slide. The nuclear channel tile of a fov is always recorded
+#before its deepcell input, so the deepcell input of empty fovs (which gets dropped) is left out of the stats
+def record_tile(slide, tile_result):
+    if tile_result.get('composite'):
+        slide['composites_written'] += 1
+        if not is_empty_tile(slide['tile_stats'].get(tile_result['fov']), slide['empty_threshold']):
+            slide['intensity_stats'].add_deepcell_input(tile_result['histograms'])
+    else:
+        slide['tile_dtype'] = tile_result['dtype']
+        slide['tiles_written'] += 1
+        slide['intensity_stats'].add_tile(tile_result['fov'], tile_result['channel'], tile_result['histogram'], tile_result['dtype'])
+    slide['bytes_written'] += tile_result['bytes']
+    slide['bytes_decoded'] += tile_result['decoded_bytes']
+    slide['write_seconds'] += tile_result['seconds']
+    if tile_result['comparison'] is not None:
+        slide['compression_comparison'] = tile_result['comparison']
+    if tile_result['signal_stats'] is not None:
+        slide['tile_stats'][tile_result['fov']] = tile_result['signal_stats']
+
+def is_empty_tile(signal_stats, empty_threshold):
+    return signal_stats is not None and signal_stats['occupancy'] < empty_threshold
+
+#Writes tile_metadata.txt in fov order once every tile is done, with the nuclear signal stats of each tile and
+#whether it is empty
+def write_tile_metadata(slide, empty_threshold):
+    empty_fovs = []
+    with open(Path(slide['dir'], f"tile_metadata.txt"), "w") as f:
+        f.write('fov,x1,x2,y1,y2,nuclear_mean,nuclear_max,occupancy,empty\n')
+        for fov, x, x_end, y, y_end in slide['tiles']:
+            stats = slide['tile_stats'][fov]
+            empty = is_empty_tile(stats, empty_threshold)
+            if empty:
+                empty_fovs.append("fov" + str(fov))
+            f.write(",".join(["fov" + str(fov), str(x), str(x_end), str(y), str(y_end), str(stats['mean']),
+                              str(stats['max']), str(stats['occupancy']), str(int(empty))]) + "\n")
+    return empty_fovs
+
+#Moves the fov directories of empty tiles out of single_channel_inputs and drops their deepcell input, so neither
+#the notebook nor the pipeline segments them. One rename per empty fov
+def set_aside_empty_fovs(slide, empty_fovs):
+    empty_fovs_dir = Path(slide['dir'], "empty_fovs")
+    empty_fovs_dir.mkdir(exist_ok=True)
+    for fov in empty_fovs:
+        with profile_span("move empty fov", fov=fov):
+            fov_dir = Path(slide['dir'], "input_data", "single_channel_inputs", fov)
+            if Path(empty_fovs_dir, fov).exists():
+                shutil.rmtree(Path(empty_fovs_dir, fov))
+            os.replace(fov_dir, Path(empty_fovs_dir, fov))
+            deepcell_input_path = Path(slide['dir'], "input_data", "deepcell_input", fov + ".tif")
+            if deepcell_input_path.exists():
+                os.remove(deepcell_input_path)
+
+#Where the tiles of a slide are, recorded once in its metadata so every later step reads the tile size, overlap,
+#padding and extent of the slide from there (segmentation_utils.get_tile_geometry). The slide shape is in rows and
+#columns like tile_metadata.txt, the mosaic origin in czi (x, y) coordinates
+def get_tile_geometry_metadata(slide):
+    return {
+        "tile_size": slide['tile_size'],
+        "overlap": slide['overlap'],
+        "padding": "zeros", #Tiles at the bottom and right edges of the slide are padded to the tile size with zeros
+        "mosaic_origin": list(slide['mosaic_origin']),
+        "slide_shape": [slide['w'], slide['h']],
+        "padded_shape": [slide['rows'][-1] + slide['tile_size'], slide['cols'][-1] + slide['tile_size']]
+    }
 
-        nchannels = im_shape[0]['C'][1]
+def finish_czi_file(slide, compression, compression_level, nuclear_channel, background_level, empty_threshold,
+                    composite_channels=None, channels_to_use=None):
+    if slide['pyramid_sync'] is not None:
+        shutil.rmtree(slide['pyramid_sync'], ignore_errors=True)
+    with profile_span("write tile metadata", slide=slide['path'].name):
+        empty_fovs = write_tile_metadata(slide, empty_threshold)
+    if empty_fovs:
+        print_colored("yellow", f"NOTE: {len(empty_fovs)} of {len(slide['tiles'])} tiles of {slide['path'].name} are empty and will be skipped")
+        set_aside_empty_fovs(slide, empty_fovs)
+
+    with profile_span("write intensity stats", slide=slide['path'].name):
+        slide['intensity_stats'].write(slide['path'].stem, channels_to_use, [tile[0] for tile in slide['tiles']])
+
+    write_tile_breakdown(len(slide['rows']), len(slide['cols']), slide['path'], {
+        "empty_fovs": empty_fovs,
+        "empty_tile_detection": {
+            "channel": nuclear_channel,
+            "background_level": background_level,
+            "empty_threshold": empty_threshold
+        },
+        "tile_geometry": get_tile_geometry_metadata(slide),
+        "pyramid": slide['pyramid'],
+        "layout": "ark",
+        "deepcell_input": {
+            "nucs": [channels_to_use[channel] for channel in composite_channels[0]],
+            "mems": [channels_to_use[channel] for channel in composite_channels[1]]
+        } if composite_channels is not None else None,
+        "dtype": str(slide['tile_dtype']),
+        "intensity_stats": get_intensity_stats_path(slide['path'].stem).name,
+        "compression": {
+            "codec": compression,
+            "level": compression_level,
+            "bytes_written": slide['bytes_written'],
+            "write_seconds": round(slide['write_seconds'], 3),
+            "comparison_fov": "fov" + str(slide['sample_fov']),
+            "comparison": slide['compression_comparison']
+        }
+    })
+    print_colored("green", f"Created {slide['dir']} with channel tiffs in fov directories and "
+                           f"{slide['composites_written']} deepcell inputs!")
+
+#Pads, optionally compares codecs on, and writes a single tile. Signal stats are computed when a background level
+#is given (nuclear channel tiles), and the histogram of the tile (without the padding) always. Shared by the serial and
+#parallel tiling
+def save_tile(fov, region, tiff_path, write_kwargs, compare_level=None, compare=False, background_level=None,
+              tile_size=DEFAULT_TILE_SIZE):
+    tile = pad_tile(region, tile_size)
+    comparison = compare_compression(tile, compare_level) if compare else None
+    signal_stats = get_tile_signal_stats(tile, background_level) if background_level is not None else None
+
+    if DEBUG: print("DEBUG: Trying to write  Tiff file to " + str(tiff_path))
+    size, seconds = write_tile(tile, tiff_path, write_kwargs)
+    return {'fov': fov, 'dtype': str(tile.dtype), 'bytes': size, 'decoded_bytes': tile.nbytes, 'seconds': seconds,
+            'comparison': comparison, 'signal_stats': signal_stats, 'channel': tiff_path.stem, 'histogram': get_histogram(region)}
+
+#Reads every channel of one tile, writes the channel tiffs and sums the deepcell input while the channels of the tile
+#are in memory. Only the regions of this tile are ever read. Shared by the streaming serial tiling and the workers
+def save_fov_tiles(czi, work_item):
+    fov, x, x_end, y, y_end = work_item['tile']
+    composite = None
+    tile_results = []
+    with profile_span("tile fov", fov="fov" + str(fov)):
+        for channel, channel_name in enumerate(work_item['channels']):
+            if DEBUG: print(f"DEBUG: fov{fov} {channel_name} x:{x}, y:{y}, x_end:{x_end}, y_end:{y_end}")
+            region = read_tile_region(czi, channel, work_item['mosaic_origin'], x, x_end, y, y_end)[0]
+            is_nuclear = channel_name == work_item['nuclear_channel']
+            tile_results.append(save_tile(fov, region, Path(work_item['tiff_dir'], channel_name + ".tiff"), work_item['write_kwargs'],
+                                          work_item['compression_level'], compare=(channel == 0 and work_item['compare']),
+                                          background_level=work_item['background_level'] if is_nuclear else None,
+                                          tile_size=work_item['tile_size']))
+            if work_item['composite_channels'] is not None:
+                composite = add_to_composite(composite, work_item['composite_channels'], channel, region, work_item['tile_size'])
+            if work_item['pyramid_path'] is not None:
+                rows, cols = work_item['pyramid_extent']
+                write_pyramid_tile(work_item['pyramid_path'], channel, region[:rows, :cols], x, y, work_item['pyramid_sync'])
+            del region
+            check_memory(work_item['max_memory'])
+
+        if composite is not None:
+            tile_results.append(save_composite(fov, composite, work_item['composite_path'], work_item['write_kwargs']))
+    return tile_results
+
+#Everything needed to tile one fov of a slide, picklable so it can be sent to a worker
+def get_fov_work_item(slide, tile, channels_to_use, max_memory, write_kwargs, compression_level, nuclear_channel,
+                      background_level, composite_channels):
+    fov = tile[0]
+    return {
+        'path': str(slide['path']),
+        'mosaic_origin': slide['mosaic_origin'],
+        'tile': tile,
+        'tile_size': slide['tile_size'],
+        'channels': list(channels_to_use),
+        'tiff_dir': get_fov_tiff_dir(slide['dir'], fov),
+        'composite_path': get_deepcell_input_path(slide['dir'], fov),
+        'composite_channels': composite_channels,
+        'write_kwargs': write_kwargs,
+        'compression_level': compression_level,
+        'compare': fov == slide['sample_fov'],
+        'max_memory': max_memory,
+        'nuclear_channel': nuclear_channel,
+        'background_level': background_level,
+        'pyramid_path': slide['pyramid']['path'] if slide['pyramid'] is not None else None,
+        'pyramid_extent': get_pyramid_extent(slide, *tile[1:]),
+        'pyramid_sync': slide['pyramid_sync'],
+    }
 
-        assert len(channels_to_use) == nchannels, "Number of channels for CZI and in file must match"
+#Streaming goes one tile at a time through every channel. Otherwise the full mosaic of one channel at a time is read,
+#and the deepcell inputs of every tile are summed in memory until the last channel is done
+def tile_slide_serial(slide, channels_to_use, stream, max_memory, write_kwargs, compression_level,
+                      nuclear_channel, background_level, composite_channels=None):
+    czi = slide['czi']
+    if DEBUG: print("DEBUG: Reading", slide['path'].name)
+    if stream:
+        for tile in slide['tiles']:
+            for tile_result in save_fov_tiles(czi, get_fov_work_item(slide, tile, channels_to_use, max_memory, write_kwargs,
+                                                                     compression_level, nuclear_channel, background_level,
+                                                                     composite_channels)):
+                record_tile(slide, tile_result)
+        return
+
+    composites = {}
+    for channel in range(slide['nchannels']):
+        print_colored("cyan", "Reading " + channels_to_use[channel] + " channel")
+        with profile_span("read mosaic", channel=channels_to_use[channel]):
+            im = czi.read_mosaic(C=channel) #Ex: (1, 7290, 4131)
+            add_profiled_bytes(read=im.nbytes)
+
+        for fov, x, x_end, y, y_end in slide['tiles']:
+            if DEBUG: print(f"DEBUG: x:{x}, y:{y}, x_end:{x_end}, y_end:{y_end}")
+            region = im[0, x:x_end, y:y_end]
+
+            tiff_path = Path(get_fov_tiff_dir(slide['dir'], fov), channels_to_use[channel] + ".tiff")
+            is_nuclear = channels_to_use[channel] == nuclear_channel
+            record_tile(slide, save_tile(fov, region, tiff_path, write_kwargs, compression_level,
+                                         compare=(channel == 0 and fov == slide['sample_fov']),
+                                         background_level=background_level if is_nuclear else None,
+                                         tile_size=slide['tile_size']))
+            if composite_channels is not None:
+                composites[fov] = add_to_composite(composites.get(fov), composite_channels, channel, region, slide['tile_size'])
+            if slide['pyramid'] is not None:
+                rows, cols = get_pyramid_extent(slide, x, x_end, y, y_end)
+                write_pyramid_tile(slide['pyramid']['path'], channel, region[:rows, :cols], x, y)
+            del region
+            check_memory(max_memory)
+        del im
+
+    for fov, composite in composites.items():
+        record_tile(slide, save_composite(fov, composite, get_deepcell_input_path(slide['dir'], fov), write_kwargs))
+
+#czi files opened by a tiling worker process, so each czi is only opened once per process
+_worker_czi_files = {}
+
+#Runs in a worker process: reads every channel of a single tile from the czi, then compresses and writes the channel
+#tiffs and the deepcell input of the tile
+def tile_fov_worker(work_item):
+    czi_file_path = work_item['path']
+    if czi_file_path not in _worker_czi_files:
+        _worker_czi_files[czi_file_path] = CziFile(czi_file_path)
+
+    tile_results = save_fov_tiles(_worker_czi_files[czi_file_path], work_item)
+    for tile_result in tile_results:
+        tile_result['path'] = czi_file_path
+    return tile_results, profiler.take_events()
+
+#Work items for every (file, tile), in fov order
+def get_work_items(slides, channels_to_use, worker_max_memory, write_kwargs, compression_level,
+                   nuclear_channel, background_level, composite_channels=None):
+    for slide in slides:
+        for tile in slide['tiles']:
+            yield get_fov_work_item(slide, tile, channels_to_use, worker_max_memory, write_kwargs, compression_level,
+                                    nuclear_channel, background_level, composite_channels)
+
+#Records the tiles a worker wrote, and the spans it profiled
+def record_worker_results(slides_by_path, tile_results, trace_events):
+    for tile_result in tile_results:
+        record_tile(slides_by_path[tile_result['path']], tile_result)
+    profiler.add_events(trace_events)
+
+#Process pool over the work items of every slide. The queue of submitted tiles is bounded so the czi decoding,
+#compression and tiff writes of the workers overlap without the whole slide piling up in memory
+def tile_slides_parallel(slides, channels_to_use, workers, max_memory, write_kwargs, compression_level,
+                         nuclear_channel, background_level, composite_channels=None):
+    slides_by_path = {str(slide['path']): slide for slide in slides}
+    worker_max_memory = max_memory / workers if max_memory is not None else None
+    max_queued = workers * 2
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        queued = set()
+        for work_item in get_work_items(slides, channels_to_use, worker_max_memory, write_kwargs, compression_level,
+                                        nuclear_channel, background_level, composite_channels):
+            if len(queued) >= max_queued:
+                done, queued = wait(queued, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record_worker_results(slides_by_path, *future.result())
+            queued.add(pool.submit(tile_fov_worker, work_item))
+
+        for future in as_completed(queued):
+            record_worker_results(slides_by_path, *future.result())
+
+def print_throughput(slides, seconds):
+    tiles = sum(slide['tiles_written'] for slide in slides)
+    mb_written = sum(slide['bytes_written'] for slide in slides) / 2**20
+    mb_decoded = sum(slide['bytes_decoded'] for slide in slides) / 2**20
+    seconds = max(seconds, 1e-9)
+    print_colored("cyan", f"Tiled {tiles} tiles in {seconds:.1f}s: {tiles / seconds:.1f} tiles/s, "
+                          f"{mb_written / seconds:.1f} MB/s written ({mb_decoded / seconds:.1f} MB/s decoded)")
 
-        dir_to_create = Path(os.path.curdir, czi_file_path.stem + '_dir')
+#Steps
+# 1. loop through all czi_files in input, create FOV Directories if not already made and write tile_metadata.txt
+# 2. Loop thru each channel
+# 3. For the czi, create fov tiles with proper size. When streaming only the region of the tile is read
+# 4. Create the tiff files, and keep signal stats of the nuclear channel tiles to find empty tiles. The nucs and mems
+#    tiles are summed into the deepcell input of the fov at the same time, and the histogram of every tile is added to
+#    the intensity stats of its channel
+# 5. Write tile_metadata.txt with the empty tiles marked, and move the empty fovs out of single_channel_inputs
+# 6. Write the intensity stats next to the slide metadata in final_data/ (see intensity_stats.py)
+#With --pyramid every tile region is also downsampled into the levels of the slide's zarr pyramid in step 4
+#When streaming, steps 2-4 go tile by tile through every channel instead of channel by channel
+#With more than one worker, steps 2-4 run in a process pool over every (file, tile) at once
+#With --overlap every tile starts --overlap pixels before the tile before it ends, tile_metadata.txt has the real start
+#and end of every tile and the slide metadata the overlap
+#The tile size (picked per slide in step 1 with --tile-size auto), overlap, padding and extent of the slide are recorded
+#in the tile_geometry of the slide metadata, which is what every later step reads them from
+
+def tile_czi_file(input_czi_files, channels_to_use=channels_to_use, stream=False, max_memory=None,
+                  compression=DEFAULT_COMPRESSION, compression_level=None, workers=1, nuclear_channel=None,
+                  background_level=DEFAULT_BACKGROUND_LEVEL, empty_threshold=DEFAULT_EMPTY_THRESHOLD, pyramid=False,
+                  pyramid_levels=DEFAULT_PYRAMID_LEVELS, chunk_size=DEFAULT_CHUNK_SIZE, output_dir=os.path.curdir,
+                  nucs=None, mems=None, overlap=DEFAULT_OVERLAP, tile_size=DEFAULT_TILE_SIZE):
+    write_kwargs = get_compression_kwargs(compression, compression_level)
+    composite_channels = get_composite_channels(channels_to_use, nucs, mems)
+    composite = composite_channels is not None
+
+    if nuclear_channel is None:
+        nuclear_channel = channels_to_use[0]
+    assert nuclear_channel in channels_to_use, f"Nuclear channel {nuclear_channel} is not one of {channels_to_use}"
+    start = time.perf_counter()
+
+    slides = [prepare_czi_file(input_czi_file, channels_to_use, output_dir, empty_threshold, overlap, tile_size, workers, max_memory)
+              for input_czi_file in input_czi_files]
+    if pyramid:
+        for slide in slides:
+            slide['pyramid'] = create_pyramid(slide, channels_to_use, pyramid_levels, chunk_size)
+            if overlap and workers > 1:
+                slide['pyramid_sync'] = str(Path(slide['dir'], slide['path'].stem + '_pyramid.sync'))
+
+    if workers > 1:
+        #Each worker holds one tile region (and its deepcell input) at a time, so there are as many workers as tiles
+        #that fit in memory
+        if max_memory is not None:
+            tile_memory = max(estimate_channel_memory_mb(slide['czi'], slide['w'], slide['h'], True, composite,
+                                                         tile_size=slide['tile_size']) for slide in slides)
+            if tile_memory > max_memory:
+                raise MemoryError(f"A single tile needs about {tile_memory:.1f} MB which is over --max-memory {max_memory} MB")
+            if workers * tile_memory > max_memory:
+                workers = max(1, int(max_memory // tile_memory))
+                print_colored("yellow", f"NOTE: Lowering --workers to {workers} to stay under --max-memory {max_memory} MB")
+
+        print_colored("cyan", f"Tiling {len(slides)} czi files with {workers} workers")
+        with profile_span("tile slides", slides=len(slides), workers=workers):
+            tile_slides_parallel(slides, channels_to_use, workers, max_memory, write_kwargs, compression_level,
+                                 nuclear_channel, background_level, composite_channels)
+
+        for slide in slides:
+            finish_czi_file(slide, compression, compression_level, nuclear_channel, background_level, empty_threshold,
+                            composite_channels, channels_to_use)
+        print_colored("cyan", f"Peak memory: {get_peak_rss_mb():.1f} MB main process, "
+                              f"{get_peak_rss_mb(children=True):.1f} MB largest worker")
+    else:
+        for slide in slides:
+            czi, w, h, slide_tile_size = slide['czi'], slide['w'], slide['h'], slide['tile_size']
+
+            stream_file = stream
+            if max_memory is not None:
+                mosaic_memory = estimate_channel_memory_mb(czi, w, h, False, composite, overlap, slide_tile_size)
+                if not stream_file and mosaic_memory > max_memory:
+                    print_colored("yellow", f"NOTE: Full mosaic of {slide['path'].name} needs about {mosaic_memory:.1f} MB "
+                                            f"which is over --max-memory {max_memory} MB. Streaming tiles instead")
+                    stream_file = True
+                tile_memory = estimate_channel_memory_mb(czi, w, h, True, composite, tile_size=slide_tile_size)
+                if tile_memory > max_memory:
+                    raise MemoryError(f"A single tile of {slide['path'].name} needs about {tile_memory:.1f} MB "
+                                      f"which is over --max-memory {max_memory} MB")
+
+            with profile_span("tile slide", slide=slide['path'].name, stream=stream_file):
+                tile_slide_serial(slide, channels_to_use, stream_file, max_memory, write_kwargs, compression_level,
+                                  nuclear_channel, background_level, composite_channels)
+            finish_czi_file(slide, compression, compression_level, nuclear_channel, background_level, empty_threshold,
+                            composite_channels, channels_to_use)
+            print_colored("cyan", f"Peak memory while tiling {slide['path'].name}: {get_peak_rss_mb():.1f} MB")
+
+    print_throughput(slides, time.perf_counter() - start)
 
-        try:
-            if DEBUG: print("DEBUG: Creating", dir_to_create)
-            Path.mkdir(dir_to_create)
-        except FileExistsError:
-            print_colored("yellow", f"NOTE: Tried to create {dir_to_create}, but directory {dir_to_create} is already made!")
-
-        with open(Path(dir_to_create, f"tile_metadata.txt"), "w") as f:
-            f.write('fov,x1,x2,y1,y2\n')
-
-            if DEBUG: print("DEBUG: Reading", czi_file_path.name)
-            for channel in np.arange(nchannels):
-                print_colored("cyan", "Reading " + channels_to_use[channel] + " channel")
-                fov = 0
-                im = czi.read_mosaic(C=channel)
-                _, w, h = im.shape #Ex: (1, 7290, 4131)
-
-                #Here we get breakdown with tile_sizes
-                rows = list(np.arange(0, w, TILE_SIZE)) #Ex: [0, 2048, 4096, 6144]
-                cols = list(np.arange(0, h, TILE_SIZE)) #Ex: [0, 2048, 4096]
-
-                if(not written):
-                    write_tile_breakdown(len(rows), len(cols), czi_file_path)
-
-                for x in rows:
-                    if w - x < TILE_SIZE: #Get cap on width
-                        x_end = w
-                    else:
-                        x_end = x + TILE_SIZE
-
-                    for y in cols:
-                        # create empty tile, useful for padding out incomplete tiles at the edges with zeros
-                        tile = np.zeros((TILE_SIZE, TILE_SIZE))
-
-                        if h - y < TILE_SIZE: #Get cap on height
-                            y_end = h
-                        else:
-                            y_end = y + TILE_SIZE
-
-                        if DEBUG: print(f"DEBUG: x:{x}, y:{y}, x_end:{x_end}, y_end:{y_end}")
-                        tile[0:x_end - x, 0:y_end - y] = im[0, x:x_end, y:y_end]
-
-                        savedir = Path(dir_to_create, 'fov' + str(fov))
-
-                        if(os.path.isdir(savedir)):
-                            pass
-                            # if DEBUG: print_colored("yellow", f"NOTE: Tried to create {savedir}, but directory {savedir} is already made!")
-                        else:
-                            if DEBUG: print(f"Created directory {savedir}")
-                            Path.mkdir(savedir)
-
-                        #use tifffile to write the tiff file
-                        if DEBUG: print("DEBUG: Trying to write  Tiff file to " + str(savedir) + "/" + channels_to_use[channel] + ".tiff"+ " channel")
-
-                        tf.imwrite(str(Path(savedir, channels_to_use[channel] + ".tiff")), tile)
-
-                        if channel == 0:
-                            f.write(",".join(["fov" + str(fov), str(x), str(x_end), str(y), str(y_end)]) + "\n")
-                        fov += 1
-        print_colored("green", f"Created {dir_to_create} with channel tiffs in fov directories!")
 if __name__ == "__main__":
-    tile_czi_file()
-
+    cell_segment_parser_args = cell_segment_parser.parse_args()
+
+    if cell_segment_parser_args.debug:
+        DEBUG = True
+    enable_profiling(cell_segment_parser_args)
+
+    if cell_segment_parser_args.channel:
+        channels_to_use = select_channels()
+
+    tile_czi_file(cell_segment_parser_args.files, channels_to_use,
+                  stream=cell_segment_parser_args.stream,
+                  max_memory=cell_segment_parser_args.max_memory,
+                  compression=cell_segment_parser_args.compression,
+                  compression_level=cell_segment_parser_args.compression_level,
+                  workers=cell_segment_parser_args.workers,
+                  nuclear_channel=cell_segment_parser_args.nuclear_channel,
+                  background_level=cell_segment_parser_args.background_level,
+                  empty_threshold=cell_segment_parser_args.empty_threshold,
+                  pyramid=cell_segment_parser_args.pyramid,
+                  pyramid_levels=cell_segment_parser_args.pyramid_levels,
+                  chunk_size=cell_segment_parser_args.chunk_size,
+                  nucs=cell_segment_parser_args.nucs,
+                  mems=cell_segment_parser_args.mems,
+                  overlap=cell_segment_parser_args.overlap,
+                  tile_size=cell_segment_parser_args.tile_size)